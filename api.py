@@ -0,0 +1,210 @@
+import hashlib
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, List
+
+from flask import Blueprint, Response, g, request, url_for
+
+import db
+
+# versioned JSON API: the timelines, threads and search as compact JSON
+#
+# timelines page with the same cursors as the HTML views: a response
+# carries `next_cursor`, sent back as ?before= (?after= for a thread's
+# replies). every response has a weak ETag built from the newest post id
+# and the counters, like state, cache version and follow state of what
+# it shows, and a poll whose If-None-Match still matches gets an empty
+# 304. timelines build the ETag from a probe first - the page's post ids
+# and counters in one query without the page query's joins (see
+# db.get_timeline_stamps) - and only read the page when it doesn't match.
+# threads are read from the object caches, and text search has no probe
+# cheaper than the search itself, so those two build it from the rows.
+#
+# requests are authenticated by the same session cookie as the HTML
+# views, so responses are private to the viewer.
+
+API_PREFIX = '/api/v1'
+
+bp = Blueprint('api_v1', __name__)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+# compact: no whitespace, utf-8 instead of \u escapes
+def dumps(payload) -> str:
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False, default=_json_default)
+
+
+def _tweet(row: Dict) -> Dict:
+    tweet = {
+        'id': row['id'],
+        'user_id': row['user_id'],
+        'username': row['username'],
+        'content': row['content'],
+        'created_at': row['created_at'],
+        'thread_id': row['thread_id'],
+        'like_count': row['like_count'] or 0,
+        'reply_count': row['reply_count'] or 0,
+        'media': [url_for('static', filename=url) for url in row.get('media_urls') or ()],
+    }
+    if g.user:
+        tweet['is_liked'] = row.get('is_liked', False)
+    if 'replies' in row:
+        tweet['replies'] = [_tweet(reply) for reply in row['replies']]
+    return tweet
+
+def _user(row: Dict) -> Dict:
+    user = {key: row[key] for key in ('user_id', 'username', 'bio') if key in row}
+    user['profile_pic'] = url_for('static', filename=row['profile_pic']) if row.get('profile_pic') else None
+    if 'is_followed' in row:
+        user['is_followed'] = row['is_followed']
+    return user
+
+
+def _attach_like_state(tweets: List[Dict]) -> List[Dict]:
+    liked = set()
+    if g.user and tweets:
+        liked = db.get_liked_post_ids(g.user['user_id'], [tweet['id'] for tweet in tweets])
+    for tweet in tweets:
+        tweet['is_liked'] = tweet['id'] in liked
+    return tweets
+
+def _all_tweets(tweets: List[Dict]) -> Iterable[Dict]:
+    for tweet in tweets:
+        yield tweet
+        yield from _all_tweets(tweet.get('replies', []))
+
+# weak validator for a response showing `tweets` (rows, or the stamps of
+# db.get_timeline_stamps): the newest post id, then every tweet's
+# counters, like state and cache version - which moves with its media
+# and anything else reported to db.on_posts_changed - then anything else
+# the response shows (`extra`). the viewer is part of it because like
+# and follow state are
+def etag_for(tweets: List[Dict], *extra) -> str:
+    tweets = list(_all_tweets(tweets))
+    versions = db.post_versions([tweet['id'] for tweet in tweets])
+    digest = hashlib.sha1()
+    digest.update(f'{max((tweet["id"] for tweet in tweets), default=0)}|'.encode())
+    digest.update(f'{g.user["user_id"] if g.user else ""}|'.encode())
+    for tweet in tweets:
+        digest.update(f'{tweet["id"]}:{tweet["like_count"]}:{tweet["reply_count"]}:'
+                      f'{int(bool(tweet.get("is_liked")))}:{versions.get(tweet["id"])};'.encode())
+    digest.update(dumps(extra).encode())
+    return digest.hexdigest()[:20]
+
+# 304 when the client already has this version, else the JSON of `payload()`
+def conditional(etag: str, payload) -> Response:
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(dumps(payload()), mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+def error(status: int, message: str) -> Response:
+    return Response(dumps({'error': message}), status=status, mimetype='application/json')
+
+# a timeline page validated by `stamps`; `load()` reads the page, with
+# like state, only when the client's copy is out of date
+def _timeline(stamps: List[Dict], load: Callable[[], List[Dict]], *extra, **fields) -> Response:
+    def payload():
+        tweets = load()
+        next_cursor = db.next_page_cursor(tweets, db.PAGE_SIZE)
+        return {**fields, 'tweets': [_tweet(tweet) for tweet in tweets], 'next_cursor': next_cursor}
+    return conditional(etag_for(stamps, *extra), payload)
+
+
+# home timeline of the logged-in user
+@bp.route('/feed')
+def feed():
+    if not g.user:
+        return error(401, 'login required')
+    user_id, before = g.user['user_id'], request.args.get('before')
+    return _timeline(db.get_timeline_stamps('feed', user_id, user_id, before=before),
+                     lambda: _attach_like_state(db.get_feed_tweets(user_id, before=before)))
+
+# everyone's tweets, newest first
+@bp.route('/explore')
+def explore():
+    viewer_id, before = g.user['user_id'] if g.user else None, request.args.get('before')
+    return _timeline(db.get_timeline_stamps('explore', viewer_id=viewer_id, before=before),
+                     lambda: _attach_like_state(db.get_all_tweets(before=before)))
+
+# a user with their counts and tweets
+@bp.route('/users/<username>/tweets')
+def user_tweets(username):
+    viewer_id, before = g.user['user_id'] if g.user else None, request.args.get('before')
+    row = db.get_user_by_username(username)
+    if not row:
+        return error(404, 'user not found')
+    counts = db.get_follow_counts(row['user_id'], viewer_id)
+    user = {
+        **_user(row),
+        'follower_count': counts['follower_count'],
+        'following_count': counts['following_count'],
+    }
+    if viewer_id:
+        user['is_following'] = counts['is_following']
+    return _timeline(db.get_timeline_stamps('user', row['user_id'], viewer_id, before=before),
+                     lambda: _attach_like_state(db.get_user_tweets(row['user_id'], before=before)),
+                     user, user=user)
+
+# a tweet with its ancestors and reply tree; ?after= pages its direct replies
+@bp.route('/tweets/<int:tweet_id>')
+def thread(tweet_id):
+    conversation = db.get_conversation(tweet_id, after=request.args.get('after'))
+    if not conversation:
+        return error(404, 'tweet not found')
+    tweet, ancestors = conversation['tweet'], conversation['ancestors']
+    _attach_like_state(ancestors + list(_all_tweets([tweet])))
+    next_cursor = conversation['next_cursor']
+    return conditional(
+        etag_for(ancestors + [tweet], next_cursor),
+        lambda: {
+            'ancestors': [_tweet(ancestor) for ancestor in ancestors],
+            'tweet': _tweet(tweet),
+            'next_cursor': next_cursor,
+        },
+    )
+
+# ?q=#tag for a hashtag, ?q=@name for users, anything else searches
+# content (?sort=recent for newest first instead of best match)
+@bp.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    before = request.args.get('before')
+    if not query:
+        return error(400, 'q is required')
+    if query.startswith('@'):
+        users = db.search_users(query[1:])
+        followed = set()
+        if g.user and users:
+            followed = db.get_followed_user_ids(g.user['user_id'], [user['user_id'] for user in users])
+        for user in users:
+            user['is_followed'] = user['user_id'] in followed
+        users = [_user(user) for user in users]
+        return conditional(etag_for([], users), lambda: {'users': users})
+    viewer_id = g.user['user_id'] if g.user else None
+    if query.startswith('#'):
+        hashtag = query[1:]
+        return _timeline(db.get_timeline_stamps('hashtag', hashtag, viewer_id, before=before),
+                         lambda: _attach_like_state(db.search_tweets_by_hashtag(hashtag, before=before)))
+    sort = 'recent' if request.args.get('sort') == 'recent' else 'relevance'
+    tweets = _attach_like_state(db.search_tweets_by_content(query, before=before, sort=sort))
+    return _timeline(tweets, lambda: tweets, sort, sort=sort)
+
+
+# mount the API under API_PREFIX (default /api/v1)
+def init_app(app):
+    app.config.setdefault('API_PREFIX', API_PREFIX)
+    app.register_blueprint(bp, url_prefix=app.config['API_PREFIX'])
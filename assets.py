@@ -0,0 +1,159 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from typing import Dict, Optional
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # brotli variants are optional
+    brotli = None
+
+# fingerprinted, precompressed static files
+#
+# `flask build-assets` copies every file under static/ into static/dist/
+# with a hash of its contents in the name (css/app.css ->
+# css/app.3f2a9c1d0b7e4a55.css) and writes .gz (and .br) copies of text
+# files next to them. init_app() makes url_for('static', ...) point at
+# those copies and serves them with a year-long immutable Cache-Control,
+# a strong ETag and the best encoding the client accepts. without a
+# build, static files are served as before.
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# only these are worth compressing, images are already compressed
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.xml', '.map', '.html', '.ico'}
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# encodings in order of preference -> file suffix
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# uploads are already named by the sha256 of their contents (see media.py)
+CONTENT_HASHED_NAME = re.compile(r'^[0-9a-f]{64}(_[a-z]+)?\.[a-z0-9]+$')
+
+
+def _fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def _compress(path: str, use_brotli: bool):
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path + '.gz', 'wb') as out:
+        # mtime=0 keeps the output identical between builds
+        out.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if use_brotli:
+        with open(path + '.br', 'wb') as out:
+            out.write(brotli.compress(data, quality=11))
+
+
+# fingerprint and precompress everything under `static_folder`, replacing
+# any previous build. returns the manifest {source path: built path}
+def build(static_folder: str, use_brotli: bool = True) -> Dict[str, str]:
+    use_brotli = use_brotli and brotli is not None
+    dist = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dist and not d.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            stem, extension = os.path.splitext(relative)
+            if CONTENT_HASHED_NAME.match(name):
+                # the name already is a fingerprint, serve the file where it is
+                continue
+            built = f'{stem}.{_fingerprint(source)}{extension}'
+            target = os.path.join(dist, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            if extension.lower() in COMPRESSIBLE_EXTENSIONS:
+                _compress(target, use_brotli)
+            manifest[relative] = f'{DIST_DIR}/{built}'
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder: str) -> Dict[str, str]:
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# True for files whose contents can never change under their name
+def is_immutable(filename: str) -> bool:
+    return filename.startswith(DIST_DIR + '/') or bool(CONTENT_HASHED_NAME.match(os.path.basename(filename)))
+
+
+def _etag(filename: str) -> str:
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if CONTENT_HASHED_NAME.match(os.path.basename(filename)):
+        return stem
+    # built names end in the fingerprint
+    return stem.rsplit('.', 1)[-1]
+
+
+# the precompressed copy of `filename` the client accepts, as (encoding, suffix)
+def _pick_encoding(static_folder: str, filename: str) -> Optional[tuple]:
+    accepted = request.accept_encodings
+    for encoding, suffix in ENCODINGS:
+        if accepted[encoding] and os.path.isfile(os.path.join(static_folder, filename + suffix)):
+            return encoding, suffix
+    return None
+
+
+def init_app(app):
+    manifest = load_manifest(app.static_folder)
+    app.extensions['assets_manifest'] = manifest
+    default_view = app.view_functions['static']
+
+    # url_for('static', filename='css/app.css') -> the fingerprinted copy
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            values['filename'] = manifest.get(values['filename'], values['filename'])
+
+    def static_view(filename):
+        if not is_immutable(filename):
+            return default_view(filename=filename)
+
+        picked = _pick_encoding(app.static_folder, filename)
+        etag = _etag(filename)
+        path = filename
+        if picked is not None:
+            encoding, suffix = picked
+            path = filename + suffix
+            etag = f'{etag}-{encoding}'
+
+        response = send_from_directory(
+            app.static_folder, path,
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            etag=etag, max_age=31536000, conditional=True,
+        )
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        if picked is not None:
+            response.headers['Content-Encoding'] = picked[0]
+        return response
+
+    app.view_functions['static'] = static_view
+    return manifest
@@ -0,0 +1,402 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+import mysql.connector
+
+# storage engines behind db.py
+#
+# db.py is written against the mysql.connector API: cursor(dictionary=True),
+# %s placeholders, callproc()/stored_results() for the stored procedures in
+# setup.sql. MySQLBackend hands out mysql connections as they are.
+# SQLiteBackend hands out the same surface over an embedded SQLite file in
+# WAL mode - statements are rewritten into SQLite's dialect, the stored
+# procedures run as plain SQL in the calling transaction and errors are
+# raised as mysql.connector errors, so db.py needs to branch only where
+# the two engines have no common syntax (see db._is_sqlite()).
+
+
+class MySQLBackend:
+    name = 'mysql'
+
+    # `config` is read on every connect, so later changes to it apply
+    # to new connections. pass multi_statements=False when a proxy in
+    # front of the server refuses multi-statement queries
+    def __init__(self, config: Dict, multi_statements: bool = True):
+        self.config = config
+        self.supports_multi_statements = multi_statements
+
+    @property
+    def label(self) -> str:
+        return f"{self.config.get('host', 'localhost')}:{self.config.get('port', 3306)}"
+
+    def connect(self):
+        return mysql.connector.connect(**self.config)
+
+    # seconds a replica trails its source, 0 for a server that isn't
+    # replicating (e.g. a second local instance in tests) and None when
+    # replication is configured but stopped
+    def replication_lag(self, conn) -> Optional[float]:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            try:
+                cursor.execute('SHOW REPLICA STATUS')
+            except mysql.connector.errors.ProgrammingError:
+                cursor.execute('SHOW SLAVE STATUS')  # before 8.0.22
+            status = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not status:
+            return 0.0
+        lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+        return None if lag is None else float(lag)
+
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup_sqlite.sql')
+
+# applied to every connection: WAL lets readers run alongside the single
+# writer, NORMAL sync is safe under WAL (a power cut can lose the last
+# commits, never corrupt the file), and the page cache/mmap keep hot
+# pages out of the read() path
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': 5000,        # ms to wait for the write lock
+    'cache_size': -64000,        # KiB of page cache per connection
+    'temp_store': 'MEMORY',
+    'mmap_size': 268435456,
+    'wal_autocheckpoint': 1000,  # pages
+}
+
+
+def _adapt_datetime(value: datetime) -> str:
+    return value.isoformat(' ')
+
+def _convert_timestamp(value: bytes) -> datetime:
+    return datetime.fromisoformat(value.decode())
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_adapter(Decimal, float)
+sqlite3.register_converter('TIMESTAMP', _convert_timestamp)
+
+# columns holding timestamps; SQLite only reports declared types for plain
+# column references, so values read through expressions are parsed by name
+TIMESTAMP_COLUMNS = {'created_at', 'followed_at', 'liked_at'}
+
+
+# mysql functions db.py uses that SQLite doesn't have
+def _unix_timestamp(value=None) -> Optional[int]:
+    if value is None:
+        return int(time.time())
+    try:
+        return int(time.mktime(datetime.fromisoformat(str(value)).timetuple()))
+    except ValueError:
+        return None
+
+def _floor(value) -> Optional[int]:
+    return None if value is None else int(value // 1)
+
+
+_TRANSLATIONS = [
+    (re.compile(r'%(s|%)'), lambda m: '?' if m.group(1) == 's' else '%'),
+    (re.compile(r'\bINSERT\s+IGNORE\s+INTO\b', re.I), 'INSERT OR IGNORE INTO'),
+    (re.compile(r'\bAS\s+UNSIGNED\)', re.I), 'AS INTEGER)'),
+    (re.compile(r'\bNOW\(\)\s*-\s*INTERVAL\s+\?\s+SECOND\b', re.I),
+     "datetime('now', 'localtime', '-' || ? || ' seconds')"),
+    (re.compile(r'\bNOW\(\)', re.I), "datetime('now', 'localtime')"),
+    (re.compile(r'\bCHAR_LENGTH\(', re.I), 'LENGTH('),
+    (re.compile(r'\s+FOR\s+UPDATE\b', re.I), ''),
+    # mysql escapes LIKE patterns with a backslash by default
+    (re.compile(r'\bLIKE\s+\?', re.I), "LIKE ? ESCAPE '\\\\'"),
+    # row-value lists: (a, b) IN ((?, ?), (?, ?)) -> (a, b) IN (VALUES (?, ?), (?, ?))
+    (re.compile(r'\bIN\s*\(\s*(\(\?(?:\s*,\s*\?)+\)(?:\s*,\s*\(\?(?:\s*,\s*\?)+\))*)\s*\)'), r'IN (VALUES \1)'),
+]
+
+_FOR_UPDATE = re.compile(r'\bFOR\s+UPDATE\b', re.I)
+
+# mysql-flavoured statement -> (sqlite statement, whether it takes the write lock)
+@lru_cache(maxsize=1024)
+def translate(sql: str):
+    locks = bool(_FOR_UPDATE.search(sql))
+    for pattern, replacement in _TRANSLATIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql, locks
+
+
+def _map_error(error: sqlite3.Error) -> mysql.connector.errors.Error:
+    if isinstance(error, sqlite3.IntegrityError):
+        cls = mysql.connector.errors.IntegrityError
+    elif isinstance(error, sqlite3.OperationalError):
+        cls = mysql.connector.errors.OperationalError
+    elif isinstance(error, sqlite3.NotSupportedError):
+        cls = mysql.connector.errors.NotSupportedError
+    elif isinstance(error, sqlite3.ProgrammingError):
+        cls = mysql.connector.errors.ProgrammingError
+    else:
+        cls = mysql.connector.errors.DatabaseError
+    return cls(msg=str(error))
+
+
+# one result set of a procedure, read like mysql's stored_results() items
+class _StoredResult:
+    def __init__(self, rows: List[tuple]):
+        self._rows = list(rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+# the stored procedures of setup.sql as statements on the caller's cursor,
+# each returning the rows of its result set
+def _publish_tweet(cursor, user_id, content, thread_id):
+    cursor.execute('INSERT INTO post (user_id, content, thread_id) VALUES (?, ?, ?)',
+                   (user_id, content, thread_id))
+    post_id = cursor.lastrowid
+    if thread_id is not None:
+        cursor.execute('INSERT INTO replies (post_id, reply_id) VALUES (?, ?)', (thread_id, post_id))
+    return [(post_id,)]
+
+def _create_user(cursor, user_id, username, email, bio, profile_pic):
+    cursor.execute('SELECT 1 FROM user WHERE username = ? OR email = ?', (username, email))
+    if cursor.fetchone():
+        return [(False, 'Username or email already exists')]
+    cursor.execute(
+        'INSERT INTO user (user_id, username, email, bio, profile_pic) VALUES (?, ?, ?, ?, ?)',
+        (user_id, username, email, bio, profile_pic)
+    )
+    return [(True, 'User created successfully')]
+
+def _insert_pair(table: str, columns: Sequence[str]):
+    def procedure(cursor, first, second):
+        cursor.execute(f'INSERT OR IGNORE INTO {table} ({columns[0]}, {columns[1]}) VALUES (?, ?)',
+                       (first, second))
+        return [(cursor.rowcount > 0,)]
+    return procedure
+
+def _delete_pair(table: str, columns: Sequence[str]):
+    def procedure(cursor, first, second):
+        cursor.execute(f'DELETE FROM {table} WHERE {columns[0]} = ? AND {columns[1]} = ?',
+                       (first, second))
+        return [(cursor.rowcount > 0,)]
+    return procedure
+
+PROCEDURES = {
+    'publish_tweet': _publish_tweet,
+    'create_user': _create_user,
+    'follow_user': _insert_pair('follows', ('follower_id', 'following_id')),
+    'unfollow_user': _delete_pair('follows', ('follower_id', 'following_id')),
+    'like_post': _insert_pair('likes', ('user_id', 'post_id')),
+    'unlike_post': _delete_pair('likes', ('user_id', 'post_id')),
+}
+
+
+# mysql.connector-style cursor over a sqlite3 cursor
+class SQLiteCursor:
+    def __init__(self, connection: 'SQLiteConnection', dictionary: bool = False):
+        self._connection = connection
+        self._cursor = connection._raw.cursor()
+        self._dictionary = dictionary
+        self._stored = []
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def column_names(self):
+        return tuple(column[0] for column in self._cursor.description or ())
+
+    def _run(self, method, sql: str, params):
+        sql, locks = translate(sql)
+        try:
+            if locks and not self._connection._raw.in_transaction:
+                # SELECT ... FOR UPDATE: take the write lock now, as mysql
+                # would lock the rows
+                self._cursor.execute('BEGIN IMMEDIATE')
+            method(sql, params)
+        except sqlite3.Error as e:
+            raise _map_error(e) from e
+        return None
+
+    def execute(self, operation: str, params=(), multi: bool = False):
+        if multi:
+            raise mysql.connector.errors.NotSupportedError(msg='SQLite runs one statement per execute')
+        return self._run(self._cursor.execute, operation, tuple(params or ()))
+
+    def executemany(self, operation: str, seq_params):
+        return self._run(self._cursor.executemany, operation, [tuple(params) for params in seq_params])
+
+    def callproc(self, procname: str, args=()):
+        try:
+            rows = PROCEDURES[procname](self._cursor, *args)
+        except KeyError:
+            raise mysql.connector.errors.ProgrammingError(msg=f'PROCEDURE {procname} does not exist')
+        except sqlite3.Error as e:
+            raise _map_error(e) from e
+        self._stored = [_StoredResult(rows)]
+        return args
+
+    def stored_results(self):
+        stored, self._stored = self._stored, []
+        return iter(stored)
+
+    def _convert(self, row):
+        if row is None:
+            return None
+        names = self.column_names
+        if any(name in TIMESTAMP_COLUMNS and isinstance(value, str) for name, value in zip(names, row)):
+            row = tuple(datetime.fromisoformat(value) if name in TIMESTAMP_COLUMNS and isinstance(value, str)
+                        else value for name, value in zip(names, row))
+        return dict(zip(names, row)) if self._dictionary else row
+
+    def fetchone(self):
+        try:
+            return self._convert(self._cursor.fetchone())
+        except sqlite3.Error as e:
+            raise _map_error(e) from e
+
+    def fetchall(self):
+        try:
+            return [self._convert(row) for row in self._cursor.fetchall()]
+        except sqlite3.Error as e:
+            raise _map_error(e) from e
+
+    def fetchmany(self, size: int = 1):
+        return [self._convert(row) for row in self._cursor.fetchmany(size)]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self._cursor.close()
+
+
+# mysql.connector-style connection over a sqlite3 connection
+class SQLiteConnection:
+    # rows are fetched into memory as they are read, nothing is left unread
+    unread_result = False
+
+    def __init__(self, raw: sqlite3.Connection):
+        self._raw = raw
+
+    def cursor(self, dictionary: bool = False, buffered: bool = None) -> SQLiteCursor:
+        return SQLiteCursor(self, dictionary)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._raw.in_transaction
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def consume_results(self):
+        pass
+
+    def ping(self, reconnect: bool = False):
+        try:
+            self._raw.execute('SELECT 1').fetchone()
+        except sqlite3.Error as e:
+            raise _map_error(e) from e
+
+    def is_connected(self) -> bool:
+        try:
+            self.ping()
+            return True
+        except mysql.connector.errors.Error:
+            return False
+
+    def close(self):
+        self._raw.close()
+
+
+class SQLiteBackend:
+    name = 'sqlite'
+    supports_multi_statements = False
+
+    # read_only opens the file for reading only, e.g. as a read replica
+    # of a backend on the same path
+    def __init__(self, path: str = 'pinkbird.db', pragmas: Dict = None, schema: str = SQLITE_SCHEMA,
+                 read_only: bool = False):
+        self.path = path
+        self.pragmas = dict(SQLITE_PRAGMAS, **(pragmas or {}))
+        self.schema = schema
+        self.read_only = read_only
+        self._schema_checked = read_only
+        self._lock = threading.Lock()
+
+    @property
+    def label(self) -> str:
+        return self.path + (' (read-only)' if self.read_only else '')
+
+    def connect(self) -> SQLiteConnection:
+        raw = sqlite3.connect(
+            f'file:{self.path}?mode=ro' if self.read_only else self.path,
+            uri=self.read_only,
+            timeout=self.pragmas['busy_timeout'] / 1000,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # pooled connections move between threads, one at a time
+            check_same_thread=False,
+            # writes open their transaction with the write lock held, so two
+            # writers queue on busy_timeout instead of failing to upgrade
+            isolation_level='IMMEDIATE',
+        )
+        for pragma, value in self.pragmas.items():
+            if self.read_only and pragma in ('journal_mode', 'wal_autocheckpoint'):
+                continue  # set by the writer, the file keeps them
+            raw.execute(f'PRAGMA {pragma} = {value}')
+        raw.create_function('UNIX_TIMESTAMP', -1, _unix_timestamp)
+        raw.create_function('FLOOR', 1, _floor, deterministic=True)
+        if not self._schema_checked:
+            self._ensure_schema(raw)
+        return SQLiteConnection(raw)
+
+    # readers of a WAL file see every commit as soon as it is made
+    def replication_lag(self, conn) -> Optional[float]:
+        return 0.0
+
+    # create the tables when the file is new or empty
+    def _ensure_schema(self, raw: sqlite3.Connection):
+        with self._lock:
+            if self._schema_checked:
+                return
+            exists = raw.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post'").fetchone()
+            if not exists and self.schema:
+                with open(self.schema) as f:
+                    raw.executescript(f.read())
+            self._schema_checked = True
+
+
+BACKENDS = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+}
+
+# backend by name, e.g. create('sqlite', path='pinkbird.db')
+def create(name: str, **settings):
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown backend {name!r}, expected one of {", ".join(sorted(BACKENDS))}')
+    return cls(**settings)
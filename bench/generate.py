@@ -0,0 +1,346 @@
+import argparse
+import hashlib
+import itertools
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Sequence
+
+import mysql.connector
+
+import db
+import migrate
+
+# synthetic pinkbird datasets for benchmarking
+#
+# builds a fresh database from setup.sql (schema only) and fills it with
+# users, a power-law follow graph, posts with replies and hashtags, and
+# skewed likes - a few accounts and posts get most of the attention, like
+# on the real thing. rows are bulk-loaded with multi-row INSERTs or
+# LOAD DATA LOCAL INFILE; counters, timelines and the user search index
+# are then derived with the same db.py functions the app uses.
+# with --engine sqlite the dataset is a file under bench/data/ built from
+# setup_sqlite.sql instead, with the same rows for the same seed.
+#
+#   python -m bench.generate --size small
+#   python -m bench.generate --size small --engine sqlite
+#   python -m bench.generate --users 50000 --posts 2000000 --database pinkbird_custom
+
+SETUP_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'setup.sql')
+
+# where sqlite datasets are written
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+ENGINES = ('mysql', 'sqlite')
+
+# preset sizes, see --size
+SIZES = {
+    'tiny':   {'users': 200,       'posts': 2_000,      'follows': 20,  'likes': 5},
+    'small':  {'users': 5_000,     'posts': 100_000,    'follows': 50,  'likes': 10},
+    'medium': {'users': 50_000,    'posts': 1_000_000,  'follows': 100, 'likes': 15},
+    'large':  {'users': 500_000,   'posts': 5_000_000,  'follows': 150, 'likes': 20},
+    'xl':     {'users': 1_000_000, 'posts': 10_000_000, 'follows': 200, 'likes': 20},
+}
+
+# every bench user logs in with this password
+PASSWORD = 'password'
+
+# skew of the zipf-like distributions, higher = more concentrated
+POPULARITY_SKEW = 1.1   # who gets followed and liked
+ACTIVITY_SKEW = 0.8     # who posts
+HASHTAG_SKEW = 1.2      # which hashtags get used
+
+VOCABULARY_SIZE = 5000
+HASHTAG_COUNT = 2000
+REPLY_FRACTION = 0.25
+DAYS = 90
+
+# rows per INSERT statement
+CHUNK_ROWS = 5000
+
+# likes drawn per batch of random picks
+LIKE_BATCH = 100_000
+
+
+# mysql database name, or sqlite file path
+def database_name(size: str, engine: str = 'mysql') -> str:
+    if engine == 'sqlite':
+        return os.path.join(DATA_DIR, f'pinkbird_bench_{size}.db')
+    return f'pinkbird_bench_{size}'
+
+
+# schema statements from setup.sql, without the sample data and the
+# client-only CREATE DATABASE / USE lines
+def schema_statements(path: str = SETUP_SQL) -> List[str]:
+    with open(path) as f:
+        schema = f.read().split('-- Sample Data')[0]
+    return [statement for statement in migrate.split_statements(schema)
+            if not statement.upper().startswith(('CREATE DATABASE', 'USE '))]
+
+
+def create_database(name: str, engine: str = 'mysql'):
+    if engine == 'sqlite':
+        # the backend creates the schema in the empty file on first connect
+        os.makedirs(os.path.dirname(os.path.abspath(name)), exist_ok=True)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+        return
+    config = {key: value for key, value in db.DB_CONFIG.items() if key != 'database'}
+    conn = mysql.connector.connect(**config)
+    cursor = conn.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS `{name}`')
+    cursor.execute(f'CREATE DATABASE `{name}`')
+    cursor.execute(f'USE `{name}`')
+    for statement in schema_statements():
+        cursor.execute(statement)
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+# point db.py (and its pool) at another database
+def use_database(name: str, engine: str = 'mysql'):
+    if engine == 'sqlite':
+        db.configure_backend('sqlite', path=name)
+    else:
+        db.DB_CONFIG['database'] = name
+        db.configure_backend('mysql')
+    db.configure_cache(db.LRUCache(db.CACHE_SIZE, db.CACHE_TTL))
+
+
+# cumulative weights for zipf-like picks from `n` items, item 0 the most likely
+def zipf_weights(n: int, skew: float) -> List[float]:
+    return list(itertools.accumulate(1.0 / (rank + 1) ** skew for rank in range(n)))
+
+
+# buffers rows per table and writes them in bulk
+class BulkLoader:
+    def __init__(self, conn, method: str = 'insert', chunk_rows: int = CHUNK_ROWS):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.method = method
+        self.chunk_rows = chunk_rows
+        self.columns = {}   # table -> column names
+        self.rows = {}      # table -> buffered rows (insert)
+        self.files = {}     # table -> tsv file (load-data)
+        self.ignore = set() # tables where duplicate rows are skipped
+        self.counts = {}
+        self.sqlite = db.get_backend().name == 'sqlite'
+        self._set_checks(False)
+
+    # key checks are off while loading, the generated rows are consistent
+    def _set_checks(self, on: bool):
+        if self.sqlite:
+            self.cursor.execute(f'PRAGMA foreign_keys = {"ON" if on else "OFF"}')
+        else:
+            self.cursor.execute(f'SET unique_checks = {int(on)}, foreign_key_checks = {int(on)}')
+
+    # `ignore` skips rows whose key is already loaded instead of failing
+    def add(self, table: str, columns: Sequence[str], row: Sequence, ignore: bool = False):
+        if table not in self.columns:
+            self.columns[table] = tuple(columns)
+            self.rows[table] = []
+            self.counts[table] = 0
+            if ignore:
+                self.ignore.add(table)
+            if self.method == 'load-data':
+                self.files[table] = tempfile.NamedTemporaryFile('w', suffix=f'.{table}.tsv', delete=False)
+        self.counts[table] += 1
+        if self.method == 'load-data':
+            self.files[table].write('\t'.join(_tsv_field(value) for value in row) + '\n')
+            return
+        buffered = self.rows[table]
+        buffered.append(row)
+        if len(buffered) >= self.chunk_rows:
+            self._insert(table)
+
+    def _insert(self, table: str):
+        rows = self.rows[table]
+        if not rows:
+            return
+        columns = self.columns[table]
+        placeholders = '(' + ', '.join(['%s'] * len(columns)) + ')'
+        ignore = 'IGNORE ' if table in self.ignore else ''
+        self.cursor.execute(
+            f'INSERT {ignore}INTO `{table}` ({", ".join(columns)}) VALUES {", ".join([placeholders] * len(rows))}',
+            tuple(value for row in rows for value in row)
+        )
+        self.conn.commit()
+        rows.clear()
+
+    def close(self) -> Dict[str, int]:
+        for table in self.columns:
+            if self.method == 'load-data':
+                f = self.files[table]
+                f.close()
+                ignore = 'IGNORE ' if table in self.ignore else ''
+                self.cursor.execute(
+                    f'''LOAD DATA LOCAL INFILE %s {ignore}INTO TABLE `{table}`
+                        FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'
+                        LINES TERMINATED BY '\\n' ({", ".join(self.columns[table])})''',
+                    (f.name,)
+                )
+                self.conn.commit()
+                os.remove(f.name)
+            else:
+                self._insert(table)
+        self._set_checks(True)
+        self.cursor.close()
+        return dict(self.counts)
+
+
+# a value in LOAD DATA's default tab-separated format
+def _tsv_field(value) -> str:
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+# deterministic pseudo-words, so FULLTEXT search has something to match
+def make_vocabulary(rng: random.Random, size: int) -> List[str]:
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'pe', 'da', 'zu', 'bi', 'go', 'fa', 'ch', 'sh']
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate(users: int, posts: int, follows: int, likes: int, seed: int = 42,
+             method: str = 'insert', timelines: bool = True, log=print) -> Dict[str, int]:
+    rng = random.Random(seed)
+    conn = db.get_conn()
+    loader = BulkLoader(conn, method)
+    started = time.monotonic()
+
+    user_ids = [f'bench-{index:08d}' for index in range(users)]
+    password_hash = hashlib.sha256(PASSWORD.encode()).hexdigest()
+    for index, user_id in enumerate(user_ids):
+        loader.add('user', ('user_id', 'username', 'email', 'bio'),
+                   (user_id, f'user{index}', f'user{index}@bench.pinkbird', f'bench user {index}'))
+        loader.add('user_auth', ('user_id', 'password_hash'), (user_id, password_hash))
+    log(f'users: {users} ({time.monotonic() - started:.1f}s)')
+
+    # popularity rank and activity rank are independent shuffles of the users
+    popular = user_ids[:]
+    rng.shuffle(popular)
+    popularity = zipf_weights(users, POPULARITY_SKEW)
+    active = user_ids[:]
+    rng.shuffle(active)
+    activity = zipf_weights(users, ACTIVITY_SKEW)
+
+    # follow graph: out-degrees are pareto distributed around `follows`,
+    # targets are picked by popularity
+    edges = 0
+    for user_id in user_ids:
+        degree = min(users - 1, int(rng.paretovariate(1.5) * follows / 3))
+        targets = set(rng.choices(popular, cum_weights=popularity, k=degree))
+        targets.discard(user_id)
+        for target in targets:
+            loader.add('follows', ('follower_id', 'following_id'), (user_id, target))
+        edges += len(targets)
+    log(f'follows: {edges} ({time.monotonic() - started:.1f}s)')
+
+    vocabulary = make_vocabulary(rng, VOCABULARY_SIZE)
+    vocabulary_weights = zipf_weights(len(vocabulary), 1.0)
+    hashtags = [f'{rng.choice(vocabulary)}{rng.choice(vocabulary)}' for _ in range(HASHTAG_COUNT)]
+    hashtags = list(dict.fromkeys(tag.lower() for tag in hashtags))
+    hashtag_weights = zipf_weights(len(hashtags), HASHTAG_SKEW)
+    for hashtag_id, name in enumerate(hashtags, 1):
+        loader.add('hashtag', ('hashtag_id', 'name'), (hashtag_id, name))
+
+    # posts are spread evenly over the last DAYS days, in id order so that
+    # a reply always comes after its parent
+    start = datetime.now() - timedelta(days=DAYS)
+    step = DAYS * 86400 / max(posts, 1)
+    authors = rng.choices(active, cum_weights=activity, k=posts)
+    replies = 0
+    for post_id in range(1, posts + 1):
+        words = rng.choices(vocabulary, cum_weights=vocabulary_weights, k=rng.randint(5, 25))
+        tags = set(rng.choices(range(len(hashtags)), cum_weights=hashtag_weights, k=rng.choice((0, 0, 1, 1, 2, 3))))
+        content = ' '.join(words + [f'#{hashtags[tag]}' for tag in tags])
+        thread_id = None
+        if post_id > 1 and rng.random() < REPLY_FRACTION:
+            # replies go mostly to recent posts
+            thread_id = max(1, post_id - 1 - int(rng.expovariate(1 / 200)))
+            loader.add('replies', ('post_id', 'reply_id'), (thread_id, post_id))
+            replies += 1
+        created_at = start + timedelta(seconds=(post_id - 1) * step + rng.random() * step)
+        loader.add('post', ('post_id', 'user_id', 'content', 'created_at', 'thread_id'),
+                   (post_id, authors[post_id - 1], content, created_at.strftime('%Y-%m-%d %H:%M:%S'), thread_id))
+        for tag in tags:
+            loader.add('contains', ('post_id', 'hashtag_id'), (post_id, tag + 1))
+    log(f'posts: {posts}, replies: {replies} ({time.monotonic() - started:.1f}s)')
+
+    # likes: posts of popular authors and a long tail of everything else
+    author_rank = {user_id: rank for rank, user_id in enumerate(popular)}
+    post_weights = list(itertools.accumulate(1.0 / (author_rank[author] + 1) ** POPULARITY_SKEW + 0.001
+                                             for author in authors))
+    remaining = posts * likes
+    while remaining > 0:
+        batch = min(remaining, LIKE_BATCH)
+        remaining -= batch
+        post_indexes = rng.choices(range(posts), cum_weights=post_weights, k=batch)
+        likers = rng.choices(active, cum_weights=activity, k=batch)
+        for liker, post_index in zip(likers, post_indexes):
+            # repeated picks of the same pair are dropped by the load
+            loader.add('likes', ('user_id', 'post_id'), (liker, post_index + 1), ignore=True)
+    counts = loader.close()
+    conn.close()
+    log(f'likes: up to {counts.get("likes", 0)} ({time.monotonic() - started:.1f}s)')
+
+    # derived data, through the app's own maintenance paths
+    db.reconcile_post_counters(chunk_size=10000)
+    db.reconcile_follow_counters(chunk_size=10000)
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE user SET fanout_on_read = follower_count > %s', (db.FANOUT_LIMIT,))
+        conn.commit()
+        cursor.close()
+    db.rebuild_user_trigrams()
+    log(f'counters and search index ({time.monotonic() - started:.1f}s)')
+    if timelines:
+        for index, user_id in enumerate(user_ids, 1):
+            db.rebuild_timeline(user_id)
+            if index % 10000 == 0:
+                log(f'timelines: {index}/{users} ({time.monotonic() - started:.1f}s)')
+    log(f'done ({time.monotonic() - started:.1f}s)')
+    return counts
+
+
+def main(argv: Iterable[str] = None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic pinkbird dataset.')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--posts', type=int)
+    parser.add_argument('--follows', type=int, help='average accounts each user follows')
+    parser.add_argument('--likes', type=int, help='average likes per post')
+    parser.add_argument('--engine', choices=ENGINES, default='mysql')
+    parser.add_argument('--database', help='defaults to pinkbird_bench_<size> (a file in bench/data/ for sqlite)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--load-data', action='store_true',
+                        help='bulk-load with LOAD DATA LOCAL INFILE (server needs local_infile=1)')
+    parser.add_argument('--no-timelines', action='store_true', help='skip filling home timelines')
+    args = parser.parse_args(argv)
+
+    settings = dict(SIZES[args.size])
+    for key in ('users', 'posts', 'follows', 'likes'):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    name = args.database or database_name(args.size, args.engine)
+    if args.load_data:
+        if args.engine != 'mysql':
+            parser.error('--load-data needs --engine mysql')
+        db.DB_CONFIG['allow_local_infile'] = True
+
+    print(f'creating {name}: {settings}')
+    create_database(name, args.engine)
+    use_database(name, args.engine)
+    generate(seed=args.seed, method='load-data' if args.load_data else 'insert',
+             timelines=not args.no_timelines, **settings)
+
+
+if __name__ == '__main__':
+    main()
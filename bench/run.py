@@ -0,0 +1,334 @@
+import argparse
+import json
+import math
+import os
+import subprocess
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+import db
+import instrumentation
+from bench import generate
+
+# micro-benchmarks for every public db.py function
+#
+# each case times one db.py call against a generated dataset (see
+# bench/generate.py) and reports p50/p95/p99 latency plus the number of
+# statements the server ran per call. results are written as JSON under
+# bench/results/ so later runs can be compared with --compare.
+#
+#   python -m bench.generate --size small
+#   python -m bench.run --sizes small
+#   python -m bench.run --sizes small --compare bench/results/<earlier run>.json
+#   python -m bench.run --sizes small --engine sqlite --compare <mysql run>.json
+#
+# query counts are the statements db.py sent, as counted by
+# instrumentation.py - a stored procedure call counts as one
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# timed calls per case, maintenance jobs are slow and run fewer times
+ITERATIONS = 50
+MAINTENANCE_ITERATIONS = 3
+
+# public db.py functions that are configuration or plumbing, not queries
+NOT_BENCHMARKED = {
+    'get_pool', 'configure_pool', 'pool_stats', 'run_concurrently', 'get_conn',
+    'configure_cache', 'cache_stats', 'post_versions', 'user_cache_stats', 'invalidate_user',
+    'configure_write_behind', 'flush_writes', 'on_posts_changed',
+    'get_backend', 'configure_backend', 'get_read_conn', 'configure_replicas', 'replica_stats',
+    'begin_routing', 'end_routing', 'sticky_until',
+}
+
+
+class Case:
+    def __init__(self, name: str, call: Callable[[Dict, int], object],
+                 setup: Callable[[Dict, int], object] = None, iterations: int = ITERATIONS):
+        self.name = name
+        self.call = call
+        self.setup = setup  # runs untimed before each call
+        self.iterations = iterations
+
+
+# ids and values the cases run with, picked from the dataset so that the
+# heavy and the typical shapes both get measured
+def sample_context() -> Dict:
+    conn = db.get_conn()
+    cursor = conn.cursor(dictionary=True)
+
+    def one(sql, params=()):
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+    users = one('SELECT COUNT(*) AS n FROM user')['n']
+    celebrity = one('SELECT user_id, username FROM user ORDER BY follower_count DESC LIMIT 1')
+    typical = one('SELECT user_id, username FROM user ORDER BY follower_count LIMIT 1 OFFSET %s', (users // 2,))
+    busy_reader = one('SELECT user_id FROM user ORDER BY following_count DESC LIMIT 1')
+    hot_post = one('SELECT post_id, content FROM post ORDER BY like_count DESC LIMIT 1')
+    thread = one('SELECT post_id FROM post ORDER BY reply_count DESC LIMIT 1')
+    hashtag = one('''SELECT h.name FROM hashtag h JOIN contains c ON c.hashtag_id = h.hashtag_id
+                     GROUP BY h.hashtag_id ORDER BY COUNT(*) DESC LIMIT 1''')
+    latest = one('SELECT post_id FROM post ORDER BY post_id DESC LIMIT 1')
+    cursor.close()
+    conn.close()
+
+    words = [word for word in hot_post['content'].split() if not word.startswith('#')]
+    return {
+        'celebrity': celebrity,
+        'typical': typical,
+        'reader_id': busy_reader['user_id'],
+        'hot_post_id': hot_post['post_id'],
+        'thread_id': thread['post_id'],
+        'latest_post_id': latest['post_id'],
+        'hashtag': hashtag['name'] if hashtag else 'none',
+        'search_words': ' '.join(words[:2]) or 'kalo',
+        'run_id': int(time.time()),
+    }
+
+
+def _page_two(fetch: Callable[[Optional[str]], List[Dict]]) -> List[Dict]:
+    return fetch(db.next_page_cursor(fetch(None), db.PAGE_SIZE))
+
+
+def cases() -> List[Case]:
+    return [
+        # users
+        Case('create_user', lambda ctx, i: db.create_user(
+            f"b{ctx['run_id']}x{i}", f"b{ctx['run_id']}x{i}@bench.pinkbird", 'password')),
+        Case('authenticate_user', lambda ctx, i: db.authenticate_user(ctx['typical']['username'], generate.PASSWORD)),
+        Case('get_user', lambda ctx, i: db.get_user(ctx['typical']['user_id'])),
+        Case('get_user_by_username', lambda ctx, i: db.get_user_by_username(ctx['typical']['username'])),
+        Case('update_profile', lambda ctx, i: db.update_profile(ctx['typical']['user_id'], f'bio {i}', None)),
+
+        # cursors and parsing, no queries
+        Case('encode_cursor', lambda ctx, i: db.encode_cursor(datetime.now(), i)),
+        Case('decode_cursor', lambda ctx, i: db.decode_cursor(db.encode_cursor(datetime.now(), i))),
+        Case('next_page_cursor', lambda ctx, i: db.next_page_cursor(
+            [{'id': 1, 'created_at': datetime.now()}] * db.PAGE_SIZE, db.PAGE_SIZE)),
+        Case('extract_hashtags', lambda ctx, i: db.extract_hashtags('a #Coffee and #coffee #tea_time post')),
+
+        # timelines
+        Case('get_all_tweets', lambda ctx, i: db.get_all_tweets()),
+        Case('get_all_tweets (page 2)', lambda ctx, i: _page_two(lambda before: db.get_all_tweets(before=before))),
+        Case('get_feed_tweets', lambda ctx, i: db.get_feed_tweets(ctx['reader_id'])),
+        Case('get_feed_tweets (typical)', lambda ctx, i: db.get_feed_tweets(ctx['typical']['user_id'])),
+        Case('get_user_tweets', lambda ctx, i: db.get_user_tweets(ctx['celebrity']['user_id'])),
+        Case('get_timeline_stamps', lambda ctx, i: db.get_timeline_stamps('explore', viewer_id=ctx['reader_id'])),
+        Case('get_timeline_stamps (feed)', lambda ctx, i: db.get_timeline_stamps(
+            'feed', ctx['reader_id'], ctx['reader_id'])),
+        Case('get_profile', lambda ctx, i: db.get_profile(ctx['celebrity']['username'], ctx['typical']['user_id'])),
+        Case('rebuild_timeline', lambda ctx, i: db.rebuild_timeline(ctx['reader_id']),
+             iterations=MAINTENANCE_ITERATIONS),
+
+        # tweets and threads
+        Case('get_tweet', lambda ctx, i: db.get_tweet(ctx['hot_post_id'])),
+        Case('get_tweets', lambda ctx, i: db.get_tweets(
+            list(range(max(1, ctx['latest_post_id'] - 50), ctx['latest_post_id'] + 1)))),
+        Case('get_tweet_replies', lambda ctx, i: db.get_tweet_replies(ctx['thread_id'])),
+        Case('get_conversation', lambda ctx, i: db.get_conversation(ctx['thread_id'])),
+        Case('get_conversation (page 2)', lambda ctx, i: db.get_conversation(
+            ctx['thread_id'], after=db.get_conversation(ctx['thread_id'])['next_cursor'])),
+        Case('get_thread', lambda ctx, i: db.get_thread(ctx['thread_id'])),
+        Case('publish_tweet', lambda ctx, i: db.publish_tweet(
+            ctx['celebrity']['user_id'], f"bench post {i} #{ctx['hashtag']}", None)),
+        Case('publish_tweet (reply)', lambda ctx, i: db.publish_tweet(
+            ctx['typical']['user_id'], f'bench reply {i}', ctx['thread_id'])),
+
+        # hashtags and search
+        Case('get_trending_hashtags', lambda ctx, i: db.get_trending_hashtags('24h')),
+        Case('rebuild_trending', lambda ctx, i: db.rebuild_trending(), iterations=MAINTENANCE_ITERATIONS),
+        Case('search_tweets_by_hashtag', lambda ctx, i: db.search_tweets_by_hashtag(ctx['hashtag'])),
+        Case('search_tweets_by_content', lambda ctx, i: db.search_tweets_by_content(ctx['search_words'])),
+        Case('search_tweets_by_content (recent)', lambda ctx, i: db.search_tweets_by_content(
+            ctx['search_words'], sort='recent')),
+        Case('search_tweets_by_content (short)', lambda ctx, i: db.search_tweets_by_content('ka')),
+        Case('search_users', lambda ctx, i: db.search_users('user12')),
+        Case('search_users (substring)', lambda ctx, i: db.search_users('ser99')),
+        Case('rebuild_user_trigrams', lambda ctx, i: db.rebuild_user_trigrams(), iterations=1),
+
+        # follows and likes - setup puts the pair in the opposite state first
+        Case('follow_user', lambda ctx, i: db.follow_user(ctx['typical']['user_id'], ctx['celebrity']['user_id']),
+             setup=lambda ctx, i: db.unfollow_user(ctx['typical']['user_id'], ctx['celebrity']['user_id'])),
+        Case('unfollow_user', lambda ctx, i: db.unfollow_user(ctx['typical']['user_id'], ctx['celebrity']['user_id']),
+             setup=lambda ctx, i: db.follow_user(ctx['typical']['user_id'], ctx['celebrity']['user_id'])),
+        Case('like_post', lambda ctx, i: db.like_post(ctx['typical']['user_id'], ctx['hot_post_id']),
+             setup=lambda ctx, i: db.unlike_post(ctx['typical']['user_id'], ctx['hot_post_id'])),
+        Case('unlike_post', lambda ctx, i: db.unlike_post(ctx['typical']['user_id'], ctx['hot_post_id']),
+             setup=lambda ctx, i: db.like_post(ctx['typical']['user_id'], ctx['hot_post_id'])),
+        Case('is_post_liked', lambda ctx, i: db.is_post_liked(ctx['typical']['user_id'], ctx['hot_post_id'])),
+        Case('get_liked_post_ids', lambda ctx, i: db.get_liked_post_ids(
+            ctx['typical']['user_id'], list(range(max(1, ctx['latest_post_id'] - 50), ctx['latest_post_id'] + 1)))),
+        Case('get_followers', lambda ctx, i: db.get_followers(ctx['celebrity']['user_id'])),
+        Case('get_following', lambda ctx, i: db.get_following(ctx['reader_id'])),
+        Case('get_follower_count', lambda ctx, i: db.get_follower_count(ctx['celebrity']['user_id'])),
+        Case('get_follow_counts', lambda ctx, i: db.get_follow_counts(
+            ctx['celebrity']['user_id'], ctx['typical']['user_id'])),
+        Case('get_following_count', lambda ctx, i: db.get_following_count(ctx['reader_id'])),
+        Case('is_following', lambda ctx, i: db.is_following(ctx['typical']['user_id'], ctx['celebrity']['user_id'])),
+        Case('get_followed_user_ids', lambda ctx, i: db.get_followed_user_ids(
+            ctx['reader_id'], [f'bench-{n:08d}' for n in range(100)])),
+        Case('reconcile_post_counters', lambda ctx, i: db.reconcile_post_counters(10000), iterations=1),
+        Case('reconcile_follow_counters', lambda ctx, i: db.reconcile_follow_counters(10000), iterations=1),
+
+        # media
+        Case('add_media_to_post', lambda ctx, i: db.add_media_to_post(
+            ctx['latest_post_id'], f'uploads/bench-{i}.jpg', 'image')),
+        Case('save_media_variants', lambda ctx, i: db.save_media_variants(
+            'bench', [{'variant': 'thumb', 'file_url': 'uploads/bench_thumb.jpg', 'width': 320, 'height': 240}])),
+        Case('get_media_without_variants', lambda ctx, i: db.get_media_without_variants()),
+        Case('get_media_for_post', lambda ctx, i: db.get_media_for_post(ctx['hot_post_id'])),
+    ]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# time one case, `warm` keeps the object caches between calls. calls
+# that raise are counted in `errors` and left out of the timings; the
+# first one's traceback is logged and kept in `error`
+def run_case(case: Case, ctx: Dict, warm: bool = False, iterations: int = None, log=print) -> Dict:
+    iterations = min(case.iterations, iterations or case.iterations)
+    timings, queries, errors, error = [], [], 0, None
+    for i in range(iterations):
+        if case.setup:
+            case.setup(ctx, i)
+        if not warm:
+            db.configure_cache(db.LRUCache(db.CACHE_SIZE, db.CACHE_TTL))
+        token = instrumentation.start(case.name)
+        started = time.perf_counter()
+        try:
+            case.call(ctx, i)
+        except Exception:
+            instrumentation.stop(token)
+            errors += 1
+            if error is None:
+                error = traceback.format_exc()
+                log(f'{case.name} failed:\n{error}')
+            continue
+        elapsed = time.perf_counter() - started
+        queries.append(instrumentation.current().queries)
+        instrumentation.stop(token)
+        timings.append(elapsed * 1000)
+    timings.sort()
+    result = {'iterations': iterations, 'errors': errors}
+    if error is not None:
+        result['error'] = error
+    if not timings:
+        return result
+    return {
+        **result,
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'max_ms': round(timings[-1], 3),
+        'queries': round(sum(queries) / len(queries), 2),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size: str, database: str, warm: bool = False, only: Iterable[str] = None,
+        iterations: int = None, engine: str = 'mysql', log=print) -> Dict:
+    generate.use_database(database, engine)
+    ctx = sample_context()
+    selected = [case for case in cases() if not only or case.name.split(' ')[0] in only]
+
+    covered = {case.name.split(' ')[0] for case in cases()} | NOT_BENCHMARKED
+    public = {name for name, value in vars(db).items()
+              if callable(value) and not name.startswith('_')
+              and getattr(value, '__module__', None) == db.__name__ and not isinstance(value, type)}
+    missing = sorted(public - covered)
+    if missing:
+        log(f'no benchmark case for: {", ".join(missing)}')
+
+    results = {}
+    for case in selected:
+        results[case.name] = run_case(case, ctx, warm, iterations, log)
+        r = results[case.name]
+        if 'p50_ms' not in r:
+            log(f"{engine:>6} {size:>7} {case.name:<36} every call failed")
+            continue
+        log(f"{engine:>6} {size:>7} {case.name:<36} p50 {r['p50_ms']:>9.2f}  p95 {r['p95_ms']:>9.2f}  "
+            f"p99 {r['p99_ms']:>9.2f} ms  {r['queries']:>6} q{'  errors: %d' % r['errors'] if r['errors'] else ''}")
+    return {
+        'size': size,
+        'engine': engine,
+        'database': database,
+        'warm_cache': warm,
+        'commit': _git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'results': results,
+    }
+
+
+def save(report: Dict, directory: str = RESULTS_DIR) -> str:
+    os.makedirs(directory, exist_ok=True)
+    stamp = report['started_at'].replace(':', '').replace('-', '').replace('+0000', 'Z')
+    engine = report.get('engine', 'mysql')
+    path = os.path.join(directory, f"{stamp}-{engine}-{report['size']}-{report['commit'] or 'nogit'}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return path
+
+
+# p50/p95 of two runs side by side, e.g. two commits or two engines
+def compare(baseline: Dict, current: Dict, log=print):
+    log(f"\n{current['size']}: {baseline.get('engine', 'mysql')}@{baseline.get('commit')} -> "
+        f"{current.get('engine', 'mysql')}@{current.get('commit')}")
+    for name, now in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None or before.get('errors') or now['errors']:
+            continue
+        change = (now['p50_ms'] / before['p50_ms'] - 1) * 100 if before['p50_ms'] else 0.0
+        log(f"{name:<36} p50 {before['p50_ms']:>9.2f} -> {now['p50_ms']:>9.2f} ms ({change:+6.1f}%)  "
+            f"p95 {before['p95_ms']:>9.2f} -> {now['p95_ms']:>9.2f}  "
+            f"queries {before['queries']} -> {now['queries']}")
+
+
+def main(argv: Iterable[str] = None):
+    parser = argparse.ArgumentParser(description='Benchmark db.py against generated datasets.')
+    parser.add_argument('--sizes', default='small', help='comma-separated, see bench.generate --size')
+    parser.add_argument('--engine', choices=generate.ENGINES, default='mysql')
+    parser.add_argument('--generate', action='store_true', help='(re)generate each dataset first')
+    parser.add_argument('--warm', action='store_true', help='keep object caches warm between calls')
+    parser.add_argument('--only', help='comma-separated db.py function names')
+    parser.add_argument('--iterations', type=int, help=f'cap on timed calls per case (default {ITERATIONS})')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    only = set(args.only.split(',')) if args.only else None
+    failed = []
+    for size in args.sizes.split(','):
+        database = generate.database_name(size, args.engine)
+        if args.generate:
+            generate.main(['--size', size, '--engine', args.engine, '--database', database])
+        report = run(size, database, warm=args.warm, only=only, iterations=args.iterations, engine=args.engine)
+        print(f'saved {save(report)}')
+        if baseline and baseline['size'] == size:
+            compare(baseline, report)
+        failed += [f'{size}/{name}' for name, result in report['results'].items() if result['errors']]
+    # a case with errors timed something other than the query, don't let
+    # its numbers pass for a clean run
+    if failed:
+        raise SystemExit(f'errors in: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
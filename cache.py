@@ -0,0 +1,296 @@
+import copy
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, List
+
+# caches for hot database rows
+#
+# a backend stores values by string key (LRUCache in this process,
+# SQLiteCache in a file shared by every worker on the host - a stand-in
+# for memcached/redis). ObjectCache sits on top of a backend and adds
+# per-key versions so writes can invalidate entries safely.
+
+_MISSING = object()
+
+
+# interface every cache backend implements - override the *_many
+# methods when the store can answer them in one round trip
+class CacheBackend:
+    # True when get() hands back the stored object itself rather than a copy
+    shares_objects = False
+
+    def get(self, key: Hashable, default=None):
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value, ttl: float = None):
+        raise NotImplementedError
+
+    def delete(self, key: Hashable):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict:
+        found = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set_many(self, mapping: Dict, ttl: float = None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def stats(self) -> Dict:
+        return {}
+
+
+# bounded cache that evicts the least recently used entry when full
+# and treats entries older than `ttl` seconds as missing
+class LRUCache(CacheBackend):
+    shares_objects = True
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key: Hashable, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self._stats['misses'] += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key: Hashable, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+            stats['maxsize'] = self.maxsize
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+# key-value cache in a local SQLite file, shared by all processes on the
+# host so one worker's invalidation is seen by the others
+class SQLiteCache(CacheBackend):
+    def __init__(self, path: str, ttl: float = 60.0):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires_at REAL)'
+        )
+        conn.commit()
+
+    # one connection per thread and process
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: Hashable, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict:
+        keys = list(keys)
+        if not keys:
+            return {}
+        placeholders = ', '.join(['?'] * len(keys))
+        rows = self._conn().execute(
+            f'SELECT key, value FROM cache WHERE key IN ({placeholders}) AND expires_at > ?',
+            (*[str(key) for key in keys], time.time())
+        ).fetchall()
+        by_name = {str(key): key for key in keys}
+        return {by_name[name]: pickle.loads(value) for name, value in rows}
+
+    def set(self, key: Hashable, value, ttl: float = None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping: Dict, ttl: float = None):
+        if not mapping:
+            return
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        conn = self._conn()
+        conn.executemany(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            [(str(key), pickle.dumps(value), expires_at) for key, value in mapping.items()]
+        )
+        conn.commit()
+
+    def delete(self, key: Hashable):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache WHERE key = ?', (str(key),))
+        conn.commit()
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache')
+        conn.commit()
+
+    # drop expired entries, call from a periodic job
+    def purge(self):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+        conn.commit()
+
+
+# read-through cache for one kind of object (tweets, users, ...)
+#
+# every key has a version token stored next to it in the backend, and
+# values are stored under "<key>@<version>". invalidate() swaps the token,
+# so a reader that loaded old data before a write can only ever store it
+# under the old token, which nobody reads again
+class ObjectCache:
+    def __init__(self, backend: CacheBackend, namespace: str, ttl: float = 60.0):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _version_key(self, key) -> str:
+        return f'{self.namespace}:{key}#v'
+
+    def _value_key(self, key, version: str) -> str:
+        return f'{self.namespace}:{key}@{version}'
+
+    # current version token of each key, creating tokens for new keys
+    def _versions(self, keys: List) -> Dict:
+        found = self.backend.get_many([self._version_key(key) for key in keys])
+        versions, created = {}, {}
+        for key in keys:
+            version = found.get(self._version_key(key))
+            if version is None:
+                version = created[self._version_key(key)] = uuid.uuid4().hex
+            versions[key] = version
+        # versions outlive the values they guard
+        self.backend.set_many(created, self.ttl * 4)
+        return versions
+
+    def _copy(self, value):
+        return copy.deepcopy(value) if self.backend.shares_objects else value
+
+    def _count(self, hits: int, misses: int):
+        with self._lock:
+            self._stats['hits'] += hits
+            self._stats['misses'] += misses
+
+    # cached values for the keys that have one, as {key: value}
+    def get_many(self, keys: Iterable) -> Dict:
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        versions = self._versions(keys)
+        stored = self.backend.get_many([self._value_key(key, versions[key]) for key in keys])
+        found = {}
+        for key in keys:
+            value = stored.get(self._value_key(key, versions[key]), _MISSING)
+            if value is not _MISSING:
+                found[key] = self._copy(value)
+        self._count(len(found), len(keys) - len(found))
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    # look keys up, load the misses with one loader call and cache them.
+    # loader takes a list of keys and returns {key: value}; keys it leaves
+    # out are treated as missing and not cached
+    def get_or_load_many(self, keys: Iterable, loader: Callable[[List], Dict]) -> Dict:
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        # read versions before loading, see the class comment
+        versions = self._versions(keys)
+        stored = self.backend.get_many([self._value_key(key, versions[key]) for key in keys])
+        found, missing = {}, []
+        for key in keys:
+            value = stored.get(self._value_key(key, versions[key]), _MISSING)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = self._copy(value)
+        self._count(len(found), len(missing))
+
+        if missing:
+            loaded = loader(missing)
+            self.backend.set_many(
+                {self._value_key(key, versions[key]): self._copy(value) for key, value in loaded.items()},
+                self.ttl
+            )
+            found.update(loaded)
+        return found
+
+    def get_or_load(self, key, loader: Callable[[], object]):
+        def load_one(keys):
+            value = loader()
+            return {} if value is None else {key: value}
+        return self.get_or_load_many([key], load_one).get(key)
+
+    def set(self, key, value):
+        version = self._versions([key])[key]
+        self.backend.set(self._value_key(key, version), self._copy(value), self.ttl)
+
+    # {key: version token}; a key's token changes whenever it is invalidated
+    def versions(self, keys: Iterable) -> Dict:
+        keys = list(dict.fromkeys(keys))
+        return self._versions(keys) if keys else {}
+
+    # make the cached values of these keys unreachable - call after commit
+    def invalidate(self, *keys):
+        if not keys:
+            return
+        self.backend.set_many({self._version_key(key): uuid.uuid4().hex for key in keys}, self.ttl * 4)
+        with self._lock:
+            self._stats['invalidations'] += len(keys)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -1,220 +1,812 @@
 import mysql.connector
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, List, Dict, Optional, Tuple
 import hashlib
+import re
+import base64
+from decimal import Decimal, InvalidOperation
 import uuid
+import os
+import time
+import threading
+import contextvars
+import itertools
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import backends
+import instrumentation
+import media
+import metrics
+import trending
+import writebehind
+from cache import CacheBackend, LRUCache, ObjectCache
+
+# mysql connection settings
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'root',  # replace with your mysql username
+    'password': 'pass',  # replace with your mysql password
+    'database': 'pinkbird',
+}
+
+# connection pool settings - use pool_stats() to size these
+POOL_CONFIG = {
+    'size': 5,            # idle connections kept open between requests
+    'max_overflow': 10,   # extra connections allowed during bursts, closed on return
+    'timeout': 10.0,      # seconds to wait for a free connection before giving up
+    'recycle': 1800,      # reopen connections older than this many seconds (0 = never)
+    'pre_ping': True,     # ping idle connections on checkout, reconnect if dead
+}
+
+# raised when no connection frees up within the checkout timeout
+class PoolTimeout(Exception):
+    pass
+
+# connection handed out by the pool
+# close() returns the underlying connection instead of closing it,
+# cursors are timed (see instrumentation.py) and commits mark the request
+# as a writer (see get_read_conn), everything else is passed through to
+# the backend's connection. use it as a context manager (with get_conn()
+# as conn:) so it goes back even when a query fails; one that is dropped
+# without close() is returned when it is garbage collected
+class PooledConnection:
+    def __init__(self, pool, raw, created_at: float):
+        self._raw = raw
+        self._return = weakref.finalize(self, pool.put, raw, created_at)
+        self._return.atexit = False
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise mysql.connector.errors.OperationalError('Connection already returned to pool')
+        return getattr(self._raw, name)
+
+    def cursor(self, *args, **kwargs):
+        if self._raw is None:
+            raise mysql.connector.errors.OperationalError('Connection already returned to pool')
+        return instrumentation.InstrumentedCursor(self._raw.cursor(*args, **kwargs))
+
+    def commit(self):
+        if self._raw is None:
+            raise mysql.connector.errors.OperationalError('Connection already returned to pool')
+        self._raw.commit()
+        _mark_write()
+
+    def close(self):
+        if self._raw is None:
+            return
+        self._raw = None
+        self._return()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+# simple thread-safe pool of mysql connections
+# keeps up to `size` idle connections, opens up to `max_overflow` more under load
+# and waits up to `timeout` seconds when everything is checked out
+class ConnectionPool:
+    def __init__(self, connect, size: int = 5, max_overflow: int = 10, timeout: float = 10.0,
+                 recycle: int = 1800, pre_ping: bool = True):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self._disposed = False
+        self._reset()
+
+    # start from an empty pool - also used in a forked child, where the
+    # parent's sockets must be dropped without sending a quit on them
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._open = 0
+        self._checked_out = 0
+        self._stats = {
+            'checkouts': 0,
+            'connects': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'recycled': 0,
+            'ping_failures': 0,
+        }
+
+    # check out a connection
+    def get(self) -> PooledConnection:
+        if self._pid != os.getpid():
+            self._reset()
+
+        wait_start = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    raw, created_at = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    self._open += 1
+                    raw, created_at = None, None
+                    break
+                if wait_start is None:
+                    wait_start = time.monotonic()
+                    self._stats['waits'] += 1
+                remaining = self.timeout - (time.monotonic() - wait_start)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._stats['wait_time'] += time.monotonic() - wait_start
+                    raise PoolTimeout(f'No database connection available after {self.timeout}s')
+                self._cond.wait(remaining)
+
+            self._checked_out += 1
+            self._stats['checkouts'] += 1
+            waited = time.monotonic() - wait_start if wait_start is not None else 0.0
+            self._stats['wait_time'] += waited
+        instrumentation.record_checkout(waited)
+
+        try:
+            raw, created_at = self._revive(raw, created_at)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+        return PooledConnection(self, raw, created_at)
+
+    # make sure a connection taken from the idle list is still usable
+    def _revive(self, raw, created_at):
+        if raw is not None and self.recycle and time.monotonic() - created_at > self.recycle:
+            self._discard(raw)
+            raw = None
+            with self._cond:
+                self._stats['recycled'] += 1
+
+        if raw is not None and self.pre_ping:
+            try:
+                raw.ping(reconnect=False)
+            except Exception:
+                self._discard(raw)
+                raw = None
+                with self._cond:
+                    self._stats['ping_failures'] += 1
+
+        if raw is None:
+            started = time.perf_counter()
+            raw = self._connect()
+            instrumentation.record_connect(time.perf_counter() - started)
+            created_at = time.monotonic()
+            with self._cond:
+                self._stats['connects'] += 1
+
+        return raw, created_at
+
+    # return a connection to the pool
+    def put(self, raw, created_at: float):
+        # connection was checked out before a fork, it belongs to the parent
+        if self._pid != os.getpid():
+            return
+
+        # throw away unread rows and end the transaction so the next
+        # user doesn't see an old snapshot or half-done writes
+        try:
+            if raw.unread_result:
+                raw.consume_results()
+            if raw.in_transaction:
+                raw.rollback()
+            healthy = True
+        except Exception:
+            healthy = False
+
+        with self._cond:
+            self._checked_out -= 1
+            if healthy and not self._disposed and len(self._idle) < self.size:
+                self._idle.append((raw, created_at))
+                raw = None
+            else:
+                self._open -= 1
+            self._cond.notify()
+
+        if raw is not None:
+            self._discard(raw)
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    # close every idle connection, and the checked out ones as they come back
+    def dispose(self):
+        with self._cond:
+            self._disposed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._open -= len(idle)
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'open': self._open,
+                'idle': len(self._idle),
+                'checked_out': self._checked_out,
+                'overflow': max(0, self._open - self.size),
+            })
+        return stats
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# storage engine the pool connects through (see backends.py): mysql with
+# DB_CONFIG, or the one picked by configure_backend(). PINKBIRD_BACKEND=sqlite
+# (with PINKBIRD_SQLITE_PATH) picks sqlite before anything has connected
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if os.environ.get('PINKBIRD_BACKEND', 'mysql') == 'sqlite':
+            _backend = backends.SQLiteBackend(os.environ.get('PINKBIRD_SQLITE_PATH', 'pinkbird.db'))
+        else:
+            _backend = backends.MySQLBackend(DB_CONFIG)
+    return _backend
+
+# switch engines, e.g. configure_backend('sqlite', path='pinkbird.db').
+# reopens the pool and empties the object caches, which hold the old
+# engine's rows
+# cb - configure backend
+def configure_backend(name: str = 'mysql', **settings):
+    global _backend
+    if name == 'mysql':
+        settings.setdefault('config', DB_CONFIG)
+    _backend = backends.create(name, **settings)
+    configure_pool()
+    _cache_backend.clear()
+    return _backend
+
+# True when statements run on the embedded SQLite engine, for the few
+# queries whose syntax differs between the engines
+def _is_sqlite() -> bool:
+    return get_backend().name == 'sqlite'
+
+def _connect():
+    return get_backend().connect()
+
+# get the shared pool, creating it on first use
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(_connect, **POOL_CONFIG)
+    return _pool
+
+# change pool settings, e.g. configure_pool(size=20, timeout=2)
+# cp - configure pool
+def configure_pool(**settings) -> ConnectionPool:
+    global _pool
+    unknown = set(settings) - set(POOL_CONFIG)
+    if unknown:
+        raise ValueError(f'Unknown pool settings: {", ".join(sorted(unknown))}')
+    POOL_CONFIG.update(settings)
+    with _pool_lock:
+        old_pool, _pool = _pool, ConnectionPool(_connect, **POOL_CONFIG)
+    if old_pool is not None:
+        old_pool.dispose()
+    for replica in _replicas:
+        replica.reopen()
+    return _pool
+
+# pool usage counters (checked out, waits, wait time, ...)
+# ps - pool stats
+def pool_stats() -> Dict:
+    return get_pool().stats()
+
+# worker threads for running independent queries side by side,
+# each call checks out its own pooled connection
+QUERY_WORKERS = 8
+
+_executor = None
+
+# run independent db calls concurrently, results come back in order
+# e.g. run_concurrently(lambda: get_followers(a), lambda: get_following(a))
+# rc - run concurrently
+def run_concurrently(*calls):
+    global _executor
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix='pinkbird-db')
+    # each call runs in a copy of the caller's context, so its queries
+    # count towards the caller's request (see instrumentation.py)
+    futures = [_executor.submit(contextvars.copy_context().run, call) for call in calls]
+    return [future.result() for future in futures]
+
+# a forked worker must never reuse the parent's sockets
+# (or its executor, whose threads don't exist in the child)
+def _reset_pool_after_fork():
+    global _executor
+    if _pool is not None:
+        _pool._reset()
+    for replica in _replicas:
+        replica.pool._reset()
+    _executor = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pool_after_fork)
 
 # get db connection
 # gdc - get database connection
 def get_conn():
-    conn = mysql.connector.connect(
-        host="localhost",
-        user="root",  # replace with your mysql username
-        password="pass",  # replace with your mysql password
-        database="pinkbird"
-    )
-    return conn
+    return get_pool().get()
 
-# check and fix hashtag trigger
-def check_hashtag_trigger():
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # Check if trigger exists
-    cursor.execute("""
-        SELECT TRIGGER_NAME 
-        FROM information_schema.TRIGGERS 
-        WHERE TRIGGER_SCHEMA = 'pinkbird' 
-        AND TRIGGER_NAME = 'extract_hashtags'
-    """)
-    
-    if not cursor.fetchone():
-        # Trigger doesn't exist, create it
-        cursor.execute("""
-            DELIMITER //
-            CREATE TRIGGER extract_hashtags AFTER INSERT ON post
-            FOR EACH ROW
-            BEGIN
-                DECLARE hashtag_text VARCHAR(50);
-                DECLARE content_copy TEXT;
-                DECLARE space_pos INT;
-                DECLARE hashtag_id_val INT;
-                
-                -- copy content for processing
-                SET content_copy = CONCAT(' ', NEW.content, ' ');
-                
-                -- find hashtags - simple extraction logic
-                WHILE content_copy REGEXP '#[a-zA-Z0-9_]+' DO
-                    -- extract the hashtag
-                    SET hashtag_text = SUBSTRING_INDEX(SUBSTRING_INDEX(content_copy, '#', 2), ' ', -1);
-                    
-                    -- trim any punctuation that might follow the hashtag
-                    SET space_pos = LOCATE(' ', hashtag_text);
-                    IF space_pos > 0 THEN
-                        SET hashtag_text = SUBSTRING(hashtag_text, 1, space_pos - 1);
-                    END IF;
-                    
-                    -- clean up hashtag text by removing '#'
-                    SET hashtag_text = TRIM(REPLACE(hashtag_text, '#', ''));
-                    
-                    -- if hashtag exists, get its id
-                    IF hashtag_text != '' THEN
-                        -- insert hashtag if it doesn't exist
-                        INSERT IGNORE INTO hashtag (name) VALUES (hashtag_text);
-                        
-                        -- get the hashtag id
-                        SELECT hashtag_id INTO hashtag_id_val FROM hashtag WHERE name = hashtag_text LIMIT 1;
-                        
-                        -- link post to hashtag
-                        INSERT IGNORE INTO contains (post_id, hashtag_id) VALUES (NEW.post_id, hashtag_id_val);
-                    END IF;
-                    
-                    -- remove processed hashtag from content copy to avoid infinite loop
-                    SET content_copy = REPLACE(content_copy, CONCAT('#', hashtag_text), '');
-                END WHILE;
-            END //
-            DELIMITER ;
-        """)
-        conn.commit()
-    
-    cursor.close()
-    conn.close()
+# pool usage, read when /metrics is scraped
+metrics.callback_gauge(
+    'pinkbird_db_pool_connections', 'Pooled database connections by state',
+    lambda: {(state,): value for state, value in pool_stats().items()
+             if state in ('open', 'idle', 'checked_out', 'overflow')},
+    ('state',),
+)
+metrics.callback_gauge(
+    'pinkbird_db_pool_events', 'Pool checkouts, connects, waits, timeouts and reconnects since start',
+    lambda: {(event,): value for event, value in pool_stats().items()
+             if event in ('checkouts', 'connects', 'waits', 'timeouts', 'recycled', 'ping_failures')},
+    ('event',),
+)
+
+# read replicas
+#
+# functions that only read call get_read_conn(), which hands out a
+# connection to a healthy replica; everything else calls get_conn() and
+# gets the primary. each replica is checked every check_interval seconds
+# and leaves rotation while its replication lag is above max_lag, its
+# replication has stopped or it can't be reached. with no healthy
+# replica, reads go to the primary.
+#
+# replicas trail the primary, so once a request has committed its reads
+# go to the primary too, and begin_routing() keeps a session on the
+# primary for sticky_seconds after its last write (read-your-writes).
+# rows for the object caches are always loaded from the primary - a stale
+# row cached from a replica would outlive the lag by CACHE_TTL
+REPLICA_CONFIG = {
+    'max_lag': 2.0,          # seconds behind the primary before a replica is skipped
+    'check_interval': 5.0,   # seconds between health checks of a replica
+    'sticky_seconds': 5.0,   # reads stay on the primary this long after a write
+}
+
+class Replica:
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = getattr(backend, 'label', backend.name)
+        self.pool = ConnectionPool(backend.connect, **POOL_CONFIG)
+        self.healthy = True
+        self.lag = None
+        self.error = None
+        self.checked_at = 0.0
+        self.stats = {'reads': 0, 'checks': 0, 'failures': 0}
+        self._check_lock = threading.Lock()
+
+    # swap in a pool with the current POOL_CONFIG
+    def reopen(self):
+        old_pool, self.pool = self.pool, ConnectionPool(self.backend.connect, **POOL_CONFIG)
+        old_pool.dispose()
+
+    # re-check the replica when the last check is old enough; one thread
+    # checks, the others carry on with the last result
+    def check_if_due(self):
+        if time.monotonic() - self.checked_at < REPLICA_CONFIG['check_interval']:
+            return
+        if not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            self.check()
+        finally:
+            self._check_lock.release()
+
+    def check(self) -> bool:
+        self.stats['checks'] += 1
+        try:
+            conn = self.pool.get()
+            try:
+                lag = self.backend.replication_lag(conn)
+            finally:
+                conn.close()
+        except Exception as e:
+            self.mark_failed(e)
+            return False
+        self.lag = lag
+        self.checked_at = time.monotonic()
+        if lag is None:
+            self.error = 'replication stopped'
+        elif lag > REPLICA_CONFIG['max_lag']:
+            self.error = f'{lag:.0f}s behind'
+        else:
+            self.error = None
+        self.healthy = self.error is None
+        return self.healthy
+
+    # take the replica out of rotation until its next check
+    def mark_failed(self, error: Exception):
+        self.stats['failures'] += 1
+        self.healthy = False
+        self.error = str(error) or type(error).__name__
+        self.checked_at = time.monotonic()
+
+_replicas = []
+_replica_turn = itertools.count()
+
+# set the read replicas, each a backend (see backends.py) or a mysql
+# config like DB_CONFIG; settings update REPLICA_CONFIG.
+# configure_replicas() with no replicas sends every read to the primary
+# cr - configure replicas
+def configure_replicas(*replicas, **settings) -> List[Replica]:
+    global _replicas
+    unknown = set(settings) - set(REPLICA_CONFIG)
+    if unknown:
+        raise ValueError(f'Unknown replica settings: {", ".join(sorted(unknown))}')
+    REPLICA_CONFIG.update(settings)
+    new = [Replica(backends.MySQLBackend(replica) if isinstance(replica, dict) else replica)
+           for replica in replicas]
+    old, _replicas = _replicas, new
+    for replica in old:
+        replica.pool.dispose()
+    return new
+
+# health, lag and read counts of each replica
+# rs - replica stats
+def replica_stats() -> List[Dict]:
+    return [{'name': replica.name, 'healthy': replica.healthy, 'lag': replica.lag,
+             'error': replica.error, **replica.stats} for replica in _replicas]
+
+# which server a request reads from, see begin_routing()
+class _Routing:
+    __slots__ = ('primary_until', 'wrote')
+
+    def __init__(self, primary_until: float):
+        self.primary_until = primary_until
+        self.wrote = False
+
+_routing = contextvars.ContextVar('pinkbird_routing', default=None)
+
+# start routing reads for one request or job. `primary_until` is the
+# time.time() until which its session must read from the primary, as
+# returned by sticky_until() after its last write. returns a token for
+# end_routing()
+# br - begin routing
+def begin_routing(primary_until: float = 0.0) -> contextvars.Token:
+    return _routing.set(_Routing(primary_until or 0.0))
+
+def end_routing(token: contextvars.Token):
+    _routing.reset(token)
+
+# when the current request wrote: the time until which its session
+# should keep reading from the primary, else None
+# su - sticky until
+def sticky_until() -> Optional[float]:
+    state = _routing.get()
+    if state is None or not state.wrote or not _replicas:
+        return None
+    return time.time() + REPLICA_CONFIG['sticky_seconds']
+
+def _mark_write():
+    state = _routing.get()
+    if state is not None:
+        state.wrote = True
+
+def _reads_primary() -> bool:
+    state = _routing.get()
+    return state is not None and (state.wrote or state.primary_until > time.time())
+
+# get a connection for reading: a healthy replica in turn, or the
+# primary when there is none or the request must see its own writes
+# grc - get read connection
+def get_read_conn():
+    if not _replicas or _reads_primary():
+        return get_conn()
+    for replica in _replicas:
+        replica.check_if_due()
+    healthy = [replica for replica in _replicas if replica.healthy]
+    if healthy:
+        first = next(_replica_turn) % len(healthy)
+        for replica in healthy[first:] + healthy[:first]:
+            try:
+                conn = replica.pool.get()
+            except Exception as e:
+                replica.mark_failed(e)
+                continue
+            replica.stats['reads'] += 1
+            return conn
+    return get_conn()
+
+metrics.callback_gauge(
+    'pinkbird_db_replica_healthy', 'Whether a read replica is in rotation',
+    lambda: {(replica.name,): int(replica.healthy) for replica in _replicas},
+    ('replica',),
+)
+metrics.callback_gauge(
+    'pinkbird_db_replica_lag_seconds', 'Replication lag seen by the last health check',
+    lambda: {(replica.name,): replica.lag for replica in _replicas if replica.lag is not None},
+    ('replica',),
+)
+metrics.callback_gauge(
+    'pinkbird_db_replica_reads', 'Connections handed out per read replica since start',
+    lambda: {(replica.name,): replica.stats['reads'] for replica in _replicas},
+    ('replica',),
+)
 
-# Initialize trigger on module import
-check_hashtag_trigger()
+# hot single-row reads go through read-through object caches (see cache.py).
+# every write path invalidates the keys it changed after it commits, and
+# CACHE_TTL bounds staleness for anything changed outside this module
+CACHE_SIZE = 50000
+CACHE_TTL = 60
+
+_cache_backend = LRUCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+_user_cache = ObjectCache(_cache_backend, 'user', CACHE_TTL)            # user_id -> row
+_username_index = ObjectCache(_cache_backend, 'username', CACHE_TTL)    # lowercase username -> user_id
+_tweet_cache = ObjectCache(_cache_backend, 'tweet', CACHE_TTL)          # post_id -> row
+_replies_cache = ObjectCache(_cache_backend, 'replies', CACHE_TTL)      # post_id -> reply post ids
+_media_cache = ObjectCache(_cache_backend, 'media', CACHE_TTL)          # post_id -> media rows
+_ancestors_cache = ObjectCache(_cache_backend, 'ancestors', CACHE_TTL)  # post_id -> ids of the posts above it
+_object_caches = [_user_cache, _username_index, _tweet_cache, _replies_cache, _media_cache, _ancestors_cache]
+
+# swap the cache backend, e.g. configure_cache(SQLiteCache('/tmp/pinkbird-cache.db'))
+# so every worker process shares one cache
+# cc - configure cache
+def configure_cache(backend: CacheBackend):
+    global _cache_backend
+    _cache_backend = backend
+    for object_cache in _object_caches:
+        object_cache.backend = backend
+
+# hit/miss counters per cached object type
+# cs - cache stats
+def cache_stats() -> Dict:
+    stats = {object_cache.namespace: object_cache.stats() for object_cache in _object_caches}
+    stats['backend'] = _cache_backend.stats()
+    return stats
+
+metrics.callback_gauge(
+    'pinkbird_cache_lookups', 'Object cache lookups since start by cache and result',
+    lambda: {(object_cache.namespace, result): object_cache.stats()[result]
+             for object_cache in _object_caches for result in ('hits', 'misses')},
+    ('cache', 'result'),
+)
+
+# callbacks run with the ids of posts whose likes, replies or media
+# changed, after the change is committed - e.g. to drop rendered copies of them
+_post_listeners = []
+
+# opc - on posts changed
+def on_posts_changed(callback: Callable[..., None]):
+    _post_listeners.append(callback)
+
+def _posts_changed(*post_ids):
+    _tweet_cache.invalidate(*post_ids)
+    for listener in _post_listeners:
+        listener(*post_ids)
 
 # create a new user
 # cnu - create new user
 def create_user(username: str, email: str, password: str, bio: str = None, profile_pic: str = None) -> Tuple[bool, str]:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # Generate a unique user ID
-    user_id = str(uuid.uuid4())
-    
-    # Hash the password
-    hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    
-    # call the stored procedure
-    cursor.callproc('create_user', (user_id, username, email, bio, profile_pic))
-    
-    # get result
-    success = False
-    message = ""
-    for result in cursor.stored_results():
-        row = result.fetchone()
-        success = bool(row[0])
-        message = row[1]
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        
+        # Generate a unique user ID
+        user_id = str(uuid.uuid4())
+        
+        # Hash the password
+        hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        
+        # call the stored procedure
+        cursor.callproc('create_user', (user_id, username, email, bio, profile_pic))
+        
+        # get result
+        success = False
+        message = ""
+        for result in cursor.stored_results():
+            row = result.fetchone()
+            success = bool(row[0])
+            message = row[1]
+        
+        # If user creation was successful, store the password hash
+        if success:
+            cursor.execute(
+                'INSERT INTO user_auth (user_id, password_hash) VALUES (%s, %s)',
+                (user_id, hashed_password)
+            )
+            _index_user_trigrams(cursor, user_id, username, email)
+        
+        conn.commit()
+        cursor.close()
     
-    # If user creation was successful, store the password hash
     if success:
-        cursor.execute(
-            'INSERT INTO user_auth (user_id, password_hash) VALUES (%s, %s)',
-            (user_id, hashed_password)
-        )
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+        invalidate_user(user_id, username)
     return success, message
 
 # authenticate a user
 # au - authenticate user
 def authenticate_user(username_or_email: str, password: str) -> Optional[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    
-    # Hash the provided password
-    hashed_password = hashlib.sha256(password.encode()).hexdigest()
-    
-    # Find the user by username or email
-    cursor.execute(
-        '''SELECT u.user_id, u.username, u.email, u.bio, u.profile_pic 
-           FROM user u
-           JOIN user_auth ua ON u.user_id = ua.user_id
-           WHERE (u.username = %s OR u.email = %s) AND ua.password_hash = %s''',
-        (username_or_email, username_or_email, hashed_password)
-    )
-    
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        
+        # Hash the provided password
+        hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        
+        # Find the user by username or email
+        cursor.execute(
+            '''SELECT u.user_id, u.username, u.email, u.bio, u.profile_pic 
+               FROM user u
+               JOIN user_auth ua ON u.user_id = ua.user_id
+               WHERE (u.username = %s OR u.email = %s) AND ua.password_hash = %s''',
+            (username_or_email, username_or_email, hashed_password)
+        )
+        
+        user = cursor.fetchone()
+        cursor.close()
     
     return user
 
+# drop a user from the cache after it changed
+# iu - invalidate user
+def invalidate_user(user_id: str, username: str = None):
+    _user_cache.invalidate(user_id)
+    if username:
+        _username_index.invalidate(username.lower())
+
+# user cache hit/miss counters
+# ucs - user cache stats
+def user_cache_stats() -> Dict:
+    return {'users': _user_cache.stats(), 'usernames': _username_index.stats()}
+
 # get user by ID
 # gui - get user info
 def get_user(user_id: str) -> Optional[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        'SELECT user_id, username, email, bio, profile_pic FROM user WHERE user_id = %s',
-        (user_id,)
-    )
-    
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
-    return user
+    return _user_cache.get_or_load(user_id, lambda: _load_user('user_id', user_id))
 
 # get user by username
 # gubn - get user by name
 def get_user_by_username(username: str) -> Optional[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        'SELECT user_id, username, email, bio, profile_pic FROM user WHERE username = %s',
-        (username,)
-    )
+    # usernames never change, so the name -> id mapping is safe to keep
+    user_id = _username_index.get(username.lower())
+    if user_id is not None:
+        user = get_user(user_id)
+        if user:
+            return user
     
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    user = _load_user('username', username)
+    if user:
+        _username_index.set(username.lower(), user['user_id'])
+    return user
+
+# read one user row by user_id or username
+def _load_user(column: str, value: str) -> Optional[Dict]:
+    with get_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        
+        cursor.execute(
+            f'SELECT user_id, username, email, bio, profile_pic FROM user WHERE {column} = %s',
+            (value,)
+        )
+        
+        user = cursor.fetchone()
+        cursor.close()
     
     return user
 
 # update user profile
 # uup - update user profile
 def update_profile(user_id: str, bio: str = None, profile_pic: str = None) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        'UPDATE user SET bio = %s, profile_pic = %s WHERE user_id = %s',
-        (bio, profile_pic, user_id)
-    )
-    
-    success = cursor.rowcount > 0
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            'UPDATE user SET bio = %s, profile_pic = %s WHERE user_id = %s',
+            (bio, profile_pic, user_id)
+        )
+        
+        success = cursor.rowcount > 0
+        conn.commit()
+        cursor.close()
     
+    invalidate_user(user_id)
     return success
 
+# default number of tweets per timeline page
+PAGE_SIZE = 20
+
+# timelines are paged by (created_at, post_id), newest first.
+# relevance-ranked search pages by (score, post_id) instead.
+# the cursor is the key of the last tweet on a page, encoded so callers
+# treat it as an opaque string
+
+# encode page cursor, key is a created_at datetime or a search score
+# epc - encode page cursor
+def encode_cursor(key, post_id: int) -> str:
+    key = key.isoformat() if isinstance(key, datetime) else str(key)
+    raw = f'{key}|{post_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+# decode page cursor, None if missing or malformed
+# dpc - decode page cursor
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[object, int]]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        key, post_id = raw.split('|')
+        if 'T' in key:
+            return datetime.fromisoformat(key), int(post_id)
+        return Decimal(key), int(post_id)
+    except (ValueError, UnicodeDecodeError, InvalidOperation):
+        return None
+
+# cursor for the page after `rows`, None when this was the last page
+# npc - next page cursor
+def next_page_cursor(rows: List[Dict], limit: int = PAGE_SIZE) -> Optional[str]:
+    if len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor(last['score'] if 'score' in last else last['created_at'], last['id'])
+
+# sql condition (and params) for rows older than the cursor,
+# `alias` is the table holding created_at and post_id
+def _keyset_filter(before: Optional[str], alias: str = 'p') -> Tuple[str, tuple]:
+    key = decode_cursor(before)
+    if key is None or not isinstance(key[0], datetime):
+        return 'TRUE', ()
+    created_at, post_id = key
+    return (f'({alias}.created_at < %s OR ({alias}.created_at = %s AND {alias}.post_id < %s))',
+            (created_at, created_at, post_id))
+
+# media_urls column for queries that can't GROUP BY the post, e.g. over
+# a ranked derived table; takes media.CARD_VARIANT as its parameter
+_MEDIA_URLS_COLUMN = '''(SELECT GROUP_CONCAT(DISTINCT COALESCE(mv.file_url, m.file_url))
+               FROM hasmedia hm
+               JOIN media m ON hm.media_id = m.media_id
+               LEFT JOIN media_variant mv ON mv.media_id = m.media_id AND mv.variant = %s
+               WHERE hm.post_id = p.post_id) as media_urls'''
+
+# media_urls from string to list, in place
+def _split_media_urls(rows: List[Dict]) -> List[Dict]:
+    for row in rows:
+        row['media_urls'] = row['media_urls'].split(',') if row['media_urls'] else []
+    return rows
+
 # get all tweets from db
 # gat - get all tweets
-def get_all_tweets() -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count,
-           (SELECT COUNT(*) FROM replies WHERE post_id = p.post_id) as reply_count,
-           GROUP_CONCAT(DISTINCT m.file_url) as media_urls
-           FROM post p
-           JOIN user u ON p.user_id = u.user_id
-           LEFT JOIN hasmedia h ON p.post_id = h.post_id
-           LEFT JOIN media m ON h.media_id = m.media_id
-           GROUP BY p.post_id
-           ORDER BY p.created_at DESC'''
-    )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
+def get_all_tweets(limit: int = PAGE_SIZE, before: str = None) -> List[Dict]:
+    keyset, keyset_params = _keyset_filter(before)
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count,
+               GROUP_CONCAT(DISTINCT COALESCE(mv.file_url, m.file_url)) as media_urls
+               FROM post p
+               JOIN user u ON p.user_id = u.user_id
+               LEFT JOIN hasmedia h ON p.post_id = h.post_id
+               LEFT JOIN media m ON h.media_id = m.media_id
+               LEFT JOIN media_variant mv ON mv.media_id = m.media_id AND mv.variant = %s
+               WHERE {keyset}
+               GROUP BY p.post_id
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (media.CARD_VARIANT, *keyset_params, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
     
     # Convert media_urls from string to list
     for row in rows:
@@ -225,31 +817,66 @@ def get_all_tweets() -> List[Dict]:
     
     return rows
 
+# home timelines are materialized: publish_tweet pushes each new post id
+# into the timeline rows of the author and their followers (fan-out on write).
+# accounts with more than FANOUT_LIMIT followers are flagged fanout_on_read
+# and skipped on write; their posts are merged in when the feed is read.
+
+# followers above which an account stops being fanned out on write
+FANOUT_LIMIT = 10000
+
+# how many recent posts are copied into a timeline on follow
+TIMELINE_BACKFILL = 200
+
+# ids on one page of a home timeline, as a derived table: the pushed
+# timeline rows merged with the posts of followed fanout_on_read accounts
+def _feed_ids(user_id: str, limit: int, before: Optional[str]) -> Tuple[str, tuple]:
+    timeline_keyset, timeline_params = _keyset_filter(before, 't')
+    pulled_keyset, pulled_params = _keyset_filter(before, 'fp')
+    return (
+        f'''SELECT post_id FROM (
+               SELECT t.post_id FROM timeline t
+               WHERE t.user_id = %s AND {timeline_keyset}
+               ORDER BY t.created_at DESC, t.post_id DESC
+               LIMIT %s
+           ) pushed
+           UNION
+           SELECT post_id FROM (
+               SELECT fp.post_id FROM follows f
+               JOIN user a ON a.user_id = f.following_id AND a.fanout_on_read
+               JOIN post fp ON fp.user_id = f.following_id
+               WHERE f.follower_id = %s AND {pulled_keyset}
+               ORDER BY fp.created_at DESC, fp.post_id DESC
+               LIMIT %s
+           ) pulled''',
+        (user_id, *timeline_params, limit, user_id, *pulled_params, limit)
+    )
+
 # get tweets from followed users
 # gtf - get tweets from followed
-def get_feed_tweets(user_id: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count,
-           (SELECT COUNT(*) FROM replies WHERE post_id = p.post_id) as reply_count,
-           GROUP_CONCAT(DISTINCT m.file_url) as media_urls
-           FROM post p
-           JOIN user u ON p.user_id = u.user_id
-           LEFT JOIN hasmedia h ON p.post_id = h.post_id
-           LEFT JOIN media m ON h.media_id = m.media_id
-           WHERE p.user_id IN (
-               SELECT following_id FROM follows WHERE follower_id = %s
-           ) OR p.user_id = %s
-           GROUP BY p.post_id
-           ORDER BY p.created_at DESC''',
-        (user_id, user_id)
-    )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
+def get_feed_tweets(user_id: str, limit: int = PAGE_SIZE, before: str = None) -> List[Dict]:
+    feed, feed_params = _feed_ids(user_id, limit, before)
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count,
+               GROUP_CONCAT(DISTINCT COALESCE(mv.file_url, m.file_url)) as media_urls
+               FROM ({feed}) feed
+               JOIN post p ON p.post_id = feed.post_id
+               JOIN user u ON p.user_id = u.user_id
+               LEFT JOIN hasmedia h ON p.post_id = h.post_id
+               LEFT JOIN media m ON h.media_id = m.media_id
+               LEFT JOIN media_variant mv ON mv.media_id = m.media_id AND mv.variant = %s
+               GROUP BY p.post_id
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (*feed_params, media.CARD_VARIANT, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
     
     # Convert media_urls from string to list
     for row in rows:
@@ -260,123 +887,932 @@ def get_feed_tweets(user_id: str) -> List[Dict]:
     
     return rows
 
-# get user's tweets
-# gut - get user tweets
-def get_user_tweets(user_id: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
+# push a new post into the author's and followers' timelines
+# runs on the caller's cursor so it commits with the post itself
+def _fan_out_post(cursor, author_id: str, post_id: int):
     cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count,
-           (SELECT COUNT(*) FROM replies WHERE post_id = p.post_id) as reply_count
+        '''INSERT IGNORE INTO timeline (user_id, post_id, author_id, created_at)
+           SELECT p.user_id, p.post_id, p.user_id, p.created_at
            FROM post p
-           JOIN user u ON p.user_id = u.user_id
+           WHERE p.post_id = %s
+           UNION ALL
+           SELECT f.follower_id, p.post_id, p.user_id, p.created_at
+           FROM post p
+           JOIN user a ON a.user_id = p.user_id AND NOT a.fanout_on_read
+           JOIN follows f ON f.following_id = p.user_id
+           WHERE p.post_id = %s''',
+        (post_id, post_id)
+    )
+
+# copy the latest posts of a newly followed account into the follower's timeline
+def _backfill_timeline(cursor, follower_id: str, following_id: str):
+    # big accounts are read on demand, flag them once they cross the limit
+    cursor.execute(
+        '''UPDATE user SET fanout_on_read = TRUE
+           WHERE user_id = %s AND NOT fanout_on_read AND follower_count > %s''',
+        (following_id, FANOUT_LIMIT)
+    )
+    cursor.execute(
+        '''INSERT IGNORE INTO timeline (user_id, post_id, author_id, created_at)
+           SELECT %s, p.post_id, p.user_id, p.created_at
+           FROM post p
+           JOIN user a ON a.user_id = p.user_id AND NOT a.fanout_on_read
            WHERE p.user_id = %s
-           ORDER BY p.created_at DESC''',
-        (user_id,)
+           ORDER BY p.created_at DESC, p.post_id DESC
+           LIMIT %s''',
+        (follower_id, following_id, TIMELINE_BACKFILL)
     )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return rows
+
+# drop an unfollowed account's posts from the follower's timeline
+def _prune_timeline(cursor, follower_id: str, following_id: str):
+    cursor.execute(
+        'DELETE FROM timeline WHERE user_id = %s AND author_id = %s',
+        (follower_id, following_id)
+    )
+
+# rebuild a user's timeline from scratch, e.g. after loading data by hand
+# rbt - rebuild timeline
+def rebuild_timeline(user_id: str, limit: int = TIMELINE_BACKFILL) -> int:
+    conn = get_conn()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('DELETE FROM timeline WHERE user_id = %s', (user_id,))
+        cursor.execute(
+            '''INSERT IGNORE INTO timeline (user_id, post_id, author_id, created_at)
+               SELECT %s, p.post_id, p.user_id, p.created_at
+               FROM post p
+               JOIN user a ON a.user_id = p.user_id
+               WHERE p.user_id = %s
+               OR (NOT a.fanout_on_read AND p.user_id IN (
+                   SELECT following_id FROM follows WHERE follower_id = %s
+               ))
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (user_id, user_id, user_id, limit)
+        )
+        count = cursor.rowcount
+        conn.commit()
+        return count
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cursor.close()
+        conn.close()
+
+# get user's tweets
+# gut - get user tweets
+def get_user_tweets(user_id: str, limit: int = PAGE_SIZE, before: str = None) -> List[Dict]:
+    keyset, keyset_params = _keyset_filter(before)
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count,
+               {_MEDIA_URLS_COLUMN}
+               FROM post p
+               JOIN user u ON p.user_id = u.user_id
+               WHERE p.user_id = %s AND {keyset}
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (media.CARD_VARIANT, user_id, *keyset_params, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return _split_media_urls(rows)
+
+# everything the profile page needs: the user, follow counts, whether
+# the viewer follows them and the first page of tweets with like state.
+# sent as one multi-statement query, i.e. a single round trip
+# gp - get profile
+def get_profile(username: str, viewer_id: str = None, limit: int = PAGE_SIZE,
+                before: str = None) -> Optional[Dict]:
+    keyset, keyset_params = _keyset_filter(before)
+    page = f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+           p.content, p.created_at, p.thread_id,
+           p.like_count,
+           p.reply_count,
+           {_MEDIA_URLS_COLUMN}
+           FROM user u
+           JOIN post p ON p.user_id = u.user_id
+           WHERE u.username = %s AND {keyset}
+           ORDER BY p.created_at DESC, p.post_id DESC
+           LIMIT %s'''
+    statements = [
+        ('''SELECT u.user_id, u.username, u.email, u.bio, u.profile_pic,
+            u.follower_count, u.following_count,
+            EXISTS(SELECT 1 FROM follows f WHERE f.follower_id = %s AND f.following_id = u.user_id) AS is_following
+            FROM user u WHERE u.username = %s''', (viewer_id, username)),
+        (page, (media.CARD_VARIANT, username, *keyset_params, limit)),
+    ]
+    if viewer_id:
+        statements.append((
+            f'SELECT l.post_id FROM ({page}) pg JOIN likes l ON l.post_id = pg.id AND l.user_id = %s',
+            (media.CARD_VARIANT, username, *keyset_params, limit, viewer_id)
+        ))
+    
+    # sqlite, or a proxy that refuses multi-statements (see
+    # backends.MySQLBackend): fetch the parts concurrently instead
+    if not get_backend().supports_multi_statements:
+        return _get_profile_concurrently(username, viewer_id, limit, before)
+    result_sets = _execute_multi(statements)
+    
+    if not result_sets[0]:
+        return None
+    user = result_sets[0][0]
+    tweets = _split_media_urls(result_sets[1])
+    liked = {row['post_id'] for row in result_sets[2]} if viewer_id else set()
+    liked = _with_queued('like', viewer_id, liked, [tweet['id'] for tweet in tweets])
+    for tweet in tweets:
+        tweet['is_liked'] = tweet['id'] in liked
+    
+    return {
+        'user': {key: user[key] for key in ('user_id', 'username', 'email', 'bio', 'profile_pic')},
+        'follower_count': user['follower_count'],
+        'following_count': user['following_count'],
+        'is_following': _queued_state('follow', viewer_id, user['user_id'], bool(user['is_following'])),
+        'tweets': tweets,
+    }
+
+# run several statements in one round trip, returning each one's rows
+def _execute_multi(statements: List[Tuple[str, tuple]]) -> List[List[Dict]]:
+    conn = get_read_conn()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        sql = ';\n'.join(statement for statement, _ in statements)
+        params = tuple(param for _, params in statements for param in params)
+        return [result.fetchall() for result in cursor.execute(sql, params, multi=True) if result.with_rows]
+    finally:
+        cursor.close()
+        conn.close()
+
+# same result as get_profile, one query per part run side by side
+def _get_profile_concurrently(username: str, viewer_id: Optional[str], limit: int,
+                              before: Optional[str]) -> Optional[Dict]:
+    user = get_user_by_username(username)
+    if not user:
+        return None
+    user_id = user['user_id']
+    
+    follower_count, following_count, is_following_user, tweets = run_concurrently(
+        lambda: get_follower_count(user_id),
+        lambda: get_following_count(user_id),
+        lambda: bool(viewer_id) and is_following(viewer_id, user_id),
+        lambda: get_user_tweets(user_id, limit, before),
+    )
+    liked = get_liked_post_ids(viewer_id, [tweet['id'] for tweet in tweets]) if viewer_id else set()
+    for tweet in tweets:
+        tweet['is_liked'] = tweet['id'] in liked
+    
+    return {
+        'user': user,
+        'follower_count': follower_count,
+        'following_count': following_count,
+        'is_following': is_following_user,
+        'tweets': tweets,
+    }
 
 # get tweet by id
 # gtbi - get tweet by id
 def get_tweet(tweet_id: int) -> Optional[Dict]:
+    tweets = get_tweets([tweet_id])
+    return tweets[0] if tweets else None
+
+# get several tweets by id, in the given order - one cache multi-get,
+# then one query for whatever wasn't cached
+# gts - get tweets
+def get_tweets(tweet_ids: List[int]) -> List[Dict]:
+    found = _tweet_cache.get_or_load_many(tweet_ids, _load_tweets)
+    return [found[tweet_id] for tweet_id in tweet_ids if tweet_id in found]
+
+def _load_tweets(tweet_ids: List[int]) -> Dict[int, Dict]:
+    with get_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        placeholders = ', '.join(['%s'] * len(tweet_ids))
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count,
+               GROUP_CONCAT(DISTINCT COALESCE(mv.file_url, m.file_url)) as media_urls
+               FROM post p
+               JOIN user u ON p.user_id = u.user_id
+               LEFT JOIN hasmedia h ON p.post_id = h.post_id
+               LEFT JOIN media m ON h.media_id = m.media_id
+               LEFT JOIN media_variant mv ON mv.media_id = m.media_id AND mv.variant = %s
+               WHERE p.post_id IN ({placeholders})
+               GROUP BY p.post_id''',
+            (media.CARD_VARIANT, *tweet_ids)
+        )
+        tweets = {tweet['id']: tweet for tweet in cursor.fetchall()}
+        cursor.close()
+    for tweet in tweets.values():
+        tweet['media_urls'] = tweet['media_urls'].split(',') if tweet['media_urls'] else []
+    return tweets
+
+# get tweet replies
+# gtr - get tweet replies
+def get_tweet_replies(tweet_id: int) -> List[Dict]:
+    reply_ids = _replies_cache.get_or_load_many([tweet_id], _load_reply_ids)[tweet_id]
+    if len(reply_ids) >= REPLY_IDS_CACHED:
+        reply_ids = _page_reply_ids(tweet_id)
+    return get_tweets(reply_ids)
+
+# most reply ids cached for one tweet, the oldest ones. a tweet with more
+# replies pages the rest from the database (see _page_reply_ids)
+REPLY_IDS_CACHED = 200
+
+# {post_id: ids of its replies, oldest first} for several posts in one
+# query, at most REPLY_IDS_CACHED each
+def _load_reply_ids(post_ids: List[int]) -> Dict[int, List[int]]:
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        placeholders = ', '.join(['%s'] * len(post_ids))
+        cursor.execute(
+            f'''SELECT post_id, reply_id FROM (
+                   SELECT r.post_id, p.post_id AS reply_id, p.created_at,
+                          ROW_NUMBER() OVER (PARTITION BY r.post_id
+                                             ORDER BY p.created_at ASC, p.post_id ASC) AS n
+                   FROM post p
+                   JOIN replies r ON r.reply_id = p.post_id
+                   WHERE r.post_id IN ({placeholders})
+               ) ranked
+               WHERE n <= %s
+               ORDER BY created_at ASC, reply_id ASC''',
+            (*post_ids, REPLY_IDS_CACHED)
+        )
+        reply_ids = {post_id: [] for post_id in post_ids}
+        for post_id, reply_id in cursor.fetchall():
+            reply_ids[post_id].append(reply_id)
+        cursor.close()
+    return reply_ids
+
+# ids of one tweet's replies oldest first, straight from the database:
+# those after `after`, a (created_at, post_id) cursor key, up to `limit`
+# (None for all of them)
+def _page_reply_ids(post_id: int, after: Tuple[datetime, int] = None,
+                    limit: Optional[int] = None) -> List[int]:
+    keyset, keyset_params = 'TRUE', ()
+    if after is not None:
+        keyset = '(p.created_at > %s OR (p.created_at = %s AND p.post_id > %s))'
+        keyset_params = (after[0], after[0], after[1])
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f'''SELECT p.post_id
+               FROM post p
+               JOIN replies r ON r.reply_id = p.post_id
+               WHERE r.post_id = %s AND {keyset}
+               ORDER BY p.created_at ASC, p.post_id ASC
+               {'LIMIT %s' if limit is not None else ''}''',
+            (post_id, *keyset_params, *((limit,) if limit is not None else ()))
+        )
+        reply_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return reply_ids
+
+# limits for get_conversation: reply levels below the viewed tweet,
+# replies shown under each tweet, replies shown in all and parent
+# tweets shown above it
+THREAD_MAX_DEPTH = 3
+THREAD_MAX_BREADTH = 10
+THREAD_MAX_REPLIES = 200
+THREAD_MAX_ANCESTORS = 20
+
+# ids of the tweets a tweet replies to, root first, up to THREAD_MAX_ANCESTORS.
+# a reply never moves, so nothing invalidates these
+def _load_ancestor_ids(tweet_id: int) -> List[int]:
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''WITH RECURSIVE ancestors (post_id, depth) AS (
+                   SELECT r.post_id, 1 FROM replies r WHERE r.reply_id = %s
+                   UNION ALL
+                   SELECT r.post_id, a.depth + 1
+                   FROM ancestors a
+                   JOIN replies r ON r.reply_id = a.post_id
+                   WHERE a.depth < %s
+               )
+               SELECT post_id FROM ancestors ORDER BY depth DESC''',
+            (tweet_id, THREAD_MAX_ANCESTORS)
+        )
+        ancestor_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return ancestor_ids
+
+# load a conversation around one tweet: the chain of tweets it replies
+# to (up to THREAD_MAX_ANCESTORS), the tweet itself and the replies below
+# it as a tree. everything comes from the object caches, a level at a
+# time - one multi-get for the reply ids of a level and one for their
+# rows, with one query for whatever wasn't cached. the tree is cut at
+# max_depth levels, max_breadth replies per tweet (oldest first) and
+# max_replies replies in all, nearest levels first (None for no limit);
+# `after` is a cursor that pages through the direct replies of the
+# viewed tweet. deeper levels show at most REPLY_IDS_CACHED per tweet.
+#
+# returns {'ancestors': [...], 'tweet': {...}, 'replies': [...],
+# 'next_cursor': ...} where every reply carries its own 'replies' list,
+# or None when the tweet doesn't exist
+def get_conversation(tweet_id: int, max_depth: int = THREAD_MAX_DEPTH,
+                     max_breadth: Optional[int] = THREAD_MAX_BREADTH, after: str = None,
+                     max_ancestors: int = THREAD_MAX_ANCESTORS,
+                     max_replies: Optional[int] = THREAD_MAX_REPLIES) -> Optional[Dict]:
+    tweet = get_tweet(tweet_id)
+    if tweet is None:
+        return None
+
+    ancestors = []
+    if max_ancestors > 0:
+        ancestor_ids = _ancestors_cache.get_or_load(tweet_id, lambda: _load_ancestor_ids(tweet_id))
+        ancestors = get_tweets(ancestor_ids[-max_ancestors:])
+
+    key = decode_cursor(after)
+    if key is not None and not isinstance(key[0], datetime):
+        key = None
+
+    tweet['replies'] = []
+    level, depth, budget, more = [tweet], 0, max_replies, False
+    while level and depth < max_depth and budget != 0:
+        reply_ids = _replies_cache.get_or_load_many([parent['id'] for parent in level], _load_reply_ids)
+        picked = []
+        for parent in level:
+            ids = reply_ids[parent['id']]
+            if depth == 0:
+                # one id past the page tells whether there is a next one
+                wanted = None if max_breadth is None else max_breadth + 1
+                truncated = len(ids) >= REPLY_IDS_CACHED and (wanted is None or wanted > len(ids))
+                if key is not None or truncated:
+                    ids = _page_reply_ids(tweet_id, key, wanted)
+                more = wanted is not None and len(ids) >= wanted
+            picked.extend((parent, reply_id) for reply_id in ids[:max_breadth])
+        if budget is not None:
+            more = more or (depth == 0 and len(picked) > budget)
+            picked = picked[:budget]
+            budget -= len(picked)
+        rows = {row['id']: row for row in get_tweets([reply_id for _, reply_id in picked])}
+        level = []
+        for parent, reply_id in picked:
+            if reply_id in rows:
+                reply = rows[reply_id]
+                reply['replies'] = []
+                parent['replies'].append(reply)
+                level.append(reply)
+        depth += 1
+
+    replies = tweet['replies']
+    next_cursor = None
+    if more and replies:
+        next_cursor = encode_cursor(replies[-1]['created_at'], replies[-1]['id'])
+    return {'ancestors': ancestors, 'tweet': tweet, 'replies': replies, 'next_cursor': next_cursor}
+
+# get thread
+# gt - get thread
+def get_thread(thread_id: int) -> List[Dict]:
+    conversation = get_conversation(thread_id, max_depth=1, max_breadth=None, max_ancestors=0,
+                                    max_replies=None)
+    if conversation is None:
+        return []
+    return [conversation['tweet']] + conversation['replies']
+
+# a hashtag is '#' followed by letters, digits or underscores -
+# the same pattern setup.sql uses to backfill existing posts
+HASHTAG_PATTERN = re.compile(r'#([A-Za-z0-9_]+)')
+
+# longest hashtag name the hashtag table stores
+HASHTAG_MAX_LENGTH = 50
+
+# get the distinct hashtags in a post, first spelling wins
+# eh - extract hashtags
+def extract_hashtags(content: str) -> List[str]:
+    hashtags = {}
+    for match in HASHTAG_PATTERN.finditer(content):
+        name = match.group(1)[:HASHTAG_MAX_LENGTH]
+        hashtags.setdefault(name.lower(), name)
+    return list(hashtags.values())
+
+# create missing hashtags and link them to a post with two statements,
+# whatever the number of tags
+def _link_hashtags(cursor, post_id: int, hashtags: List[str]):
+    if not hashtags:
+        return
+    values = ', '.join(['(%s)'] * len(hashtags))
+    cursor.execute(f'INSERT IGNORE INTO hashtag (name) VALUES {values}', tuple(hashtags))
+    placeholders = ', '.join(['%s'] * len(hashtags))
+    cursor.execute(
+        f'''INSERT IGNORE INTO contains (post_id, hashtag_id)
+           SELECT %s, hashtag_id FROM hashtag WHERE name IN ({placeholders})''',
+        (post_id, *hashtags)
+    )
+
+# publish new tweet
+# pnt - publish new tweet
+def publish_tweet(user_id: str, content: str, thread_id: int = None) -> int:
     conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
+    cursor = conn.cursor()
+    
+    try:
+        # call the stored procedure
+        cursor.callproc('publish_tweet', (user_id, content, thread_id))
+        
+        # get result
+        post_id = None
+        for result in cursor.stored_results():
+            post_id = result.fetchone()[0]
+        
+        hashtags = extract_hashtags(content)
+        _link_hashtags(cursor, post_id, hashtags)
+        
+        # the procedure linked the reply, bump the parent's counter with it
+        if thread_id is not None:
+            cursor.execute(
+                'UPDATE post SET reply_count = reply_count + 1 WHERE post_id = %s',
+                (thread_id,)
+            )
+        
+        _fan_out_post(cursor, user_id, post_id)
+        
+        conn.commit()
+        if thread_id is not None:
+            _replies_cache.invalidate(thread_id)
+            _posts_changed(thread_id)
+        trending.hashtags.record(hashtags)
+        return post_id
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cursor.close()
+        conn.close()
+
+# recount like_count/reply_count from the likes and replies tables,
+# one post id range per transaction so the job never holds long locks
+# rpc - reconcile post counters
+def reconcile_post_counters(chunk_size: int = 1000) -> int:
+    conn = get_conn()
+    cursor = conn.cursor()
+    
+    fixed = 0
+    try:
+        cursor.execute('SELECT COALESCE(MIN(post_id), 0), COALESCE(MAX(post_id), 0) FROM post')
+        low, high = cursor.fetchone()
+        
+        for start in range(low, high + 1, chunk_size):
+            end = start + chunk_size - 1
+            if _is_sqlite():
+                _reconcile_post_counters_sqlite(cursor, start, end)
+                fixed += cursor.rowcount
+                conn.commit()
+                continue
+            cursor.execute(
+                '''UPDATE post p
+                   LEFT JOIN (
+                       SELECT post_id, COUNT(*) AS total FROM likes
+                       WHERE post_id BETWEEN %s AND %s GROUP BY post_id
+                   ) l ON l.post_id = p.post_id
+                   LEFT JOIN (
+                       SELECT post_id, COUNT(*) AS total FROM replies
+                       WHERE post_id BETWEEN %s AND %s GROUP BY post_id
+                   ) r ON r.post_id = p.post_id
+                   SET p.like_count = COALESCE(l.total, 0),
+                       p.reply_count = COALESCE(r.total, 0)
+                   WHERE p.post_id BETWEEN %s AND %s
+                   AND (p.like_count <> COALESCE(l.total, 0) OR p.reply_count <> COALESCE(r.total, 0))''',
+                (start, end, start, end, start, end)
+            )
+            fixed += cursor.rowcount
+            conn.commit()
+        return fixed
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cursor.close()
+        conn.close()
+
+# sqlite has no UPDATE ... JOIN, the counts come from correlated subqueries
+def _reconcile_post_counters_sqlite(cursor, start: int, end: int):
     cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count
-           FROM post p
-           JOIN user u ON p.user_id = u.user_id
-           WHERE p.post_id = %s''',
-        (tweet_id,)
+        '''UPDATE post SET like_count = c.likes, reply_count = c.replies
+           FROM (
+               SELECT p.post_id,
+                      (SELECT COUNT(*) FROM likes l WHERE l.post_id = p.post_id) AS likes,
+                      (SELECT COUNT(*) FROM replies r WHERE r.post_id = p.post_id) AS replies
+               FROM post p WHERE p.post_id BETWEEN %s AND %s
+           ) c
+           WHERE post.post_id = c.post_id
+           AND (post.like_count <> c.likes OR post.reply_count <> c.replies)''',
+        (start, end)
     )
-    tweet = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return tweet
 
-# get tweet replies
-# gtr - get tweet replies
-def get_tweet_replies(tweet_id: int) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count
-           FROM post p
-           JOIN user u ON p.user_id = u.user_id
-           JOIN replies r ON r.reply_id = p.post_id
-           WHERE r.post_id = %s
-           ORDER BY p.created_at ASC''',
-        (tweet_id,)
-    )
-    replies = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return replies
+# trending counts live in memory per process (see trending.py).
+# each worker counts its own publishes right away and re-reads the
+# contains table every TRENDING_RESYNC_SECONDS to pick up everyone else's
+
+# seconds between full reloads of the trending counts
+TRENDING_RESYNC_SECONDS = 300
+
+_trending_reload = threading.Lock()
+
+# reload trending counts from hashtag uses inside the longest window
+# rbt - rebuild trending
+def rebuild_trending():
+    window = max(trending.hashtags.windows.values())
+    bucket = trending.hashtags.bucket_seconds
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            '''SELECT h.name, FLOOR(UNIX_TIMESTAMP(p.created_at) / %s) * %s AS bucket, COUNT(*)
+               FROM post p
+               JOIN contains c ON c.post_id = p.post_id
+               JOIN hashtag h ON h.hashtag_id = c.hashtag_id
+               WHERE p.created_at >= NOW() - INTERVAL %s SECOND
+               GROUP BY h.hashtag_id, bucket''',
+            (bucket, bucket, window)
+        )
+        rows = [(name, float(start), count) for name, start, count in cursor.fetchall()]
+        
+        cursor.close()
+    trending.hashtags.load(rows)
+
+# get the top hashtags in a window ('1h' or '24h')
+# gth - get trending hashtags
+def get_trending_hashtags(window: str = '24h', k: int = None) -> List[Dict]:
+    loaded_at = trending.hashtags.loaded_at
+    if loaded_at is None or time.time() - loaded_at > TRENDING_RESYNC_SECONDS:
+        # one thread reloads, the others keep serving the current counts
+        if _trending_reload.acquire(blocking=loaded_at is None):
+            try:
+                rebuild_trending()
+            finally:
+                _trending_reload.release()
+    return trending.hashtags.top(window, k)
+
+# search tweets by hashtag
+# stbh - search tweets by hashtag
+def search_tweets_by_hashtag(hashtag: str, limit: int = PAGE_SIZE, before: str = None) -> List[Dict]:
+    keyset, keyset_params = _keyset_filter(before)
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count,
+               {_MEDIA_URLS_COLUMN}
+               FROM post p
+               JOIN user u ON p.user_id = u.user_id
+               JOIN contains c ON p.post_id = c.post_id
+               JOIN hashtag h ON c.hashtag_id = h.hashtag_id
+               WHERE h.name = %s AND {keyset}
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (media.CARD_VARIANT, hashtag, *keyset_params, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return _split_media_urls(rows)
+
+# what a timeline page's validator is built from (see api.py): the id,
+# counters and viewer's like of each post on the page, newest first.
+# the page is found with the same keyset as its page query but none of
+# the joins, and `key` is the reader (feed), the author (user) or the
+# hashtag name (hashtag)
+# gts - get timeline stamps
+def get_timeline_stamps(timeline: str, key: str = None, viewer_id: str = None,
+                        limit: int = PAGE_SIZE, before: str = None) -> List[Dict]:
+    keyset, keyset_params = _keyset_filter(before)
+    if timeline == 'explore':
+        source, where, params = 'post p', keyset, keyset_params
+    elif timeline == 'user':
+        source, where, params = 'post p', f'p.user_id = %s AND {keyset}', (key, *keyset_params)
+    elif timeline == 'hashtag':
+        source = ('post p JOIN contains c ON p.post_id = c.post_id '
+                  'JOIN hashtag h ON c.hashtag_id = h.hashtag_id')
+        where, params = f'h.name = %s AND {keyset}', (key, *keyset_params)
+    elif timeline == 'feed':
+        feed, params = _feed_ids(key, limit, before)
+        source, where = f'({feed}) feed JOIN post p ON p.post_id = feed.post_id', 'TRUE'
+    else:
+        raise ValueError(f'unknown timeline: {timeline}')
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.like_count, p.reply_count,
+               EXISTS(SELECT 1 FROM likes l WHERE l.user_id = %s AND l.post_id = p.post_id) AS is_liked
+               FROM {source}
+               WHERE {where}
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (viewer_id, *params, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    liked = _with_queued('like', viewer_id, {row['id'] for row in rows if row['is_liked']},
+                         [row['id'] for row in rows])
+    for row in rows:
+        row['is_liked'] = row['id'] in liked
+    return rows
+
+# version token of each post's tweet cache entry, {post_id: token}. a
+# token changes whenever the post is reported to on_posts_changed
+# (likes, replies, media), so it stands in for those in validators
+# pv - post versions
+def post_versions(post_ids: List[int]) -> Dict[int, str]:
+    return _tweet_cache.versions(post_ids)
+
+# user search ranks exact username matches first, then username prefixes,
+# then anything containing the query in the username or email.
+# exact and prefix matches use the username/email unique indexes,
+# substring matches are found through the user_trigram table
+
+# most users returned by one search
+USER_SEARCH_LIMIT = 20
+
+# lowercase 3-character slices of a string
+def _trigrams(text: str) -> set:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# escape LIKE wildcards so user input only matches literally
+def _escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# store the trigrams of a new user's username and email
+def _index_user_trigrams(cursor, user_id: str, username: str, email: str):
+    trigrams = _trigrams(username) | _trigrams(email)
+    if not trigrams:
+        return
+    cursor.executemany(
+        'INSERT IGNORE INTO user_trigram (trigram, user_id) VALUES (%s, %s)',
+        [(trigram, user_id) for trigram in trigrams]
+    )
+
+# rebuild user_trigram for every user, e.g. after importing users by hand
+# rut - rebuild user trigrams
+def rebuild_user_trigrams() -> int:
+    conn = get_conn()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('DELETE FROM user_trigram')
+        cursor.execute(
+            '''INSERT IGNORE INTO user_trigram (trigram, user_id)
+               WITH RECURSIVE seq (n) AS (
+                   SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+               )
+               SELECT LOWER(SUBSTRING(src.text, seq.n, 3)), src.user_id
+               FROM (
+                   SELECT user_id, username AS text FROM user
+                   UNION ALL
+                   SELECT user_id, email FROM user
+               ) src
+               JOIN seq ON seq.n <= CHAR_LENGTH(src.text) - 2'''
+        )
+        count = cursor.rowcount
+        conn.commit()
+        return count
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        cursor.close()
+        conn.close()
+
+# search users
+# su - search users
+def search_users(query: str, limit: int = USER_SEARCH_LIMIT) -> List[Dict]:
+    query = query.strip()
+    if not query:
+        return []
+    
+    prefix = _escape_like(query) + '%'
+    branches = [
+        # exact and prefix matches, straight from the unique indexes
+        ('''SELECT user_id, username, email, bio, profile_pic, 1 AS match_rank
+            FROM user WHERE username = %s''', (query,)),
+        ('''SELECT user_id, username, email, bio, profile_pic, 2 AS match_rank
+            FROM user WHERE username LIKE %s ORDER BY username LIMIT %s''', (prefix, limit)),
+        ('''SELECT user_id, username, email, bio, profile_pic, 3 AS match_rank
+            FROM user WHERE email LIKE %s ORDER BY username LIMIT %s''', (prefix, limit)),
+    ]
+    
+    # substring matches: users holding every trigram of the query,
+    # re-checked with LIKE to drop false positives. a query of one or two
+    # characters has no trigrams and falls back to a LIKE scan, which the
+    # LIMIT stops early since such short strings match often
+    trigrams = _trigrams(query)
+    contains = '%' + _escape_like(query) + '%'
+    if not trigrams:
+        branches.append((
+            '''SELECT user_id, username, email, bio, profile_pic, 3 AS match_rank
+               FROM user WHERE username LIKE %s OR email LIKE %s
+               LIMIT %s''',
+            (contains, contains, limit)
+        ))
+    else:
+        placeholders = ', '.join(['%s'] * len(trigrams))
+        branches.append((
+            f'''SELECT u.user_id, u.username, u.email, u.bio, u.profile_pic, 3 AS match_rank
+                FROM (
+                    SELECT user_id FROM user_trigram
+                    WHERE trigram IN ({placeholders})
+                    GROUP BY user_id HAVING COUNT(*) = %s
+                ) t
+                JOIN user u ON u.user_id = t.user_id
+                WHERE u.username LIKE %s OR u.email LIKE %s
+                ORDER BY u.username LIMIT %s''',
+            (*trigrams, len(trigrams), contains, contains, limit)
+        ))
+    
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        # each branch is wrapped as a derived table so it keeps its own
+        # ORDER BY/LIMIT on both engines
+        cursor.execute(
+            ' UNION ALL '.join(f'SELECT * FROM ({sql}) b{i}' for i, (sql, _) in enumerate(branches)),
+            tuple(param for _, params in branches for param in params)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    
+    # keep each user's best rank, then order like before: rank, username
+    best = {}
+    for row in rows:
+        if row['user_id'] not in best or row['match_rank'] < best[row['user_id']]['match_rank']:
+            best[row['user_id']] = row
+    users = sorted(best.values(), key=lambda row: (row['match_rank'], row['username'].lower()))
+    for user in users:
+        del user['match_rank']
+    return users[:limit]
+
+# content search is served by the ft_post_content FULLTEXT index, or the
+# post_fts table on sqlite. matches are capped at SEARCH_RESULT_CAP by text
+# relevance, then ordered either by relevance blended with recency or
+# purely newest first
 
-# get thread
-# gt - get thread
-def get_thread(thread_id: int) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
+# most matches considered for one search
+SEARCH_RESULT_CAP = 500
+
+# a post this many seconds newer is worth one extra point of relevance
+SEARCH_RECENCY_SECONDS = 7 * 24 * 3600
+
+# shortest word the FULLTEXT index stores (innodb_ft_min_token_size)
+FULLTEXT_MIN_TOKEN = 3
+
+# search tweets by content
+# stbc - search tweets by content
+def search_tweets_by_content(query: str, limit: int = PAGE_SIZE, before: str = None,
+                             sort: str = 'relevance') -> List[Dict]:
+    # words too short for the index would match nothing, scan instead
+    if max((len(word) for word in query.split()), default=0) < FULLTEXT_MIN_TOKEN:
+        return _search_tweets_by_substring(query, limit, before)
     
-    # Get the original tweet and its replies
-    original_tweet = get_tweet(thread_id)
-    replies = get_tweet_replies(thread_id)
+    if sort == 'recent':
+        score_column = ''
+        keyset, keyset_params = _keyset_filter(before, 'ranked')
+        order = 'ranked.created_at DESC, ranked.post_id DESC'
+    else:
+        score_column = ', ranked.score'
+        key = decode_cursor(before)
+        if key is None or not isinstance(key[0], Decimal):
+            keyset, keyset_params = 'TRUE', ()
+        else:
+            keyset = '(ranked.score < %s OR (ranked.score = %s AND ranked.post_id < %s))'
+            keyset_params = (key[0], key[0], key[1])
+        order = 'ranked.score DESC, ranked.post_id DESC'
     
-    # Combine them into a thread
-    thread = [original_tweet] if original_tweet else []
-    thread.extend(replies)
+    if _is_sqlite():
+        # the post_fts index; bm25() is lower for better matches
+        ranked, ranked_params = (
+            '''SELECT p.post_id, p.created_at,
+               ROUND(-bm25(post_fts) + UNIX_TIMESTAMP(p.created_at) / %s, 6) AS score
+               FROM post_fts
+               JOIN post p ON p.post_id = post_fts.rowid
+               WHERE post_fts MATCH %s
+               ORDER BY bm25(post_fts)
+               LIMIT %s''',
+            (float(SEARCH_RECENCY_SECONDS), _fts5_query(query), SEARCH_RESULT_CAP)
+        )
+    else:
+        ranked, ranked_params = (
+            '''SELECT post_id, created_at,
+               ROUND(MATCH(content) AGAINST (%s IN NATURAL LANGUAGE MODE)
+                     + UNIX_TIMESTAMP(created_at) / %s, 6) AS score
+               FROM post
+               WHERE MATCH(content) AGAINST (%s IN NATURAL LANGUAGE MODE)
+               ORDER BY MATCH(content) AGAINST (%s IN NATURAL LANGUAGE MODE) DESC
+               LIMIT %s''',
+            (query, SEARCH_RECENCY_SECONDS, query, query, SEARCH_RESULT_CAP)
+        )
     
-    return thread
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count{score_column},
+               {_MEDIA_URLS_COLUMN}
+               FROM ({ranked}) ranked
+               JOIN post p ON p.post_id = ranked.post_id
+               JOIN user u ON p.user_id = u.user_id
+               WHERE {keyset}
+               ORDER BY {order}
+               LIMIT %s''',
+            (media.CARD_VARIANT, *ranked_params, *keyset_params, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return _split_media_urls(rows)
 
-# publish new tweet
-# pnt - publish new tweet
-def publish_tweet(user_id: str, content: str, thread_id: int = None) -> int:
+# natural-language query -> fts5 query matching any of its words,
+# each quoted so punctuation in them isn't read as query syntax
+def _fts5_query(query: str) -> str:
+    return ' OR '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+# substring search for queries the FULLTEXT index can't answer
+def _search_tweets_by_substring(query: str, limit: int, before: Optional[str]) -> List[Dict]:
+    keyset, keyset_params = _keyset_filter(before)
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f'''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
+               p.content, p.created_at, p.thread_id,
+               p.like_count,
+               p.reply_count,
+               {_MEDIA_URLS_COLUMN}
+               FROM post p
+               JOIN user u ON p.user_id = u.user_id
+               WHERE p.content LIKE %s AND {keyset}
+               ORDER BY p.created_at DESC, p.post_id DESC
+               LIMIT %s''',
+            (media.CARD_VARIANT, '%' + _escape_like(query) + '%', *keyset_params, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return _split_media_urls(rows)
+
+# move both sides' stored follow counters by delta (+1 follow, -1 unfollow)
+def _adjust_follow_counts(cursor, follower_id: str, following_id: str, delta: int):
+    cursor.execute(
+        'UPDATE user SET following_count = following_count + %s WHERE user_id = %s',
+        (delta, follower_id)
+    )
+    cursor.execute(
+        'UPDATE user SET follower_count = follower_count + %s WHERE user_id = %s',
+        (delta, following_id)
+    )
+
+# recount follower_count/following_count from the follows table,
+# chunk_size users per transaction
+# rfc - reconcile follow counters
+def reconcile_follow_counters(chunk_size: int = 1000) -> int:
     conn = get_conn()
     cursor = conn.cursor()
     
+    fixed = 0
+    last_user_id = ''
     try:
-        # call the stored procedure
-        cursor.callproc('publish_tweet', (user_id, content, thread_id))
-        
-        # get result
-        post_id = None
-        for result in cursor.stored_results():
-            post_id = result.fetchone()[0]
-        
-        # Extract hashtags manually if trigger failed
-        hashtags = [word[1:] for word in content.split() if word.startswith('#')]
-        for hashtag in hashtags:
-            # Clean hashtag
-            hashtag = ''.join(c for c in hashtag if c.isalnum() or c == '_')
-            if hashtag:
-                # Insert hashtag if it doesn't exist
-                cursor.execute(
-                    'INSERT IGNORE INTO hashtag (name) VALUES (%s)',
-                    (hashtag,)
-                )
-                # Get hashtag id
-                cursor.execute(
-                    'SELECT hashtag_id FROM hashtag WHERE name = %s',
-                    (hashtag,)
-                )
-                hashtag_id = cursor.fetchone()[0]
-                # Link post to hashtag
-                cursor.execute(
-                    'INSERT IGNORE INTO contains (post_id, hashtag_id) VALUES (%s, %s)',
-                    (post_id, hashtag_id)
-                )
-        
-        conn.commit()
-        return post_id
+        while True:
+            cursor.execute(
+                'SELECT user_id FROM user WHERE user_id > %s ORDER BY user_id LIMIT %s',
+                (last_user_id, chunk_size)
+            )
+            user_ids = [row[0] for row in cursor.fetchall()]
+            if not user_ids:
+                break
+            
+            placeholders = ', '.join(['%s'] * len(user_ids))
+            if _is_sqlite():
+                _reconcile_follow_counters_sqlite(cursor, user_ids)
+                fixed += cursor.rowcount
+                conn.commit()
+                last_user_id = user_ids[-1]
+                continue
+            cursor.execute(
+                f'''UPDATE user u
+                   LEFT JOIN (
+                       SELECT following_id, COUNT(*) AS total FROM follows
+                       WHERE following_id IN ({placeholders}) GROUP BY following_id
+                   ) fr ON fr.following_id = u.user_id
+                   LEFT JOIN (
+                       SELECT follower_id, COUNT(*) AS total FROM follows
+                       WHERE follower_id IN ({placeholders}) GROUP BY follower_id
+                   ) fg ON fg.follower_id = u.user_id
+                   SET u.follower_count = COALESCE(fr.total, 0),
+                       u.following_count = COALESCE(fg.total, 0)
+                   WHERE u.user_id IN ({placeholders})
+                   AND (u.follower_count <> COALESCE(fr.total, 0) OR u.following_count <> COALESCE(fg.total, 0))''',
+                (*user_ids, *user_ids, *user_ids)
+            )
+            fixed += cursor.rowcount
+            conn.commit()
+            last_user_id = user_ids[-1]
+        return fixed
     except Exception as e:
         conn.rollback()
         raise e
@@ -384,259 +1820,493 @@ def publish_tweet(user_id: str, content: str, thread_id: int = None) -> int:
         cursor.close()
         conn.close()
 
-# search tweets by hashtag
-# stbh - search tweets by hashtag
-def search_tweets_by_hashtag(hashtag: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
+# sqlite has no UPDATE ... JOIN, the counts come from correlated subqueries
+def _reconcile_follow_counters_sqlite(cursor, user_ids: List[str]):
+    placeholders = ', '.join(['%s'] * len(user_ids))
     cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count,
-           (SELECT COUNT(*) FROM replies WHERE post_id = p.post_id) as reply_count
-           FROM post p
-           JOIN user u ON p.user_id = u.user_id
-           JOIN contains c ON p.post_id = c.post_id
-           JOIN hashtag h ON c.hashtag_id = h.hashtag_id
-           WHERE LOWER(h.name) = LOWER(%s)
-           ORDER BY p.created_at DESC''',
-        (hashtag,)
+        f'''UPDATE user SET follower_count = c.followers, following_count = c.following
+           FROM (
+               SELECT u.user_id,
+                      (SELECT COUNT(*) FROM follows f WHERE f.following_id = u.user_id) AS followers,
+                      (SELECT COUNT(*) FROM follows f WHERE f.follower_id = u.user_id) AS following
+               FROM user u WHERE u.user_id IN ({placeholders})
+           ) c
+           WHERE user.user_id = c.user_id
+           AND (user.follower_count <> c.followers OR user.following_count <> c.following)''',
+        tuple(user_ids)
     )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return rows
 
-# search users
-# su - search users
-def search_users(query: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
+# optional write-behind for likes and follows: instead of a transaction
+# per click, writes are queued in this process (see writebehind.py) and
+# a worker applies them in multi-row batches. the acting user sees their
+# own queued writes straight away; counters and other viewers catch up
+# on the next flush, FLUSH_INTERVAL seconds at most
+_write_behind = None
+
+# turn write-behind on (journal_dir makes queued writes survive a crash)
+# or off with enabled=False, which flushes what is queued first
+# cwb - configure write behind
+def configure_write_behind(enabled: bool = True, journal_dir: str = None,
+                           **settings) -> Optional[writebehind.WriteBehindQueue]:
+    global _write_behind
+    old_queue, _write_behind = _write_behind, None
+    if old_queue is not None:
+        old_queue.stop()
+    if enabled:
+        _write_behind = writebehind.register(writebehind.WriteBehindQueue(
+            _apply_write_batch, journal_dir=journal_dir, name='toggles',
+            drop_errors=(mysql.connector.errors.IntegrityError, mysql.connector.errors.DataError), **settings
+        ))
+    return _write_behind
+
+# write everything queued now, e.g. before reading counters in a script
+# fw - flush writes
+def flush_writes() -> int:
+    return _write_behind.flush() if _write_behind is not None else 0
+
+# the stored state of a like/follow, None when its user or the post/user
+# it points at does not exist. read from the primary: a lagging replica
+# could make a change look like a no-op and the queue would drop it
+def _stored_toggle(kind: str, actor: str, target) -> Optional[bool]:
+    if kind == 'like':
+        target_sql = 'SELECT 1 FROM post WHERE post_id = %s'
+        link_sql = 'SELECT 1 FROM likes WHERE user_id = %s AND post_id = %s'
+    else:
+        target_sql = 'SELECT 1 FROM user WHERE user_id = %s'
+        link_sql = 'SELECT 1 FROM follows WHERE follower_id = %s AND following_id = %s'
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f'''SELECT EXISTS(SELECT 1 FROM user WHERE user_id = %s),
+                      EXISTS({target_sql}), EXISTS({link_sql})''',
+            (actor, target, actor, target)
+        )
+        actor_exists, target_exists, current = cursor.fetchone()
+        cursor.close()
+    if not (actor_exists and target_exists):
+        return None
+    return bool(current)
+
+# queue a like/follow change for the worker. returns whether it changes
+# anything, like the stored procedures do. writes to a post or user that
+# does not exist are refused here rather than failing the flush
+def _queue_write(kind: str, actor: str, target, state: bool) -> bool:
+    _mark_write()
+    current = _write_behind.state(kind, actor, target)
+    if current is None:
+        current = _stored_toggle(kind, actor, target)
+        if current is None:
+            return False
+    if current == state:
+        return False
+    _write_behind.submit(kind, actor, target, state)
+    return True
+
+# an actor's set of liked posts/followed users with their queued writes
+# applied, `candidates` being everything the set was read for
+def _with_queued(kind: str, actor: str, found: set, candidates) -> set:
+    if _write_behind is None or not actor:
+        return found
+    queued = _write_behind.states_for(kind, actor)
+    if not queued:
+        return found
+    return {target for target in candidates if queued.get(target, target in found)}
+
+def _queued_state(kind: str, actor: str, target, default: bool) -> bool:
+    if _write_behind is None or not actor:
+        return default
+    state = _write_behind.state(kind, actor, target)
+    return default if state is None else state
+
+# rows as a derived table: SELECT %s AS a, %s AS b UNION ALL SELECT %s, %s ...
+def _values_table(rows: List[tuple], columns: Tuple[str, ...]) -> Tuple[str, tuple]:
+    first = 'SELECT ' + ', '.join(f'%s AS {column}' for column in columns)
+    rest = 'SELECT ' + ', '.join(['%s'] * len(columns))
+    sql = ' UNION ALL '.join([first] + [rest] * (len(rows) - 1))
+    return sql, tuple(value for row in rows for value in row)
+
+# set (actor, target) pairs on or off in a link table, returns the pairs
+# that actually changed as (added, removed). pairs already there are left
+# out of the INSERT, so it needs no IGNORE - which would also swallow a
+# foreign key error and leave the counters counting a like that isn't stored
+def _apply_pairs(cursor, table: str, columns: Tuple[str, str], wanted: Dict[tuple, bool]) -> Tuple[list, list]:
+    if not wanted:
+        return [], []
+    pairs = list(wanted)
+    placeholders = ', '.join(['(%s, %s)'] * len(pairs))
+    flat = tuple(value for pair in pairs for value in pair)
     cursor.execute(
-        '''SELECT user_id, username, email, bio, profile_pic
-           FROM user
-           WHERE LOWER(username) LIKE LOWER(%s) OR LOWER(email) LIKE LOWER(%s)
-           ORDER BY 
-               CASE 
-                   WHEN LOWER(username) = LOWER(%s) THEN 1
-                   WHEN LOWER(username) LIKE LOWER(%s) THEN 2
-                   ELSE 3
-               END,
-               username
-           LIMIT 20''',
-        (f'%{query}%', f'%{query}%', query, f'{query}%')
+        f'''SELECT {columns[0]}, {columns[1]} FROM {table}
+           WHERE ({columns[0]}, {columns[1]}) IN ({placeholders}) FOR UPDATE''',
+        flat
     )
-    users = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return users
+    existing = {tuple(row) for row in cursor.fetchall()}
+    added = [pair for pair in pairs if wanted[pair] and pair not in existing]
+    removed = [pair for pair in pairs if not wanted[pair] and pair in existing]
+    if added:
+        cursor.execute(
+            f'''INSERT INTO {table} ({columns[0]}, {columns[1]})
+               VALUES {', '.join(['(%s, %s)'] * len(added))}''',
+            tuple(value for pair in added for value in pair)
+        )
+    if removed:
+        cursor.execute(
+            f'''DELETE FROM {table}
+               WHERE ({columns[0]}, {columns[1]}) IN ({', '.join(['(%s, %s)'] * len(removed))})''',
+            tuple(value for pair in removed for value in pair)
+        )
+    return added, removed
 
-# search tweets by content
-# stbc - search tweets by content
-def search_tweets_by_content(query: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
+# add per-row deltas to a counter column, e.g. {post_id: +3}
+def _apply_count_deltas(cursor, table: str, key: str, column: str, deltas: Dict):
+    deltas = [(row_id, delta) for row_id, delta in deltas.items() if delta]
+    if not deltas:
+        return
+    values, params = _values_table(deltas, ('row_id', 'delta'))
+    if _is_sqlite():
+        cursor.execute(
+            f'''UPDATE {table} SET {column} = {column} + d.delta
+               FROM ({values}) d WHERE d.row_id = {table}.{key}''',
+            params
+        )
+        return
     cursor.execute(
-        '''SELECT p.post_id as id, p.user_id as user_id, u.username as username, 
-           p.content, p.created_at, p.thread_id,
-           (SELECT COUNT(*) FROM likes WHERE post_id = p.post_id) as like_count,
-           (SELECT COUNT(*) FROM replies WHERE post_id = p.post_id) as reply_count
-           FROM post p
-           JOIN user u ON p.user_id = u.user_id
-           WHERE LOWER(p.content) LIKE LOWER(%s)
-           ORDER BY p.created_at DESC''',
-        (f'%{query}%',)
+        f'''UPDATE {table} t
+           JOIN ({values}) d ON d.row_id = t.{key}
+           SET t.{column} = t.{column} + d.delta''',
+        params
     )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return rows
+
+# apply a batch of queued writes, [(kind, actor, target, state)], in one
+# transaction. safe to repeat: each write sets a state rather than toggling
+def _apply_write_batch(writes: List[tuple]):
+    likes = {(actor, target): state for kind, actor, target, state in writes if kind == 'like'}
+    follows = {(actor, target): state for kind, actor, target, state in writes if kind == 'follow'}
+    conn = get_conn()
+    cursor = conn.cursor()
+    try:
+        liked, unliked = _apply_pairs(cursor, 'likes', ('user_id', 'post_id'), likes)
+        like_deltas = {}
+        for _, post_id in liked:
+            like_deltas[post_id] = like_deltas.get(post_id, 0) + 1
+        for _, post_id in unliked:
+            like_deltas[post_id] = like_deltas.get(post_id, 0) - 1
+        _apply_count_deltas(cursor, 'post', 'post_id', 'like_count', like_deltas)
+
+        followed, unfollowed = _apply_pairs(cursor, 'follows', ('follower_id', 'following_id'), follows)
+        following_deltas, follower_deltas = {}, {}
+        for pairs, delta in ((followed, 1), (unfollowed, -1)):
+            for follower_id, following_id in pairs:
+                following_deltas[follower_id] = following_deltas.get(follower_id, 0) + delta
+                follower_deltas[following_id] = follower_deltas.get(following_id, 0) + delta
+        _apply_count_deltas(cursor, 'user', 'user_id', 'following_count', following_deltas)
+        _apply_count_deltas(cursor, 'user', 'user_id', 'follower_count', follower_deltas)
+        for follower_id, following_id in followed:
+            _backfill_timeline(cursor, follower_id, following_id)
+        for follower_id, following_id in unfollowed:
+            _prune_timeline(cursor, follower_id, following_id)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+    if like_deltas:
+        _posts_changed(*like_deltas)
 
 # follow a user
 # fau - follow a user
 def follow_user(follower_id: str, following_id: str) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # call the stored procedure
-    cursor.callproc('follow_user', (follower_id, following_id))
+    if _write_behind is not None:
+        return _queue_write('follow', follower_id, following_id, True)
     
-    # get result
-    success = False
-    for result in cursor.stored_results():
-        success = bool(result.fetchone()[0])
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        
+        # call the stored procedure
+        cursor.callproc('follow_user', (follower_id, following_id))
+        
+        # get result
+        success = False
+        for result in cursor.stored_results():
+            success = bool(result.fetchone()[0])
+        
+        if success:
+            _adjust_follow_counts(cursor, follower_id, following_id, 1)
+            _backfill_timeline(cursor, follower_id, following_id)
+        
+        conn.commit()
+        cursor.close()
     return success
 
 # unfollow a user
 # uau - unfollow a user
 def unfollow_user(follower_id: str, following_id: str) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
+    if _write_behind is not None:
+        return _queue_write('follow', follower_id, following_id, False)
     
-    # call the stored procedure
-    cursor.callproc('unfollow_user', (follower_id, following_id))
-    
-    # get result
-    success = False
-    for result in cursor.stored_results():
-        success = bool(result.fetchone()[0])
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        
+        # call the stored procedure
+        cursor.callproc('unfollow_user', (follower_id, following_id))
+        
+        # get result
+        success = False
+        for result in cursor.stored_results():
+            success = bool(result.fetchone()[0])
+        
+        if success:
+            _adjust_follow_counts(cursor, follower_id, following_id, -1)
+            _prune_timeline(cursor, follower_id, following_id)
+        
+        conn.commit()
+        cursor.close()
     return success
 
 # like a post
 # lap - like a post
 def like_post(user_id: str, post_id: int) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # call the stored procedure
-    cursor.callproc('like_post', (user_id, post_id))
+    if _write_behind is not None:
+        return _queue_write('like', user_id, post_id, True)
     
-    # get result
-    success = False
-    for result in cursor.stored_results():
-        success = bool(result.fetchone()[0])
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        
+        # call the stored procedure
+        cursor.callproc('like_post', (user_id, post_id))
+        
+        # get result
+        success = False
+        for result in cursor.stored_results():
+            success = bool(result.fetchone()[0])
+        
+        # keep the stored counter in step, in the same transaction
+        if success:
+            cursor.execute(
+                'UPDATE post SET like_count = like_count + 1 WHERE post_id = %s',
+                (post_id,)
+            )
+        
+        conn.commit()
+        cursor.close()
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    if success:
+        _posts_changed(post_id)
     return success
 
 # unlike a post 
 # ulp - unlike a post
 def unlike_post(user_id: str, post_id: int) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
+    if _write_behind is not None:
+        return _queue_write('like', user_id, post_id, False)
     
-    # call the stored procedure
-    cursor.callproc('unlike_post', (user_id, post_id))
-    
-    # get result
-    success = False
-    for result in cursor.stored_results():
-        success = bool(result.fetchone()[0])
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        
+        # call the stored procedure
+        cursor.callproc('unlike_post', (user_id, post_id))
+        
+        # get result
+        success = False
+        for result in cursor.stored_results():
+            success = bool(result.fetchone()[0])
+        
+        # keep the stored counter in step, in the same transaction
+        if success:
+            cursor.execute(
+                'UPDATE post SET like_count = like_count - 1 WHERE post_id = %s',
+                (post_id,)
+            )
+        
+        conn.commit()
+        cursor.close()
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    if success:
+        _posts_changed(post_id)
     return success
 
 # check if liked
 # cil - check if liked
 def is_post_liked(user_id: str, post_id: int) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        'SELECT EXISTS(SELECT 1 FROM likes WHERE user_id = %s AND post_id = %s)',
-        (user_id, post_id)
-    )
-    is_liked = bool(cursor.fetchone()[0])
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            'SELECT EXISTS(SELECT 1 FROM likes WHERE user_id = %s AND post_id = %s)',
+            (user_id, post_id)
+        )
+        is_liked = bool(cursor.fetchone()[0])
+        
+        cursor.close()
+    return _queued_state('like', user_id, post_id, is_liked)
+
+# get which of the given posts a user has liked, in one query
+# glp - get liked posts
+def get_liked_post_ids(user_id: str, post_ids: List[int]) -> set:
+    post_ids = list(set(post_ids))
+    if not user_id or not post_ids:
+        return set()
     
-    cursor.close()
-    conn.close()
-    return is_liked
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        placeholders = ', '.join(['%s'] * len(post_ids))
+        cursor.execute(
+            f'SELECT post_id FROM likes WHERE user_id = %s AND post_id IN ({placeholders})',
+            (user_id, *post_ids)
+        )
+        liked = {row[0] for row in cursor.fetchall()}
+        
+        cursor.close()
+    return _with_queued('like', user_id, liked, post_ids)
 
 # get followers
 # gf - get followers
 def get_followers(user_id: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        '''SELECT u.user_id, u.username, u.bio, u.profile_pic
-           FROM follows f
-           JOIN user u ON f.follower_id = u.user_id
-           WHERE f.following_id = %s''',
-        (user_id,)
-    )
-    
-    followers = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        
+        cursor.execute(
+            '''SELECT u.user_id, u.username, u.bio, u.profile_pic
+               FROM follows f
+               JOIN user u ON f.follower_id = u.user_id
+               WHERE f.following_id = %s''',
+            (user_id,)
+        )
+        
+        followers = cursor.fetchall()
+        cursor.close()
     return followers
 
 # get following
 # gfg - get following
 def get_following(user_id: str) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        '''SELECT u.user_id, u.username, u.bio, u.profile_pic
-           FROM follows f
-           JOIN user u ON f.following_id = u.user_id
-           WHERE f.follower_id = %s''',
-        (user_id,)
-    )
-    
-    following = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        
+        cursor.execute(
+            '''SELECT u.user_id, u.username, u.bio, u.profile_pic
+               FROM follows f
+               JOIN user u ON f.following_id = u.user_id
+               WHERE f.follower_id = %s''',
+            (user_id,)
+        )
+        
+        following = cursor.fetchall()
+        cursor.close()
     return following
 
 # get follower count
 # gfc - get follower count
 def get_follower_count(user_id: str) -> int:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # call the function
-    cursor.execute(f"SELECT get_follower_count(%s)", (user_id,))
-    count = cursor.fetchone()[0]
-    
-    cursor.close()
-    conn.close()
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        # stored counter, kept in step by follow_user/unfollow_user
+        cursor.execute('SELECT follower_count FROM user WHERE user_id = %s', (user_id,))
+        row = cursor.fetchone()
+        count = row[0] if row else 0
+        
+        cursor.close()
     return count
 
 # get following count
 # gfgc - get following count
 def get_following_count(user_id: str) -> int:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # call the function
-    cursor.execute(f"SELECT get_following_count(%s)", (user_id,))
-    count = cursor.fetchone()[0]
-    
-    cursor.close()
-    conn.close()
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        # stored counter, kept in step by follow_user/unfollow_user
+        cursor.execute('SELECT following_count FROM user WHERE user_id = %s', (user_id,))
+        row = cursor.fetchone()
+        count = row[0] if row else 0
+        
+        cursor.close()
     return count
 
 # check if following
 # cif - check if following
 def is_following(follower_id: str, following_id: str) -> bool:
-    conn = get_conn()
-    cursor = conn.cursor()
-    
-    # call the function
-    cursor.execute(f"SELECT check_if_following(%s, %s)", (follower_id, following_id))
-    is_following = bool(cursor.fetchone()[0])
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute(
+            'SELECT EXISTS(SELECT 1 FROM follows WHERE follower_id = %s AND following_id = %s)',
+            (follower_id, following_id)
+        )
+        is_following = bool(cursor.fetchone()[0])
+        
+        cursor.close()
+    return _queued_state('follow', follower_id, following_id, is_following)
+
+# a user's follower and following counts and whether the viewer follows
+# them, in one query
+# gfcs - get follow counts
+def get_follow_counts(user_id: str, viewer_id: str = None) -> Dict:
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            '''SELECT u.follower_count, u.following_count,
+               EXISTS(SELECT 1 FROM follows f WHERE f.follower_id = %s AND f.following_id = u.user_id) AS is_following
+               FROM user u WHERE u.user_id = %s''',
+            (viewer_id, user_id)
+        )
+        row = cursor.fetchone() or {'follower_count': 0, 'following_count': 0, 'is_following': 0}
+        cursor.close()
+    return {
+        'follower_count': row['follower_count'],
+        'following_count': row['following_count'],
+        'is_following': _queued_state('follow', viewer_id, user_id, bool(row['is_following'])),
+    }
+
+# get which of the given users someone follows, in one query
+# gfu - get followed users
+def get_followed_user_ids(follower_id: str, user_ids: List[str]) -> set:
+    user_ids = list(set(user_ids))
+    if not follower_id or not user_ids:
+        return set()
     
-    cursor.close()
-    conn.close()
-    return is_following
+    with get_read_conn() as conn:
+        cursor = conn.cursor()
+        
+        placeholders = ', '.join(['%s'] * len(user_ids))
+        cursor.execute(
+            f'SELECT following_id FROM follows WHERE follower_id = %s AND following_id IN ({placeholders})',
+            (follower_id, *user_ids)
+        )
+        followed = {row[0] for row in cursor.fetchall()}
+        
+        cursor.close()
+    return _with_queued('follow', follower_id, followed, user_ids)
 
 # add media to post
 # amp - add media to post
-def add_media_to_post(post_id: int, file_url: str, media_type: str) -> bool:
+def add_media_to_post(post_id: int, file_url: str, media_type: str, content_hash: str = None) -> bool:
     conn = get_conn()
     cursor = conn.cursor()
     
     try:
-        # Insert into media table
-        cursor.execute(
-            'INSERT INTO media (file_url, media_type) VALUES (%s, %s)',
-            (file_url, media_type)
-        )
-        media_id = cursor.lastrowid
+        # Insert into media table, a file uploaded before reuses its row
+        # (and the variants already made for it)
+        if _is_sqlite():
+            cursor.execute(
+                '''INSERT INTO media (file_url, media_type, content_hash) VALUES (%s, %s, %s)
+                   ON CONFLICT (content_hash) DO UPDATE SET content_hash = excluded.content_hash
+                   RETURNING media_id''',
+                (file_url, media_type, content_hash)
+            )
+            media_id = cursor.fetchone()[0]
+        else:
+            cursor.execute(
+                '''INSERT INTO media (file_url, media_type, content_hash) VALUES (%s, %s, %s)
+                   ON DUPLICATE KEY UPDATE media_id = LAST_INSERT_ID(media_id)''',
+                (file_url, media_type, content_hash)
+            )
+            media_id = cursor.lastrowid
         
         # Link media to post
         cursor.execute(
@@ -645,6 +2315,8 @@ def add_media_to_post(post_id: int, file_url: str, media_type: str) -> bool:
         )
         
         conn.commit()
+        _media_cache.invalidate(post_id)
+        _posts_changed(post_id)
         return True
     except Exception as e:
         conn.rollback()
@@ -653,21 +2325,86 @@ def add_media_to_post(post_id: int, file_url: str, media_type: str) -> bool:
         cursor.close()
         conn.close()
 
+# record the resized copies made for an uploaded file, `variants` as
+# returned by media.make_variants(). called from the media workers.
+# returns False when no upload has this hash; errors are raised
+# smv - save media variants
+def save_media_variants(content_hash: str, variants: List[Dict]) -> bool:
+    if not variants:
+        return True
+    conn = get_conn()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            '''SELECT h.post_id FROM hasmedia h JOIN media m ON m.media_id = h.media_id
+               WHERE m.content_hash = %s''',
+            (content_hash,)
+        )
+        post_ids = [row[0] for row in cursor.fetchall()]
+        rows = ' UNION ALL '.join(['SELECT %s AS variant, %s AS file_url, %s AS width, %s AS height'] * len(variants))
+        if _is_sqlite():
+            upsert = '''ON CONFLICT (media_id, variant) DO UPDATE SET
+                        file_url = excluded.file_url, width = excluded.width, height = excluded.height'''
+        else:
+            upsert = 'ON DUPLICATE KEY UPDATE file_url = VALUES(file_url), width = VALUES(width), height = VALUES(height)'
+        cursor.execute(
+            f'''INSERT INTO media_variant (media_id, variant, file_url, width, height)
+               SELECT m.media_id, v.variant, v.file_url, v.width, v.height
+               FROM media m
+               JOIN ({rows}) v
+               WHERE m.content_hash = %s
+               {upsert}''',
+            (*[value for variant in variants
+               for value in (variant['variant'], variant['file_url'], variant['width'], variant['height'])],
+             content_hash)
+        )
+        saved = cursor.rowcount > 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    
+    # the posts showing this file pick up the new urls now, not after CACHE_TTL
+    if post_ids:
+        _media_cache.invalidate(*post_ids)
+        _posts_changed(*post_ids)
+    return saved
+
+# content hash and url of every uploaded file that has no variants yet
+# mwv - media without variants
+def get_media_without_variants() -> List[Dict]:
+    with get_read_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            '''SELECT m.media_id, m.file_url, m.content_hash
+               FROM media m
+               WHERE m.content_hash IS NOT NULL
+                 AND NOT EXISTS (SELECT 1 FROM media_variant mv WHERE mv.media_id = m.media_id)'''
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
 # get media for post
 # gmp - get media for post
 def get_media_for_post(post_id: int) -> List[Dict]:
-    conn = get_conn()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        '''SELECT m.media_id, m.file_url, m.media_type
-           FROM media m
-           JOIN hasmedia h ON m.media_id = h.media_id
-           WHERE h.post_id = %s''',
-        (post_id,)
-    )
-    
-    media = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return media
+    return _media_cache.get_or_load(post_id, lambda: _load_media(post_id))
+
+def _load_media(post_id: int) -> List[Dict]:
+    with get_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        
+        cursor.execute(
+            '''SELECT m.media_id, m.file_url, m.media_type
+               FROM media m
+               JOIN hasmedia h ON m.media_id = h.media_id
+               WHERE h.post_id = %s''',
+            (post_id,)
+        )
+        
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
@@ -1,55 +1,19 @@
 -- Extract hashtags from existing posts and insert them into hashtag and contains tables
-DELIMITER //
+-- set-based, same pattern as db.extract_hashtags: '#' followed by letters, digits or underscores
+-- safe to re-run: existing hashtags and links are skipped
+INSERT IGNORE INTO hashtag (name)
+WITH RECURSIVE seq (n) AS (
+    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+)
+SELECT SUBSTRING(REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n), 2, 50)
+FROM post p
+JOIN seq ON REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n) IS NOT NULL;
 
-CREATE PROCEDURE extract_hashtags_from_posts()
-BEGIN
-    DECLARE done INT DEFAULT FALSE;
-    DECLARE post_id INT;
-    DECLARE content TEXT;
-    DECLARE cur CURSOR FOR SELECT post_id, content FROM post;
-    DECLARE CONTINUE HANDLER FOR NOT FOUND SET done = TRUE;
-    
-    OPEN cur;
-    
-    read_loop: LOOP
-        FETCH cur INTO post_id, content;
-        IF done THEN
-            LEAVE read_loop;
-        END IF;
-        
-        -- Extract hashtags using regex
-        SET @pos = 1;
-        WHILE @pos > 0 DO
-            SET @pos = LOCATE('#', content, @pos);
-            IF @pos > 0 THEN
-                SET @end = LOCATE(' ', content, @pos);
-                IF @end = 0 THEN
-                    SET @end = LENGTH(content) + 1;
-                END IF;
-                
-                SET @hashtag = SUBSTRING(content, @pos + 1, @end - @pos - 1);
-                
-                -- Insert hashtag if it doesn't exist
-                INSERT IGNORE INTO hashtag (name) VALUES (@hashtag);
-                
-                -- Get hashtag_id
-                SET @hashtag_id = (SELECT hashtag_id FROM hashtag WHERE name = @hashtag);
-                
-                -- Insert into contains table
-                INSERT IGNORE INTO contains (post_id, hashtag_id) VALUES (post_id, @hashtag_id);
-                
-                SET @pos = @end;
-            END IF;
-        END WHILE;
-    END LOOP;
-    
-    CLOSE cur;
-END //
-
-DELIMITER ;
-
--- Execute the procedure
-CALL extract_hashtags_from_posts();
-
--- Clean up
-DROP PROCEDURE IF EXISTS extract_hashtags_from_posts; 
\ No newline at end of file
+INSERT IGNORE INTO contains (post_id, hashtag_id)
+WITH RECURSIVE seq (n) AS (
+    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+)
+SELECT p.post_id, h.hashtag_id
+FROM post p
+JOIN seq ON REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n) IS NOT NULL
+JOIN hashtag h ON h.name = SUBSTRING(REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n), 2, 50);
@@ -0,0 +1,95 @@
+from typing import Dict, Tuple
+
+from flask import current_app
+from markupsafe import Markup
+
+import db
+import metrics
+from cache import LRUCache
+
+# rendered fragment cache for tweet cards
+#
+# templates call {{ tweet_card(tweet) }} instead of including
+# tweet_card.html. the card is rendered once per post and version - the
+# fields it shows, so an entry can't outlive a reply, a media variant or
+# a cache TTL on the row - and kept as the html before and after the like
+# button. the like button is the only part that depends on the viewer;
+# like_button.html is rendered into the gap on every call.
+#
+# db.py reports posts whose likes or replies changed (db.on_posts_changed)
+# and their cards are dropped then. other processes notice the changed
+# version on their next render instead.
+
+# cards kept, and seconds before an unused card is rendered again
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_TTL = 600
+
+_SLOT = '<!--like-button-->'
+
+_cards = LRUCache(maxsize=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_TTL)
+_stats = {'hits': 0, 'misses': 0}
+
+
+# everything tweet_card.html shows apart from the like button
+def _version(tweet: Dict) -> Tuple:
+    return (tweet['username'], tweet['content'], tweet['created_at'], tweet['thread_id'],
+            tweet.get('reply_count'), tuple(tweet.get('media_urls') or ()))
+
+def _render_parts(tweet: Dict) -> Tuple[str, str]:
+    html = current_app.jinja_env.get_template('tweet_card.html').render(tweet=tweet, like_button=Markup(_SLOT))
+    head, _, tail = html.partition(_SLOT)
+    return head, tail
+
+# card html for one tweet, for the viewer of the current request
+# tc - tweet card
+def tweet_card(tweet: Dict) -> Markup:
+    button = current_app.jinja_env.get_template('like_button.html').render(tweet=tweet)
+    enabled = current_app.config['FRAGMENT_CACHE']
+    if enabled is None:
+        # read per render: app.run(debug=True) sets debug after init_app
+        enabled = not current_app.debug
+    if not enabled:
+        head, tail = _render_parts(tweet)
+        return Markup(head + button + tail)
+    version = _version(tweet)
+    cached = _cards.get(tweet['id'])
+    if cached is not None and cached[0] == version:
+        _stats['hits'] += 1
+        head, tail = cached[1], cached[2]
+    else:
+        _stats['misses'] += 1
+        head, tail = _render_parts(tweet)
+        _cards.set(tweet['id'], (version, head, tail))
+    return Markup(head + button + tail)
+
+# drop the cached cards of these posts
+# ic - invalidate cards
+def invalidate(*post_ids):
+    for post_id in post_ids:
+        _cards.delete(post_id)
+
+# hits, misses and size; a card whose version changed counts as a miss
+def stats() -> Dict:
+    stats = {**_cards.stats(), **_stats}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+metrics.callback_gauge(
+    'pinkbird_fragment_cache_lookups', 'Rendered tweet card lookups since start by result',
+    lambda: {(result,): stats()[result] for result in ('hits', 'misses')},
+    ('result',),
+)
+
+
+# make tweet_card() available to templates:
+#   FRAGMENT_CACHE       cache rendered cards; None (the default) turns it
+#                        off in debug mode, where templates reload when edited
+#   FRAGMENT_CACHE_SIZE  cards kept before the least recently used goes
+def init_app(app):
+    global _cards
+    app.config.setdefault('FRAGMENT_CACHE', None)
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE)
+    _cards = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'], ttl=FRAGMENT_TTL)
+    app.jinja_env.globals['tweet_card'] = tweet_card
+    db.on_posts_changed(invalidate)
@@ -0,0 +1,285 @@
+import contextvars
+import ipaddress
+import logging
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Optional
+
+import metrics
+
+# per-request database instrumentation
+#
+# every cursor db.py hands out is an InstrumentedCursor, which times each
+# statement and adds it to the QueryStats of the current context; the
+# pool reports connection opens and checkout waits the same way. init_app()
+# gives each flask request its own QueryStats and turns them into
+# response headers, prometheus metrics (see metrics.py) and a slow-query
+# log. statements run outside a request are only logged when slow.
+#
+# stats follow contextvars, so work handed to db.run_concurrently is
+# counted against the request that started it.
+
+slow_log = logging.getLogger('pinkbird.slow_queries')
+
+# statements slower than this many seconds are logged (None = never)
+SLOW_QUERY_SECONDS = 0.1
+
+# slow statements kept per request for the response headers
+MAX_SLOW_STATEMENTS = 10
+
+_current = contextvars.ContextVar('pinkbird_query_stats', default=None)
+
+
+class QueryStats:
+    def __init__(self, label: str = None):
+        self.label = label            # route the stats belong to, used in logs
+        self.queries = 0
+        self.db_time = 0.0            # seconds spent in execute/callproc
+        self.connects = 0
+        self.connect_time = 0.0       # seconds spent opening connections
+        self.checkouts = 0
+        self.wait_time = 0.0          # seconds spent waiting for a free connection
+        self.slow = []                # [(seconds, normalized sql)], slowest first
+        self._lock = threading.Lock()
+
+    def add_query(self, seconds: float, sql: str = None):
+        with self._lock:
+            self.queries += 1
+            self.db_time += seconds
+            if sql is not None:
+                self.slow.append((seconds, sql))
+                self.slow.sort(reverse=True)
+                del self.slow[MAX_SLOW_STATEMENTS:]
+
+    def add_connect(self, seconds: float):
+        with self._lock:
+            self.connects += 1
+            self.connect_time += seconds
+
+    def add_checkout(self, wait_seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += wait_seconds
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'queries': self.queries,
+                'db_time': self.db_time,
+                'connects': self.connects,
+                'connect_time': self.connect_time,
+                'checkouts': self.checkouts,
+                'wait_time': self.wait_time,
+                'slow': list(self.slow),
+            }
+
+
+# start collecting for the current context, returns a token for stop()
+def start(label: str = None) -> contextvars.Token:
+    return _current.set(QueryStats(label))
+
+def stop(token: contextvars.Token):
+    _current.reset(token)
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+# send slow statements to `path` as well, and/or change the threshold
+# csl - configure slow log
+def configure_slow_log(threshold: Optional[float] = SLOW_QUERY_SECONDS, path: str = None):
+    global SLOW_QUERY_SECONDS
+    SLOW_QUERY_SECONDS = threshold
+    if path and not any(getattr(handler, 'baseFilename', None) == path for handler in slow_log.handlers):
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_log.addHandler(handler)
+
+
+_LITERALS = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),                    # quoted strings
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),                        # numbers
+    (re.compile(r'%s'), '?'),                                       # placeholders
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?+)'),            # IN (?, ?, ...)
+    (re.compile(r'\(\?\+\)(?:\s*,\s*\(\?\+\))+'), '(?+)+'),         # VALUES (?, ?), (?, ?) ...
+    (re.compile(r'(?:SELECT \?(?: AS \w+)?(?:, \?(?: AS \w+)?)* UNION ALL )+SELECT \?(?:, \?)*'),
+     'SELECT ?+'),                                                  # rows of _values_table()
+]
+
+# sql with literals and placeholder lists collapsed, so every call of a
+# statement looks the same whatever its arguments
+# nsql - normalize sql
+@lru_cache(maxsize=2048)
+def normalize_sql(sql: str) -> str:
+    sql = ' '.join(sql.split())
+    for pattern, replacement in _LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+_queries = metrics.counter('pinkbird_db_queries_total', 'Statements sent to the database')
+_query_seconds = metrics.counter('pinkbird_db_query_seconds_total', 'Seconds spent running statements')
+_slow_queries = metrics.counter('pinkbird_db_slow_queries_total', 'Statements slower than the slow-query threshold')
+_connects = metrics.counter('pinkbird_db_connects_total', 'Database connections opened')
+_connect_seconds = metrics.counter('pinkbird_db_connect_seconds_total', 'Seconds spent opening database connections')
+
+# time one statement; called by InstrumentedCursor
+def record_query(sql: str, seconds: float):
+    stats = _current.get()
+    slow = SLOW_QUERY_SECONDS is not None and seconds >= SLOW_QUERY_SECONDS
+    normalized = normalize_sql(sql) if slow else None
+    if stats is not None:
+        stats.add_query(seconds, normalized)
+    _queries.inc()
+    _query_seconds.inc(seconds)
+    if slow:
+        _slow_queries.inc()
+        route = stats.label if stats is not None and stats.label else '-'
+        slow_log.warning('%.1fms %s %s', seconds * 1000, route, normalized)
+
+def record_connect(seconds: float):
+    stats = _current.get()
+    if stats is not None:
+        stats.add_connect(seconds)
+    _connects.inc()
+    _connect_seconds.inc(seconds)
+
+def record_checkout(wait_seconds: float):
+    stats = _current.get()
+    if stats is not None:
+        stats.add_checkout(wait_seconds)
+
+
+# cursor wrapper timing execute/executemany/callproc; everything else is
+# passed through. a multi=True execute returns a lazy iterator over the
+# results, so only the time to send the statements is counted for it
+class InstrumentedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, sql: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def execute(self, operation, params=(), **kwargs):
+        return self._timed(self._cursor.execute, operation, operation, params, **kwargs)
+
+    def executemany(self, operation, seq_params):
+        return self._timed(self._cursor.executemany, operation, operation, seq_params)
+
+    def callproc(self, procname, args=()):
+        return self._timed(self._cursor.callproc, f'CALL {procname}()', procname, args)
+
+
+# per-route request metrics
+_request_seconds = metrics.histogram(
+    'pinkbird_http_request_duration_seconds', 'Request latency by route',
+    ('route', 'method', 'status'),
+)
+_request_queries = metrics.histogram(
+    'pinkbird_http_request_db_queries', 'Database statements per request by route',
+    ('route',), buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+_request_db_seconds = metrics.histogram(
+    'pinkbird_http_request_db_seconds', 'Database time per request by route',
+    ('route',),
+)
+
+
+def _server_timing(stats: Dict) -> str:
+    return (f'db;dur={stats["db_time"] * 1000:.1f};desc="{stats["queries"]} queries", '
+            f'db-connect;dur={stats["connect_time"] * 1000:.1f}, '
+            f'db-wait;dur={stats["wait_time"] * 1000:.1f}')
+
+
+# whether a client address falls in one of the networks
+def _address_in(address: Optional[str], networks) -> bool:
+    try:
+        address = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+# wire per-request stats into a flask app:
+#   QUERY_STATS_HEADERS   add X-DB-* and Server-Timing headers to responses;
+#                         None (the default) adds them in debug mode
+#   SLOW_QUERY_SECONDS    slow-query threshold in seconds, None to turn off
+#   SLOW_QUERY_LOG        file slow statements are appended to
+#   METRICS_ENDPOINT      path of the prometheus endpoint, None to turn off
+#   METRICS_ALLOWED       addresses or networks that may read it, loopback
+#                         by default; None lets anyone in
+def init_app(app):
+    from flask import Response, abort, g, request
+
+    app.config.setdefault('QUERY_STATS_HEADERS', None)
+    app.config.setdefault('SLOW_QUERY_SECONDS', SLOW_QUERY_SECONDS)
+    app.config.setdefault('SLOW_QUERY_LOG', None)
+    app.config.setdefault('METRICS_ENDPOINT', '/metrics')
+    app.config.setdefault('METRICS_ALLOWED', ('127.0.0.1', '::1'))
+    configure_slow_log(app.config['SLOW_QUERY_SECONDS'], app.config['SLOW_QUERY_LOG'])
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats_token = start(request.endpoint)
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = current()
+        started = g.pop('request_started', None)
+        if stats is None or started is None:
+            return response
+        route = request.endpoint or 'unmatched'
+        if route == 'metrics':
+            return response
+        summary = stats.as_dict()
+        _request_seconds.observe(time.perf_counter() - started, route=route,
+                                 method=request.method, status=response.status_code)
+        _request_queries.observe(summary['queries'], route=route)
+        _request_db_seconds.observe(summary['db_time'], route=route)
+        headers = app.config['QUERY_STATS_HEADERS']
+        if headers is None:
+            # read per response: app.run(debug=True) sets debug after init_app
+            headers = app.debug
+        if headers:
+            response.headers['X-DB-Queries'] = str(summary['queries'])
+            response.headers['X-DB-Time-Ms'] = f'{summary["db_time"] * 1000:.1f}'
+            response.headers['X-DB-Connects'] = str(summary['connects'])
+            response.headers['X-DB-Connect-Ms'] = f'{summary["connect_time"] * 1000:.1f}'
+            if summary['slow']:
+                seconds, sql = summary['slow'][0]
+                response.headers['X-DB-Slowest'] = f'{seconds * 1000:.1f}ms {sql}'[:500]
+            response.headers.add('Server-Timing', _server_timing(summary))
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exc=None):
+        token = g.pop('query_stats_token', None)
+        if token is not None:
+            try:
+                stop(token)
+            except ValueError:
+                # teardown ran in a different context than before_request
+                pass
+
+    if app.config['METRICS_ENDPOINT']:
+        allowed = app.config['METRICS_ALLOWED']
+        if allowed is not None:
+            allowed = [ipaddress.ip_network(network, strict=False) for network in allowed]
+
+        @app.route(app.config['METRICS_ENDPOINT'], endpoint='metrics')
+        def metrics_endpoint():
+            if allowed is not None and not _address_in(request.remote_addr, allowed):
+                abort(403)
+            return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
@@ -1,8 +1,14 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, g
 import db as db
+import api
+import assets
+import fragments
+import instrumentation
+import media
+import migrate
+import click
 import functools
 import os
-from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 app.secret_key = 'pinkbird_secret_key'  # needed for flash messages
@@ -13,15 +19,95 @@ app.config['ALLOWED_IMAGE_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 # Create upload folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Helper function to check allowed file extensions
-def allowed_image_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_IMAGE_EXTENSIONS']
+# Serve fingerprinted static files once `flask build-assets` has run
+assets.init_app(app)
 
-# Make db module available to all templates
-@app.context_processor
-def inject_db():
-    return dict(db=db)
+# Count queries and DB time per request: X-DB-* / Server-Timing headers
+# (on in debug mode), a slow-query log and Prometheus metrics at /metrics
+app.config['QUERY_STATS_HEADERS'] = None  # None: only in debug mode
+app.config['SLOW_QUERY_SECONDS'] = 0.1
+app.config['SLOW_QUERY_LOG'] = None  # e.g. 'instance/slow-queries.log'
+app.config['METRICS_ENDPOINT'] = '/metrics'
+app.config['METRICS_ALLOWED'] = ('127.0.0.1', '::1')  # e.g. add '10.0.0.0/8' for a scraper
+instrumentation.init_app(app)
+
+# JSON versions of the timelines, threads and search, with ETag/304 for polling
+app.config['API_PREFIX'] = '/api/v1'
+api.init_app(app)
+
+# Render each tweet card once per version and reuse it across pages and
+# viewers; only the like button is rendered per viewer
+app.config['FRAGMENT_CACHE'] = None  # None: on unless running in debug mode
+app.config['FRAGMENT_CACHE_SIZE'] = 10000
+fragments.init_app(app)
+
+# Batch likes and follows in the background instead of writing them per
+# click; queued writes are journaled to WRITE_BEHIND_DIR until flushed
+app.config['WRITE_BEHIND'] = False
+app.config['WRITE_BEHIND_DIR'] = os.path.join(app.instance_path, 'write-behind')
+if app.config['WRITE_BEHIND']:
+    db.configure_write_behind(journal_dir=app.config['WRITE_BEHIND_DIR'])
+
+# Send reads to replicas (mysql configs like db.DB_CONFIG); a session reads
+# from the primary for DB_STICKY_SECONDS after it writes
+app.config['DB_REPLICAS'] = []
+app.config['DB_STICKY_SECONDS'] = 5.0
+if app.config['DB_REPLICAS']:
+    db.configure_replicas(*app.config['DB_REPLICAS'], sticky_seconds=app.config['DB_STICKY_SECONDS'])
+
+# Store an uploaded image under its content hash (see media.py);
+# returns None when there is no usable file
+def store_image(file):
+    return media.store_upload(file, app.config['UPLOAD_FOLDER'], app.config['ALLOWED_IMAGE_EXTENSIONS'])
+
+# Store a profile picture and queue its resized variants
+def store_profile_pic(file):
+    upload = store_image(file)
+    if upload:
+        media.process_async(upload)
+    return upload
+
+# Smallest adequate copy of an uploaded image, e.g. {{ user.profile_pic|variant('thumb') }}
+@app.template_filter('variant')
+def variant_filter(url, name=media.AVATAR_VARIANT):
+    return media.variant_url(url, name, app.static_folder)
+
+# Set is_liked on each tweet for the current user with a single query,
+# so templates never have to ask the database per card
+def attach_like_state(tweets):
+    liked = set()
+    if g.user and tweets:
+        liked = db.get_liked_post_ids(g.user['user_id'], [tweet['id'] for tweet in tweets])
+    for tweet in tweets:
+        tweet['is_liked'] = tweet['id'] in liked
+    return tweets
+
+# Set is_followed on each user row for the current user with a single query
+def attach_follow_state(users):
+    followed = set()
+    if g.user and users:
+        followed = db.get_followed_user_ids(g.user['user_id'], [user['user_id'] for user in users])
+    for user in users:
+        user['is_followed'] = user['user_id'] in followed
+    return users
+
+# Link to the next (older) page of a timeline, or None on the last page
+def next_page_url(tweets):
+    cursor = db.next_page_cursor(tweets, db.PAGE_SIZE)
+    if not cursor:
+        return None
+    args = dict(request.view_args or {})
+    args.update(request.args.to_dict())
+    args['before'] = cursor
+    return url_for(request.endpoint, **args)
+
+# Every tweet in a reply tree, parents before their replies
+def flatten_replies(tweets):
+    flat = []
+    for tweet in tweets:
+        flat.append(tweet)
+        flat.extend(flatten_replies(tweet.get('replies', [])))
+    return flat
 
 # Authentication decorator
 def login_required(view):
@@ -33,6 +119,28 @@ def login_required(view):
         return view(*args, **kwargs)
     return wrapped_view
 
+# Route this request's reads, on the primary if its session wrote recently
+@app.before_request
+def begin_db_routing():
+    g.db_routing = db.begin_routing(session.get('db_primary_until', 0))
+
+@app.after_request
+def keep_writer_on_primary(response):
+    primary_until = db.sticky_until()
+    if primary_until is not None:
+        session['db_primary_until'] = primary_until
+    return response
+
+@app.teardown_request
+def end_db_routing(exc=None):
+    token = g.pop('db_routing', None)
+    if token is not None:
+        try:
+            db.end_routing(token)
+        except ValueError:
+            # teardown ran in a different context than before_request
+            pass
+
 # Set current user for each request
 @app.before_request
 def load_logged_in_user():
@@ -46,8 +154,9 @@ def load_logged_in_user():
 @app.route('/')
 def index():
     if g.user:
-        tweets = db.get_feed_tweets(g.user['user_id'])
-        return render_template('index.html', tweets=tweets)
+        before = request.args.get('before')
+        tweets = attach_like_state(db.get_feed_tweets(g.user['user_id'], before=before))
+        return render_template('index.html', tweets=tweets, next_url=next_page_url(tweets))
     else:
         return render_template('welcome.html')
 
@@ -62,13 +171,9 @@ def register():
         
         # Handle profile picture upload
         profile_pic = None
-        if 'profile_pic' in request.files:
-            file = request.files['profile_pic']
-            if file.filename != '':
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                profile_pic = 'uploads/' + filename
+        upload = store_profile_pic(request.files.get('profile_pic'))
+        if upload:
+            profile_pic = upload.url
         
         success, message = db.create_user(username, email, password, bio, profile_pic)
         
@@ -108,27 +213,24 @@ def logout():
 # Profile page
 @app.route('/profile/<username>')
 def profile(username):
-    user = db.get_user_by_username(username)
+    before = request.args.get('before')
+    viewer_id = g.user['user_id'] if g.user else None
     
-    if not user:
+    # user, counts, follow state and the tweet page in one round trip
+    profile = db.get_profile(username, viewer_id, before=before)
+    
+    if not profile:
         flash('User not found', 'error')
         return redirect(url_for('index'))
     
-    tweets = db.get_user_tweets(user['user_id'])
-    follower_count = db.get_follower_count(user['user_id'])
-    following_count = db.get_following_count(user['user_id'])
-    
-    # Check if the logged-in user is following this profile
-    is_following = False
-    if g.user:
-        is_following = db.is_following(g.user['user_id'], user['user_id'])
-    
+    tweets = profile['tweets']
     return render_template('profile.html', 
-                          profile_user=user, 
+                          profile_user=profile['user'], 
                           tweets=tweets, 
-                          follower_count=follower_count, 
-                          following_count=following_count,
-                          is_following=is_following)
+                          follower_count=profile['follower_count'], 
+                          following_count=profile['following_count'],
+                          is_following=profile['is_following'],
+                          next_url=next_page_url(tweets))
 
 # Edit profile
 @app.route('/profile/edit', methods=['GET', 'POST'])
@@ -139,13 +241,9 @@ def edit_profile():
         
         # Handle profile picture upload
         profile_pic = g.user['profile_pic']
-        if 'profile_pic' in request.files:
-            file = request.files['profile_pic']
-            if file.filename != '':
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                profile_pic = 'uploads/' + filename
+        upload = store_profile_pic(request.files.get('profile_pic'))
+        if upload:
+            profile_pic = upload.url
         
         success = db.update_profile(g.user['user_id'], bio, profile_pic)
         
@@ -167,7 +265,7 @@ def followers(username):
         flash('User not found', 'error')
         return redirect(url_for('index'))
     
-    followers = db.get_followers(user['user_id'])
+    followers = attach_follow_state(db.get_followers(user['user_id']))
     
     return render_template('followers.html', profile_user=user, followers=followers)
 
@@ -180,7 +278,7 @@ def following(username):
         flash('User not found', 'error')
         return redirect(url_for('index'))
     
-    following = db.get_following(user['user_id'])
+    following = attach_follow_state(db.get_following(user['user_id']))
     
     return render_template('following.html', profile_user=user, following=following)
 
@@ -195,50 +293,49 @@ def post_tweet():
     if thread_id:
         thread_id = int(thread_id)
     
-    # Handle image upload
-    image_url = None
-    if 'image' in request.files:
-        file = request.files['image']
-        if file.filename != '' and allowed_image_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            image_url = 'uploads/' + filename
+    # Handle image upload - variants are queued once the media row exists
+    upload = store_image(request.files.get('image'))
     
     # call the db function which uses the stored procedure
     post_id = db.publish_tweet(g.user['user_id'], content, thread_id)
     
     # If we have an image, add it to the media table and link it to the post
-    if image_url:
-        db.add_media_to_post(post_id, image_url, 'image')
+    if upload:
+        db.add_media_to_post(post_id, upload.url, 'image', upload.content_hash)
+        media.process_async(upload, db.save_media_variants)
     
     if thread_id:
         return redirect(url_for('view_tweet', tweet_id=thread_id))
     
     return redirect(url_for('index'))
 
-# View a single tweet and its replies
+# View a single tweet with the conversation around it
 @app.route('/tweet/<int:tweet_id>')
 def view_tweet(tweet_id):
-    tweet = db.get_tweet(tweet_id)
+    conversation = db.get_conversation(tweet_id, after=request.args.get('after'))
     
-    if not tweet:
+    if not conversation:
         flash('Tweet not found', 'error')
         return redirect(url_for('index'))
     
-    replies = db.get_tweet_replies(tweet_id)
+    tweet = conversation['tweet']
     
-    # Check if the user has liked this tweet
-    is_liked = False
-    if g.user:
-        is_liked = db.is_post_liked(g.user['user_id'], tweet_id)
+    # Check like state for every tweet on the page in one go
+    attach_like_state(conversation['ancestors'] + flatten_replies([tweet]))
+    
+    next_url = None
+    if conversation['next_cursor']:
+        next_url = url_for('view_tweet', tweet_id=tweet_id, after=conversation['next_cursor'])
     
-    return render_template('tweet.html', tweet=tweet, replies=replies, is_liked=is_liked)
+    return render_template('tweet.html', tweet=tweet, ancestors=conversation['ancestors'],
+                           replies=conversation['replies'], is_liked=tweet['is_liked'],
+                           next_url=next_url)
 
 # Search route
 @app.route('/search')
 def search():
     query = request.args.get('q', '').strip()
+    before = request.args.get('before')
     
     if not query:
         return redirect(url_for('explore'))
@@ -246,17 +343,20 @@ def search():
     if query.startswith('#'):
         # Search for hashtag
         hashtag = query[1:]
-        tweets = db.search_tweets_by_hashtag(hashtag)
-        return render_template('search_results.html', query=query, tweets=tweets, hashtag=hashtag)
+        tweets = attach_like_state(db.search_tweets_by_hashtag(hashtag, before=before))
+        return render_template('search_results.html', query=query, tweets=tweets, hashtag=hashtag,
+                               next_url=next_page_url(tweets))
     elif query.startswith('@'):
         # Search for users
         username = query[1:]
-        users = db.search_users(username)
+        users = attach_follow_state(db.search_users(username))
         return render_template('search_results.html', query=query, users=users)
     else:
         # Search for tweets by content
-        tweets = db.search_tweets_by_content(query)
-        return render_template('search_results.html', query=query, tweets=tweets)
+        sort = 'recent' if request.args.get('sort') == 'recent' else 'relevance'
+        tweets = attach_like_state(db.search_tweets_by_content(query, before=before, sort=sort))
+        return render_template('search_results.html', query=query, tweets=tweets, sort=sort,
+                               next_url=next_page_url(tweets))
 
 # follow a user 
 @app.route('/follow', methods=['POST'])
@@ -314,11 +414,75 @@ def unlike():
     
     return redirect(request.referrer or url_for('index'))
 
+# Username suggestions for the search box, e.g. /search/users?q=pu
+@app.route('/search/users')
+def user_typeahead():
+    query = request.args.get('q', '').strip().lstrip('@')
+    if not query:
+        return jsonify([])
+    users = db.search_users(query, limit=8)
+    return jsonify([{'username': user['username'], 'profile_pic': user['profile_pic']} for user in users])
+
 # Explore page - show all tweets
 @app.route('/explore')
 def explore():
-    tweets = db.get_all_tweets()
-    return render_template('explore.html', tweets=tweets)
+    before = request.args.get('before')
+    tweets = attach_like_state(db.get_all_tweets(before=before))
+    trending = {window: db.get_trending_hashtags(window) for window in ('1h', '24h')}
+    return render_template('explore.html', tweets=tweets, trending=trending, next_url=next_page_url(tweets))
+
+# Apply pending schema migrations from migrations/: flask --app main migrate
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='List migrations and whether they are applied.')
+@click.option('--to', 'target', type=int, default=None, help='Stop after this version.')
+def migrate_command(status, target):
+    if status:
+        applied = migrate.applied_versions()
+        for migration in migrate.available():
+            applied_at = applied.get(migration.version)
+            print(f'{migration.version:04d} {migration.name:<40} {applied_at or "pending"}')
+        return
+    done = migrate.migrate(target)
+    for migration in done:
+        print(f'Applied {migration.version:04d} {migration.name}')
+    if not done:
+        print('Database is up to date')
+
+# Rebuild the user search trigram index: flask --app main rebuild-user-index
+@app.cli.command('rebuild-user-index')
+def rebuild_user_index_command():
+    count = db.rebuild_user_trigrams()
+    print(f'Indexed {count} user trigrams')
+
+# Rebuild stored like/reply/follow counters that drifted: flask --app main reconcile-counters
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    fixed = db.reconcile_post_counters()
+    print(f'Fixed counters on {fixed} posts')
+    fixed = db.reconcile_follow_counters()
+    print(f'Fixed follow counters on {fixed} users')
+
+# Make resized variants for uploads that have none yet, e.g. after the
+# media queue was full: flask --app main process-media
+@app.cli.command('process-media')
+def process_media_command():
+    processed = 0
+    for row in db.get_media_without_variants():
+        path = os.path.join(app.static_folder, row['file_url'])
+        if not os.path.exists(path):
+            continue
+        variants = media.make_variants(path, row['file_url'])
+        if variants and db.save_media_variants(row['content_hash'], variants):
+            processed += 1
+    print(f'Made variants for {processed} media files')
+
+# Fingerprint and precompress static files: flask --app main build-assets
+# (restart the app afterwards so it picks up the new manifest)
+@app.cli.command('build-assets')
+@click.option('--brotli/--no-brotli', default=True, help='Also write .br files (needs the brotli package).')
+def build_assets_command(brotli):
+    manifest = assets.build(app.static_folder, use_brotli=brotli)
+    print(f'Built {len(manifest)} static files into {assets.DIST_DIR}/')
 
 # start app
 if __name__ == '__main__':
@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # without Pillow uploads are stored but never resized
+    Image = ImageOps = None
+
+# upload pipeline for images
+#
+# uploads are streamed to disk under the sha256 of their bytes, so the
+# same picture uploaded twice is stored once and names never collide.
+# resized variants (a thumbnail and a web-sized copy) are made by a small
+# worker pool after the request has returned; until they exist pages
+# fall back to the original file.
+
+logger = logging.getLogger(__name__)
+
+# variant name -> longest edge in pixels
+VARIANTS = {
+    'thumb': 320,
+    'web': 1280,
+}
+
+# variant tweet cards show - the card is ~640 css px wide, so this covers 2x screens
+CARD_VARIANT = 'web'
+
+# variant used for profile pictures
+AVATAR_VARIANT = 'thumb'
+
+# bytes read from the upload per write
+CHUNK_SIZE = 64 * 1024
+
+JPEG_QUALITY = 82
+
+# worker threads making variants, and how many jobs may wait for one -
+# jobs beyond that are dropped and picked up by `flask process-media`
+MEDIA_WORKERS = 2
+MAX_PENDING = 64
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+# variant files already seen on disk, see variant_url()
+_known_variants = set()
+
+
+class StoredUpload(NamedTuple):
+    url: str            # path under static/, e.g. 'uploads/<hash>.jpg'
+    path: str           # file on disk
+    content_hash: str   # sha256 hex digest of the bytes
+    created: bool       # False when the same bytes were already stored
+
+
+# write an uploaded file into `folder` named by its content hash.
+# `file` is a werkzeug FileStorage (or anything with .stream and .filename)
+def save_upload(file, folder: str, url_prefix: str = 'uploads') -> StoredUpload:
+    extension = os.path.splitext(file.filename)[1].lower() or '.bin'
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        content_hash = digest.hexdigest()
+        filename = content_hash + extension
+        path = os.path.join(folder, filename)
+        created = not os.path.exists(path)
+        if created:
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return StoredUpload(f'{url_prefix}/{filename}', path, content_hash, created)
+
+
+# store an upload from a form when it is an image with one of the
+# `allowed` extensions, else None. variants are left to process_async(),
+# which a caller with a media row to fill queues once that row exists
+def store_upload(file, folder: str, allowed, url_prefix: str = 'uploads') -> Optional[StoredUpload]:
+    if not file or not file.filename or '.' not in file.filename:
+        return None
+    if file.filename.rsplit('.', 1)[1].lower() not in allowed:
+        return None
+    return save_upload(file, folder, url_prefix)
+
+
+def _variant_name(filename: str, variant: str) -> str:
+    stem, extension = os.path.splitext(filename)
+    # variants keep transparency as png, everything else becomes jpeg
+    extension = '.png' if extension == '.png' else '.jpg'
+    return f'{stem}_{variant}{extension}'
+
+
+# url of a variant next to the original at `url`
+def variant_path(url: str, variant: str) -> str:
+    folder, filename = os.path.split(url)
+    return os.path.join(folder, _variant_name(filename, variant)).replace(os.sep, '/')
+
+
+# make every variant of the image at `path`, skipping ones already on disk.
+# returns [{'variant', 'file_url', 'width', 'height'}] for the variants that
+# exist afterwards; animated and unreadable images get none
+def make_variants(path: str, url: str) -> List[Dict]:
+    if Image is None:
+        return []
+    made = []
+    with Image.open(path) as image:
+        if getattr(image, 'is_animated', False):
+            return []
+        image = ImageOps.exif_transpose(image)
+        for variant, edge in VARIANTS.items():
+            variant_url = variant_path(url, variant)
+            target = os.path.join(os.path.dirname(path), os.path.basename(variant_url))
+            if os.path.exists(target):
+                with Image.open(target) as existing:
+                    width, height = existing.size
+            else:
+                copy = image.copy()
+                copy.thumbnail((edge, edge), Image.LANCZOS)
+                tmp_path = target + '.tmp'
+                if target.endswith('.png'):
+                    copy.save(tmp_path, 'PNG', optimize=True)
+                else:
+                    copy.convert('RGB').save(tmp_path, 'JPEG', quality=JPEG_QUALITY,
+                                             optimize=True, progressive=True)
+                os.replace(tmp_path, target)
+                width, height = copy.size
+            made.append({'variant': variant, 'file_url': variant_url, 'width': width, 'height': height})
+    return made
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix='pinkbird-media')
+    return _executor
+
+# a forked worker gets its own threads
+def _reset_after_fork():
+    global _executor, _executor_lock, _pending
+    _executor = None
+    _executor_lock = threading.Lock()
+    _pending = threading.BoundedSemaphore(MAX_PENDING)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _process(upload: StoredUpload, on_done: Optional[Callable[[str, List[Dict]], None]]):
+    try:
+        variants = make_variants(upload.path, upload.url)
+        if variants and on_done is not None:
+            on_done(upload.content_hash, variants)
+    except Exception:
+        logger.exception('making variants of %s failed', upload.url)
+    finally:
+        _pending.release()
+
+
+# queue variant generation for a stored upload. on_done(content_hash,
+# variants) runs on the worker thread once the files exist. returns False
+# when the queue is full and the job was dropped
+def process_async(upload: StoredUpload,
+                  on_done: Optional[Callable[[str, List[Dict]], None]] = None) -> bool:
+    if Image is None:
+        return False
+    if not _pending.acquire(blocking=False):
+        logger.warning('media queue full, not processing %s', upload.url)
+        return False
+    try:
+        _get_executor().submit(_process, upload, on_done)
+    except BaseException:
+        _pending.release()
+        raise
+    return True
+
+
+# wait for queued jobs to finish, e.g. before exiting a script
+def drain():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+# url of `variant` when its file has been made, else `url` itself.
+# `static_folder` is where urls are resolved from; positive answers are
+# remembered since variant files are never deleted
+def variant_url(url: Optional[str], variant: str, static_folder: str) -> Optional[str]:
+    if not url:
+        return url
+    candidate = variant_path(url, variant)
+    if candidate in _known_variants:
+        return candidate
+    if os.path.exists(os.path.join(static_folder, candidate)):
+        _known_variants.add(candidate)
+        return candidate
+    return url
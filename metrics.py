@@ -0,0 +1,157 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# a small prometheus client: counters, histograms and callback gauges
+# with labels, rendered in the text exposition format for /metrics.
+#
+# values live in this process only. under a multi-process server every
+# worker answers scrapes with its own numbers, so scrape each worker (or
+# run one process per port) and sum in prometheus.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a fast cache hit to a request that should have timed out
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Labels:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {_format_value(counts[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+# a gauge read at scrape time: `collect` returns {label values: value}
+class CallbackGauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], Dict[Labels, float]],
+                 labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self.collect().items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    # add a metric, or get the one already registered under its name
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics: List[_Metric] = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback_gauge(name: str, documentation: str, collect: Callable[[], Dict[Labels, float]],
+                   labelnames: Sequence[str] = ()) -> CallbackGauge:
+    return REGISTRY.register(CallbackGauge(name, documentation, collect, labelnames))
@@ -0,0 +1,152 @@
+import logging
+import os
+import re
+from typing import Dict, List, NamedTuple
+
+import db
+
+# versioned schema migrations
+#
+# each change to the schema of a running database is a numbered file in
+# migrations/, e.g. 0002_add_post_language.sql. migrate() runs the files
+# whose versions are not yet in the schema_migrations table, in order,
+# and records each one as it finishes. nothing runs on import - deploys
+# run `flask --app main migrate` before starting the new workers.
+#
+# a file is plain SQL like setup.sql, DELIMITER lines included. a file
+# named NNNN_name.mysql.sql or NNNN_name.sqlite.sql is only run on that
+# engine and replaces NNNN_name.sql there; a version with no file for
+# the engine is recorded as applied without running anything.
+#
+# setup.sql and setup_sqlite.sql always hold the current schema and mark
+# every migration as applied, so a fresh database starts up to date. add
+# the change there as well as in the migration, and its version to the
+# INSERT INTO schema_migrations at the end of their schema sections.
+#
+# mysql commits DDL as it goes, so a migration that fails halfway leaves
+# its earlier statements applied and is not recorded. write migrations
+# that can be re-run (IF EXISTS / IF NOT EXISTS) where the engine allows.
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# seconds to wait for another process running migrations (mysql)
+LOCK_TIMEOUT = 60
+
+_FILE_NAME = re.compile(r'^(\d+)_(\w+?)(?:\.(mysql|sqlite))?\.sql$')
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    path: str
+
+
+# migrations in MIGRATIONS_DIR for an engine, oldest first
+def available(engine: str = None, directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    engine = engine or db.get_backend().name
+    found = {}
+    for file_name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        match = _FILE_NAME.match(file_name)
+        if not match:
+            continue
+        version, name, only_on = int(match.group(1)), match.group(2), match.group(3)
+        if only_on not in (None, engine):
+            found.setdefault(version, Migration(version, name, None))
+            continue
+        if only_on is None and version in found and found[version].path is not None:
+            continue  # an engine-specific file wins over the generic one
+        found[version] = Migration(version, name, os.path.join(directory, file_name))
+    return [found[version] for version in sorted(found)]
+
+
+# split a script into statements, following DELIMITER lines like the
+# mysql client; comment lines between statements are dropped
+def split_statements(script: str) -> List[str]:
+    statements, current, delimiter = [], [], ';'
+    for line in script.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.upper().startswith('DELIMITER'):
+            delimiter = stripped.split()[1]
+            continue
+        if not current and (not stripped or stripped.startswith('--')):
+            continue
+        current.append(line)
+        if stripped.endswith(delimiter):
+            statement = ''.join(current).rstrip()[:-len(delimiter)].strip()
+            if statement:
+                statements.append(statement)
+            current = []
+    if current and ''.join(current).strip():
+        statements.append(''.join(current).strip())
+    return statements
+
+
+def _ensure_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+# {version: applied_at} of the migrations recorded in the database
+# av - applied versions
+def applied_versions() -> Dict[int, object]:
+    with db.get_conn() as conn:
+        cursor = conn.cursor(dictionary=True)
+        _ensure_table(cursor)
+        conn.commit()
+        cursor.execute('SELECT version, applied_at FROM schema_migrations')
+        applied = {row['version']: row['applied_at'] for row in cursor.fetchall()}
+        cursor.close()
+    return applied
+
+# migrations not yet applied to the database
+def pending(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    applied = applied_versions()
+    return [migration for migration in available(directory=directory) if migration.version not in applied]
+
+# apply pending migrations up to `target` (default: all), oldest first.
+# returns the migrations applied
+def migrate(target: int = None, directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    conn = db.get_conn()
+    cursor = conn.cursor()
+    mysql = db.get_backend().name == 'mysql'
+    locked = False
+    done = []
+    try:
+        if mysql:
+            # one runner at a time when several hosts deploy together
+            cursor.execute('SELECT GET_LOCK(%s, %s)', ('pinkbird_migrate', LOCK_TIMEOUT))
+            if cursor.fetchone()[0] != 1:
+                raise RuntimeError('Another process is running migrations')
+            locked = True
+        _ensure_table(cursor)
+        conn.commit()
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cursor.fetchall()}
+        for migration in available(directory=directory):
+            if migration.version in applied or (target is not None and migration.version > target):
+                continue
+            logger.info('applying migration %04d %s', migration.version, migration.name)
+            if migration.path is not None:
+                with open(migration.path) as f:
+                    for statement in split_statements(f.read()):
+                        cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                           (migration.version, migration.name))
+            conn.commit()
+            done.append(migration)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if locked:
+            cursor.execute('SELECT RELEASE_LOCK(%s)', ('pinkbird_migrate',))
+            cursor.fetchall()
+        cursor.close()
+        conn.close()
+    return done
@@ -0,0 +1,3 @@
+-- hashtags are extracted once, in db.publish_tweet; the old
+-- extract_hashtags trigger would insert every tag a second time
+DROP TRIGGER IF EXISTS extract_hashtags;
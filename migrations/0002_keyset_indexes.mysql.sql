@@ -0,0 +1,4 @@
+-- indexes for newest-first timeline pages (keyset on created_at, post_id).
+-- sqlite databases have always had them (setup_sqlite.sql)
+CREATE INDEX idx_post_created ON post (created_at, post_id);
+CREATE INDEX idx_post_user_created ON post (user_id, created_at, post_id);
@@ -0,0 +1,10 @@
+-- like and reply counts stored on post, kept in step by db.like_post,
+-- db.unlike_post and db.publish_tweet
+ALTER TABLE post
+    ADD COLUMN like_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN reply_count INT NOT NULL DEFAULT 0;
+
+-- backfill; `flask reconcile-counters` redoes this in small batches
+UPDATE post p SET
+    p.like_count = (SELECT COUNT(*) FROM likes l WHERE l.post_id = p.post_id),
+    p.reply_count = (SELECT COUNT(*) FROM replies r WHERE r.post_id = p.post_id);
@@ -0,0 +1,9 @@
+-- follower and following counts stored on user, kept in step by
+-- db.follow_user and db.unfollow_user
+ALTER TABLE user
+    ADD COLUMN follower_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN following_count INT NOT NULL DEFAULT 0;
+
+UPDATE user u SET
+    u.follower_count = (SELECT COUNT(*) FROM follows f WHERE f.following_id = u.user_id),
+    u.following_count = (SELECT COUNT(*) FROM follows f WHERE f.follower_id = u.user_id);
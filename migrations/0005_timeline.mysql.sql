@@ -0,0 +1,39 @@
+-- materialized home timelines (fan-out on write, see db.py)
+ALTER TABLE user ADD COLUMN fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE INDEX idx_follows_following ON follows (following_id, follower_id);
+
+CREATE TABLE IF NOT EXISTS timeline (
+    user_id VARCHAR(36),
+    post_id INT,
+    author_id VARCHAR(36) NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, created_at, post_id),
+    UNIQUE KEY uq_timeline_post (user_id, post_id),
+    KEY idx_timeline_author (user_id, author_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE
+);
+
+-- accounts above db.FANOUT_LIMIT followers are merged in on read
+UPDATE user SET fanout_on_read = TRUE WHERE follower_count > 10000;
+
+-- every reader gets their own and followed accounts' latest posts,
+-- db.TIMELINE_BACKFILL (200) of them, like db.rebuild_timeline
+INSERT IGNORE INTO timeline (user_id, post_id, author_id, created_at)
+SELECT user_id, post_id, author_id, created_at
+FROM (
+    SELECT src.user_id, src.post_id, src.author_id, src.created_at,
+           ROW_NUMBER() OVER (PARTITION BY src.user_id
+                              ORDER BY src.created_at DESC, src.post_id DESC) AS n
+    FROM (
+        SELECT p.user_id, p.post_id, p.user_id AS author_id, p.created_at
+        FROM post p
+        UNION ALL
+        SELECT f.follower_id, p.post_id, p.user_id, p.created_at
+        FROM follows f
+        JOIN user a ON a.user_id = f.following_id AND NOT a.fanout_on_read
+        JOIN post p ON p.user_id = f.following_id
+    ) src
+) ranked
+WHERE n <= 200;
@@ -0,0 +1,2 @@
+-- full-text index for content search; sqlite uses the post_fts table
+CREATE FULLTEXT INDEX ft_post_content ON post (content);
@@ -0,0 +1,20 @@
+-- every lowercase 3-character slice of a username/email, for substring
+-- search (db.search_users); db.create_user adds the rows of new users
+CREATE TABLE IF NOT EXISTS user_trigram (
+    trigram CHAR(3) COLLATE utf8mb4_bin,
+    user_id VARCHAR(36),
+    PRIMARY KEY (trigram, user_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
+);
+
+INSERT IGNORE INTO user_trigram (trigram, user_id)
+WITH RECURSIVE seq (n) AS (
+    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+)
+SELECT LOWER(SUBSTRING(src.text, seq.n, 3)), src.user_id
+FROM (
+    SELECT user_id, username AS text FROM user
+    UNION ALL
+    SELECT user_id, email FROM user
+) src
+JOIN seq ON seq.n <= CHAR_LENGTH(src.text) - 2;
@@ -0,0 +1,21 @@
+-- hashtag names compare case-insensitively: #Coffee = #coffee.
+-- a database whose default collation was case-sensitive can hold both
+-- spellings, so posts are moved to the oldest one and the rest dropped
+-- before the unique index is rebuilt. tags are [A-Za-z0-9_], so LOWER()
+-- folds them the way the new collation does
+INSERT IGNORE INTO contains (post_id, hashtag_id)
+SELECT c.post_id, keep.hashtag_id
+FROM contains c
+JOIN hashtag h ON h.hashtag_id = c.hashtag_id
+JOIN (
+    SELECT LOWER(name) AS folded, MIN(hashtag_id) AS hashtag_id FROM hashtag GROUP BY LOWER(name)
+) keep ON keep.folded = LOWER(h.name)
+WHERE c.hashtag_id <> keep.hashtag_id;
+
+DELETE h FROM hashtag h
+JOIN (
+    SELECT LOWER(name) AS folded, MIN(hashtag_id) AS hashtag_id FROM hashtag GROUP BY LOWER(name)
+) keep ON keep.folded = LOWER(h.name)
+WHERE h.hashtag_id <> keep.hashtag_id;
+
+ALTER TABLE hashtag MODIFY name VARCHAR(50) COLLATE utf8mb4_0900_ai_ci NOT NULL;
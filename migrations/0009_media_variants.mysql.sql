@@ -0,0 +1,16 @@
+-- uploads are stored once per content hash and resized in the
+-- background. files uploaded before this keep a NULL hash and are
+-- shown at their original size
+ALTER TABLE media
+    ADD COLUMN content_hash CHAR(64) NULL,
+    ADD UNIQUE KEY uq_media_content_hash (content_hash);
+
+CREATE TABLE IF NOT EXISTS media_variant (
+    media_id INT,
+    variant VARCHAR(20) NOT NULL,
+    file_url VARCHAR(255) NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    PRIMARY KEY (media_id, variant),
+    FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
+);
@@ -8,7 +8,10 @@ CREATE TABLE user (
     username VARCHAR(50) UNIQUE NOT NULL,
     email VARCHAR(100) UNIQUE NOT NULL,
     bio TEXT,
-    profile_pic VARCHAR(255)
+    profile_pic VARCHAR(255),
+    follower_count INT NOT NULL DEFAULT 0,   -- kept in step by db.follow_user/unfollow_user
+    following_count INT NOT NULL DEFAULT 0,
+    fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE  -- big accounts: merge into feeds on read
 );
 CREATE TABLE IF NOT EXISTS user_auth (user_id VARCHAR(36), password_hash VARCHAR(255), PRIMARY KEY (user_id), FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE);
 
@@ -19,21 +22,43 @@ CREATE TABLE post (
     content TEXT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     thread_id INT,
+    like_count INT NOT NULL DEFAULT 0,   -- kept in step by db.like_post/unlike_post
+    reply_count INT NOT NULL DEFAULT 0,  -- kept in step by db.publish_tweet
     FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
     FOREIGN KEY (thread_id) REFERENCES post(post_id) ON DELETE CASCADE
 );
 
+-- indexes for newest-first timeline pages (keyset on created_at, post_id)
+CREATE INDEX idx_post_created ON post (created_at, post_id);
+CREATE INDEX idx_post_user_created ON post (user_id, created_at, post_id);
+
+-- full-text index for content search (maintained by InnoDB on every insert)
+CREATE FULLTEXT INDEX ft_post_content ON post (content);
+
 -- Hashtag Table
 CREATE TABLE hashtag (
     hashtag_id INT AUTO_INCREMENT PRIMARY KEY,
-    name VARCHAR(50) UNIQUE NOT NULL
+    name VARCHAR(50) COLLATE utf8mb4_0900_ai_ci UNIQUE NOT NULL  -- case-insensitive: #Coffee = #coffee
 );
 
 -- Media Table
 CREATE TABLE media (
     media_id INT AUTO_INCREMENT PRIMARY KEY,
     file_url VARCHAR(255) NOT NULL,
-    media_type VARCHAR(50) NOT NULL
+    media_type VARCHAR(50) NOT NULL,
+    content_hash CHAR(64) NULL,  -- sha256 of the upload, one row per distinct file
+    UNIQUE KEY uq_media_content_hash (content_hash)
+);
+
+-- Resized copies of a media file (thumb, web, ...)
+CREATE TABLE media_variant (
+    media_id INT,
+    variant VARCHAR(20) NOT NULL,
+    file_url VARCHAR(255) NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    PRIMARY KEY (media_id, variant),
+    FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
 );
 
 -- Follows Table
@@ -45,6 +70,7 @@ CREATE TABLE follows (
     FOREIGN KEY (follower_id) REFERENCES user(user_id) ON DELETE CASCADE,
     FOREIGN KEY (following_id) REFERENCES user(user_id) ON DELETE CASCADE
 );
+CREATE INDEX idx_follows_following ON follows (following_id, follower_id);
 
 -- Likes Table
 CREATE TABLE likes (
@@ -83,6 +109,47 @@ CREATE TABLE hasmedia (
     FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
 );
 
+-- User Trigram Table
+-- every lowercase 3-character slice of a username/email, for substring search
+CREATE TABLE user_trigram (
+    trigram CHAR(3) COLLATE utf8mb4_bin,
+    user_id VARCHAR(36),
+    PRIMARY KEY (trigram, user_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
+);
+
+-- Timeline Table
+-- materialized home feed: one row per (reader, post), filled on publish/follow
+CREATE TABLE timeline (
+    user_id VARCHAR(36),
+    post_id INT,
+    author_id VARCHAR(36) NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, created_at, post_id),
+    UNIQUE KEY uq_timeline_post (user_id, post_id),
+    KEY idx_timeline_author (user_id, author_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE
+);
+
+-- Applied schema migrations (see migrate.py); this file is the current
+-- schema, so a fresh database starts with every migration applied
+CREATE TABLE schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO schema_migrations (version, name) VALUES
+    (1, 'drop_hashtag_trigger'),
+    (2, 'keyset_indexes'),
+    (3, 'post_counters'),
+    (4, 'follow_counters'),
+    (5, 'timeline'),
+    (6, 'post_fulltext'),
+    (7, 'user_trigram'),
+    (8, 'hashtag_collation'),
+    (9, 'media_variants');
+
 -- ========================
 -- STORED PROCEDURES
 -- ========================
@@ -299,56 +366,6 @@ BEGIN
 END //
 DELIMITER ;
 
--- ========================
--- TRIGGERS
--- ========================
-
--- trigger to extract hashtags from post content
--- eht - extract hashtags trigger
-DELIMITER //
-CREATE TRIGGER extract_hashtags AFTER INSERT ON post
-FOR EACH ROW
-BEGIN
-    DECLARE hashtag_text VARCHAR(50);
-    DECLARE content_copy TEXT;
-    DECLARE space_pos INT;
-    DECLARE hashtag_id_val INT;
-    
-    -- copy content for processing
-    SET content_copy = CONCAT(' ', NEW.content, ' ');
-    
-    -- find hashtags - simple extraction logic
-    WHILE content_copy REGEXP '#[a-zA-Z0-9_]+' DO
-        -- extract the hashtag
-        SET hashtag_text = SUBSTRING_INDEX(SUBSTRING_INDEX(content_copy, '#', 2), ' ', -1);
-        
-        -- trim any punctuation that might follow the hashtag
-        SET space_pos = LOCATE(' ', hashtag_text);
-        IF space_pos > 0 THEN
-            SET hashtag_text = SUBSTRING(hashtag_text, 1, space_pos - 1);
-        END IF;
-        
-        -- clean up hashtag text by removing '#'
-        SET hashtag_text = TRIM(REPLACE(hashtag_text, '#', ''));
-        
-        -- if hashtag exists, get its id
-        IF hashtag_text != '' THEN
-            -- insert hashtag if it doesn't exist
-            INSERT IGNORE INTO hashtag (name) VALUES (hashtag_text);
-            
-            -- get the hashtag id
-            SELECT hashtag_id INTO hashtag_id_val FROM hashtag WHERE name = hashtag_text LIMIT 1;
-            
-            -- link post to hashtag
-            INSERT IGNORE INTO contains (post_id, hashtag_id) VALUES (NEW.post_id, hashtag_id_val);
-        END IF;
-        
-        -- remove processed hashtag from content copy to avoid infinite loop
-        SET content_copy = REPLACE(content_copy, CONCAT('#', hashtag_text), '');
-    END WHILE;
-END //
-DELIMITER ;
-
 -- Sample Data Insertions
 INSERT INTO user (user_id, username, email, bio, profile_pic) VALUES
 ('123', 'Nishitai3', 'nishita@gmail.com', 'i love coffee', 'pic123.jpg'),
@@ -362,8 +379,23 @@ INSERT INTO post (user_id, content, created_at, thread_id) VALUES
 ('564', 'that coffee place is my favorite too! #coffee', '2025-04-01 23:26:53', 1),
 ('123', 'let me know how your recipe turns out! #recipe #books', '2025-04-01 23:26:53', 2);
 
--- The hashtag table will be populated by trigger
--- Contains table will be filled by trigger
+-- Extract hashtags from the sample posts (same pattern as db.extract_hashtags)
+INSERT IGNORE INTO hashtag (name)
+WITH RECURSIVE seq (n) AS (
+    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+)
+SELECT SUBSTRING(REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n), 2, 50)
+FROM post p
+JOIN seq ON REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n) IS NOT NULL;
+
+INSERT IGNORE INTO contains (post_id, hashtag_id)
+WITH RECURSIVE seq (n) AS (
+    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+)
+SELECT p.post_id, h.hashtag_id
+FROM post p
+JOIN seq ON REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n) IS NOT NULL
+JOIN hashtag h ON h.name = SUBSTRING(REGEXP_SUBSTR(p.content, '#[A-Za-z0-9_]+', 1, seq.n), 2, 50);
 
 INSERT INTO media (file_url, media_type) VALUES
 ('coffee_shop.jpg', 'image'),
@@ -379,4 +411,32 @@ INSERT INTO likes (user_id, post_id) VALUES
 INSERT INTO hasmedia (post_id, media_id) VALUES
 (1, 1), (2, 2);
 
+-- Set stored counters for the sample posts
+UPDATE post p SET
+    p.like_count = (SELECT COUNT(*) FROM likes l WHERE l.post_id = p.post_id),
+    p.reply_count = (SELECT COUNT(*) FROM replies r WHERE r.post_id = p.post_id);
 
+-- Index the sample users for substring search
+INSERT IGNORE INTO user_trigram (trigram, user_id)
+WITH RECURSIVE seq (n) AS (
+    SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < 100
+)
+SELECT LOWER(SUBSTRING(src.text, seq.n, 3)), src.user_id
+FROM (
+    SELECT user_id, username AS text FROM user
+    UNION ALL
+    SELECT user_id, email FROM user
+) src
+JOIN seq ON seq.n <= CHAR_LENGTH(src.text) - 2;
+
+-- Set stored follow counters for the sample users
+UPDATE user u SET
+    u.follower_count = (SELECT COUNT(*) FROM follows f WHERE f.following_id = u.user_id),
+    u.following_count = (SELECT COUNT(*) FROM follows f WHERE f.follower_id = u.user_id);
+
+-- Fill home timelines for the sample posts (own posts + followed accounts)
+INSERT IGNORE INTO timeline (user_id, post_id, author_id, created_at)
+SELECT p.user_id, p.post_id, p.user_id, p.created_at FROM post p
+UNION ALL
+SELECT f.follower_id, p.post_id, p.user_id, p.created_at
+FROM post p JOIN follows f ON f.following_id = p.user_id;
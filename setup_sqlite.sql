@@ -0,0 +1,163 @@
+-- schema for the embedded SQLite backend (see backends.py), the same
+-- tables and indexes as setup.sql. the stored procedures and functions
+-- there are run as plain statements by backends.SQLiteCursor.callproc,
+-- and post_fts stands in for the FULLTEXT index on post.content.
+-- backends.SQLiteBackend applies this file to an empty database file.
+
+CREATE TABLE user (
+    user_id VARCHAR(36) PRIMARY KEY,
+    username VARCHAR(50) COLLATE NOCASE UNIQUE NOT NULL,
+    email VARCHAR(100) COLLATE NOCASE UNIQUE NOT NULL,
+    bio TEXT,
+    profile_pic VARCHAR(255),
+    follower_count INT NOT NULL DEFAULT 0,
+    following_count INT NOT NULL DEFAULT 0,
+    fanout_on_read BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE user_auth (
+    user_id VARCHAR(36) PRIMARY KEY,
+    password_hash VARCHAR(255),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
+);
+
+-- INTEGER PRIMARY KEY makes post_id the rowid, AUTOINCREMENT never reuses ids
+CREATE TABLE post (
+    post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id VARCHAR(36),
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    thread_id INT,
+    like_count INT NOT NULL DEFAULT 0,
+    reply_count INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (thread_id) REFERENCES post(post_id) ON DELETE CASCADE
+);
+
+CREATE INDEX idx_post_created ON post (created_at, post_id);
+CREATE INDEX idx_post_user_created ON post (user_id, created_at, post_id);
+
+-- external-content full-text index over post.content, kept in step by triggers
+CREATE VIRTUAL TABLE post_fts USING fts5(content, content='post', content_rowid='post_id');
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN
+    INSERT INTO post_fts (rowid, content) VALUES (new.post_id, new.content);
+END;
+
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN
+    INSERT INTO post_fts (post_fts, rowid, content) VALUES ('delete', old.post_id, old.content);
+END;
+
+CREATE TRIGGER post_fts_update AFTER UPDATE OF content ON post BEGIN
+    INSERT INTO post_fts (post_fts, rowid, content) VALUES ('delete', old.post_id, old.content);
+    INSERT INTO post_fts (rowid, content) VALUES (new.post_id, new.content);
+END;
+
+CREATE TABLE hashtag (
+    hashtag_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name VARCHAR(50) COLLATE NOCASE UNIQUE NOT NULL
+);
+
+CREATE TABLE media (
+    media_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_url VARCHAR(255) NOT NULL,
+    media_type VARCHAR(50) NOT NULL,
+    content_hash CHAR(64) NULL UNIQUE
+);
+
+CREATE TABLE media_variant (
+    media_id INT,
+    variant VARCHAR(20) NOT NULL,
+    file_url VARCHAR(255) NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    PRIMARY KEY (media_id, variant),
+    FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE TABLE follows (
+    follower_id VARCHAR(36),
+    following_id VARCHAR(36),
+    followed_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    PRIMARY KEY (follower_id, following_id),
+    FOREIGN KEY (follower_id) REFERENCES user(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (following_id) REFERENCES user(user_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX idx_follows_following ON follows (following_id, follower_id);
+
+CREATE TABLE likes (
+    user_id VARCHAR(36),
+    post_id INT,
+    liked_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+    PRIMARY KEY (user_id, post_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+-- mysql indexes foreign keys by itself, sqlite needs these for the cascades
+CREATE INDEX idx_likes_post ON likes (post_id);
+
+CREATE TABLE replies (
+    post_id INT,
+    reply_id INT,
+    PRIMARY KEY (post_id, reply_id),
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE,
+    FOREIGN KEY (reply_id) REFERENCES post(post_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX idx_replies_reply ON replies (reply_id);
+
+CREATE TABLE contains (
+    post_id INT,
+    hashtag_id INT,
+    PRIMARY KEY (post_id, hashtag_id),
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE,
+    FOREIGN KEY (hashtag_id) REFERENCES hashtag(hashtag_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX idx_contains_hashtag ON contains (hashtag_id);
+
+CREATE TABLE hasmedia (
+    post_id INT,
+    media_id INT,
+    PRIMARY KEY (post_id, media_id),
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE,
+    FOREIGN KEY (media_id) REFERENCES media(media_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX idx_hasmedia_media ON hasmedia (media_id);
+
+CREATE TABLE user_trigram (
+    trigram CHAR(3),
+    user_id VARCHAR(36),
+    PRIMARY KEY (trigram, user_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX idx_user_trigram_user ON user_trigram (user_id);
+
+CREATE TABLE timeline (
+    user_id VARCHAR(36),
+    post_id INT,
+    author_id VARCHAR(36) NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, created_at, post_id),
+    UNIQUE (user_id, post_id),
+    FOREIGN KEY (user_id) REFERENCES user(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (post_id) REFERENCES post(post_id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE INDEX idx_timeline_author ON timeline (user_id, author_id);
+CREATE INDEX idx_timeline_post ON timeline (post_id);
+
+-- applied schema migrations (see migrate.py); this file is the current
+-- schema, so a fresh database starts with every migration applied
+CREATE TABLE schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    applied_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+);
+INSERT INTO schema_migrations (version, name) VALUES
+    (1, 'drop_hashtag_trigger'),
+    (2, 'keyset_indexes'),
+    (3, 'post_counters'),
+    (4, 'follow_counters'),
+    (5, 'timeline'),
+    (6, 'post_fulltext'),
+    (7, 'user_trigram'),
+    (8, 'hashtag_collation'),
+    (9, 'media_variants');
@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the suite runs on the embedded SQLite backend, so it needs no server.
+# set before db.py is imported: main.py connects while it is loaded
+_DEFAULT_DB = os.path.join(tempfile.mkdtemp(prefix='pinkbird-tests-'), 'import.db')
+os.environ['PINKBIRD_BACKEND'] = 'sqlite'
+os.environ['PINKBIRD_SQLITE_PATH'] = _DEFAULT_DB
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+# a fresh database file and empty object caches for every test
+@pytest.fixture(autouse=True)
+def database(tmp_path):
+    db.configure_write_behind(enabled=False)
+    db.configure_backend('sqlite', path=str(tmp_path / 'pinkbird.db'))
+    db.configure_cache(db.LRUCache(db.CACHE_SIZE, db.CACHE_TTL))
+    yield
+    db.configure_write_behind(enabled=False)
+
+
+# create a user and return its row, e.g. make_user('alice')
+@pytest.fixture
+def make_user():
+    def make(username, password='password'):
+        success, message = db.create_user(username, f'{username}@example.com', password)
+        assert success, message
+        return db.get_user_by_username(username)
+    return make
+
+
+@pytest.fixture
+def app():
+    import main
+    main.app.config['TESTING'] = True
+    return main.app
+
+
+# a test client logged in as `user`
+@pytest.fixture
+def login(app):
+    def log_in(user, password='password'):
+        client = app.test_client()
+        response = client.post('/login', data={'username_or_email': user['username'], 'password': password})
+        assert response.status_code == 302
+        return client
+    return log_in
@@ -0,0 +1,77 @@
+import db
+
+
+def _poll(client, url, etag):
+    return client.get(url, headers={'If-None-Match': etag})
+
+
+def test_explore_answers_304_until_something_changes(make_user, login):
+    alice, bob = make_user('alice'), make_user('bob')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    client = login(bob)
+
+    first = client.get('/api/v1/explore')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert [t['id'] for t in first.json['tweets']] == [post_id]
+
+    unchanged = _poll(client, '/api/v1/explore', etag)
+    assert unchanged.status_code == 304
+    assert unchanged.data == b''
+
+    db.like_post(alice['user_id'], post_id)
+    liked = _poll(client, '/api/v1/explore', etag)
+    assert liked.status_code == 200
+    assert liked.json['tweets'][0]['like_count'] == 1
+
+    etag = liked.headers['ETag']
+    newer = db.publish_tweet(alice['user_id'], 'newer')
+    published = _poll(client, '/api/v1/explore', etag)
+    assert published.status_code == 200
+    assert published.json['tweets'][0]['id'] == newer
+
+
+def test_a_304_skips_the_page_query(make_user, login, app):
+    alice = make_user('alice')
+    db.publish_tweet(alice['user_id'], 'hello')
+    app.config['QUERY_STATS_HEADERS'] = True
+    try:
+        client = login(alice)
+        full = client.get('/api/v1/feed')
+        cached = _poll(client, '/api/v1/feed', full.headers['ETag'])
+    finally:
+        app.config['QUERY_STATS_HEADERS'] = None
+    assert cached.status_code == 304
+    assert int(cached.headers['X-DB-Queries']) < int(full.headers['X-DB-Queries'])
+
+
+def test_etag_depends_on_the_viewer(make_user, login):
+    alice, bob = make_user('alice'), make_user('bob')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    db.like_post(bob['user_id'], post_id)
+    as_alice = login(alice).get('/api/v1/explore')
+    as_bob = login(bob).get('/api/v1/explore')
+    assert as_alice.json['tweets'][0]['is_liked'] is False
+    assert as_bob.json['tweets'][0]['is_liked'] is True
+    assert as_alice.headers['ETag'] != as_bob.headers['ETag']
+
+
+def test_media_changes_the_etag(make_user, login):
+    alice = make_user('alice')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    client = login(alice)
+    etag = client.get('/api/v1/users/alice/tweets').headers['ETag']
+    db.add_media_to_post(post_id, 'uploads/abc.png', 'image', 'abc')
+    response = _poll(client, '/api/v1/users/alice/tweets', etag)
+    assert response.status_code == 200
+    assert response.json['tweets'][0]['media']
+
+
+def test_thread_etag(make_user, login):
+    alice = make_user('alice')
+    root = db.publish_tweet(alice['user_id'], 'root')
+    client = login(alice)
+    etag = client.get(f'/api/v1/tweets/{root}').headers['ETag']
+    assert _poll(client, f'/api/v1/tweets/{root}', etag).status_code == 304
+    db.publish_tweet(alice['user_id'], 'reply', root)
+    assert _poll(client, f'/api/v1/tweets/{root}', etag).status_code == 200
@@ -0,0 +1,48 @@
+import pytest
+
+import backends
+
+
+def _sql(statement):
+    return backends.translate(statement)[0]
+
+
+@pytest.mark.parametrize('mysql, sqlite', [
+    ('SELECT * FROM post WHERE post_id = %s', 'SELECT * FROM post WHERE post_id = ?'),
+    ("SELECT DATE_FORMAT(x, '%%Y') FROM t", "SELECT DATE_FORMAT(x, '%Y') FROM t"),
+    ('INSERT IGNORE INTO likes (user_id, post_id) VALUES (%s, %s)',
+     'INSERT OR IGNORE INTO likes (user_id, post_id) VALUES (?, ?)'),
+    ('insert  ignore into hashtag (name) VALUES (%s)', 'INSERT OR IGNORE INTO hashtag (name) VALUES (?)'),
+    ('SELECT CAST(x AS UNSIGNED) FROM t', 'SELECT CAST(x AS INTEGER) FROM t'),
+    ('WHERE created_at > NOW() - INTERVAL %s SECOND',
+     "WHERE created_at > datetime('now', 'localtime', '-' || ? || ' seconds')"),
+    ('SET created_at = NOW()', "SET created_at = datetime('now', 'localtime')"),
+    ('SELECT CHAR_LENGTH(content) FROM post', 'SELECT LENGTH(content) FROM post'),
+    ('SELECT * FROM user WHERE username LIKE %s', "SELECT * FROM user WHERE username LIKE ? ESCAPE '\\'"),
+    ('WHERE (user_id, post_id) IN ((%s, %s), (%s, %s))', 'WHERE (user_id, post_id) IN (VALUES (?, ?), (?, ?))'),
+    ('WHERE post_id IN (%s, %s)', 'WHERE post_id IN (?, ?)'),
+])
+def test_translate(mysql, sqlite):
+    assert _sql(mysql) == sqlite
+
+
+def test_for_update_is_dropped_and_takes_the_write_lock():
+    sql, locks = backends.translate('SELECT 1 FROM likes WHERE user_id = %s FOR UPDATE')
+    assert sql == 'SELECT 1 FROM likes WHERE user_id = ?'
+    assert locks
+    assert not backends.translate('SELECT 1 FROM likes')[1]
+
+
+def test_errors_are_raised_as_mysql_connector_errors(tmp_path):
+    import mysql.connector
+    backend = backends.create('sqlite', path=str(tmp_path / 'errors.db'))
+    conn = backend.connect()
+    cursor = conn.cursor()
+    with pytest.raises(mysql.connector.errors.ProgrammingError):
+        cursor.callproc('no_such_procedure')
+    with pytest.raises(mysql.connector.errors.Error):
+        cursor.execute('SELECT * FROM no_such_table')
+    cursor.execute("INSERT INTO user (user_id, username, email) VALUES ('1', 'a', 'a@x')")
+    with pytest.raises(mysql.connector.errors.IntegrityError):
+        cursor.execute("INSERT INTO user (user_id, username, email) VALUES ('2', 'A', 'b@x')")
+    conn.close()
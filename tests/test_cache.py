@@ -0,0 +1,56 @@
+import cache
+import db
+
+
+def test_invalidate_changes_the_version_and_hides_the_old_value():
+    objects = cache.ObjectCache(cache.LRUCache(100, 60), 'things')
+    loads = []
+
+    def load(keys):
+        loads.append(list(keys))
+        return {key: f'value {len(loads)}' for key in keys}
+
+    assert objects.get_or_load_many([1, 2], load) == {1: 'value 1', 2: 'value 1'}
+    assert objects.get_or_load_many([1, 2], load) == {1: 'value 1', 2: 'value 1'}
+    before = objects.versions([1, 2])
+    objects.invalidate(1)
+    after = objects.versions([1, 2])
+    assert before[1] != after[1] and before[2] == after[2]
+    assert objects.get_or_load_many([1, 2], load) == {1: 'value 2', 2: 'value 1'}
+    assert loads == [[1, 2], [1]]
+
+
+def test_like_refreshes_the_cached_tweet(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    assert db.get_tweet(post_id)['like_count'] == 0
+    version = db.post_versions([post_id])[post_id]
+    db.like_post(bob['user_id'], post_id)
+    assert db.get_tweet(post_id)['like_count'] == 1
+    assert db.post_versions([post_id])[post_id] != version
+
+
+def test_reply_refreshes_the_cached_replies(make_user):
+    alice = make_user('alice')
+    root = db.publish_tweet(alice['user_id'], 'root')
+    assert db.get_conversation(root)['replies'] == []
+    reply = db.publish_tweet(alice['user_id'], 'reply', root)
+    conversation = db.get_conversation(root)
+    assert [r['id'] for r in conversation['replies']] == [reply]
+    assert conversation['tweet']['reply_count'] == 1
+
+
+def test_media_refreshes_the_cached_tweet(make_user):
+    alice = make_user('alice')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    assert db.get_tweet(post_id)['media_urls'] == []
+    db.add_media_to_post(post_id, 'uploads/abc.png', 'image', 'abc')
+    assert db.get_tweet(post_id)['media_urls'] == ['uploads/abc.png']
+
+
+def test_profile_update_refreshes_the_cached_user(make_user):
+    alice = make_user('alice')
+    assert db.get_user(alice['user_id'])['bio'] in (None, '')
+    db.update_profile(alice['user_id'], 'new bio', None)
+    assert db.get_user(alice['user_id'])['bio'] == 'new bio'
+    assert db.get_user_by_username('alice')['bio'] == 'new bio'
@@ -0,0 +1,83 @@
+import db
+import migrate
+
+
+def _write(directory, name, sql):
+    (directory / name).write_text(sql)
+
+
+def test_fresh_schema_is_up_to_date():
+    applied = migrate.applied_versions()
+    assert {m.version for m in migrate.available()} <= set(applied)
+    assert migrate.pending() == []
+    assert migrate.migrate() == []
+
+
+def test_engine_specific_files_replace_generic_ones(tmp_path):
+    _write(tmp_path, '0001_both.sql', 'SELECT 1;')
+    _write(tmp_path, '0002_change.sql', 'SELECT 2;')
+    _write(tmp_path, '0002_change.sqlite.sql', 'SELECT 3;')
+    _write(tmp_path, '0003_mysql_only.mysql.sql', 'SELECT 4;')
+    _write(tmp_path, 'README.txt', 'not a migration')
+    sqlite = migrate.available('sqlite', str(tmp_path))
+    assert [(m.version, m.path and m.path.rsplit('/', 1)[1]) for m in sqlite] == [
+        (1, '0001_both.sql'), (2, '0002_change.sqlite.sql'), (3, None)]
+    mysql = migrate.available('mysql', str(tmp_path))
+    assert [m.path.rsplit('/', 1)[1] for m in mysql] == [
+        '0001_both.sql', '0002_change.sql', '0003_mysql_only.mysql.sql']
+
+
+def test_pending_migrations_run_once_in_order(tmp_path):
+    _write(tmp_path, '0100_add_table.sql', '''
+        -- a comment line
+        CREATE TABLE migration_probe (id INT PRIMARY KEY, label VARCHAR(20));
+        INSERT INTO migration_probe VALUES (1, 'first');
+    ''')
+    _write(tmp_path, '0101_add_row.sql', "INSERT INTO migration_probe VALUES (2, 'second');")
+    _write(tmp_path, '0102_mysql_only.mysql.sql', 'THIS IS NOT SQLITE;')
+
+    done = migrate.migrate(target=100, directory=str(tmp_path))
+    assert [m.version for m in done] == [100]
+    done = migrate.migrate(directory=str(tmp_path))
+    assert [m.version for m in done] == [101, 102]
+    assert migrate.migrate(directory=str(tmp_path)) == []
+
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT label FROM migration_probe ORDER BY id')
+        assert [row[0] for row in cursor.fetchall()] == ['first', 'second']
+        cursor.close()
+    assert {100, 101, 102} <= set(migrate.applied_versions())
+
+
+def test_failed_migration_is_not_recorded(tmp_path):
+    _write(tmp_path, '0100_broken.sql', 'SELECT * FROM no_such_table;')
+    try:
+        migrate.migrate(directory=str(tmp_path))
+    except Exception:
+        pass
+    else:
+        raise AssertionError('the broken migration ran')
+    assert 100 not in migrate.applied_versions()
+
+
+def test_split_statements_follows_delimiter_lines():
+    script = '''
+-- leading comment
+CREATE TABLE a (id INT);
+
+DELIMITER //
+CREATE PROCEDURE p()
+BEGIN
+    SELECT 1;
+    SELECT 2;
+END //
+DELIMITER ;
+DROP TABLE a;
+'''
+    statements = migrate.split_statements(script)
+    assert statements[0] == 'CREATE TABLE a (id INT)'
+    assert statements[1].startswith('CREATE PROCEDURE p()') and statements[1].endswith('END')
+    assert 'SELECT 1;\n    SELECT 2;' in statements[1]
+    assert statements[2] == 'DROP TABLE a'
+    assert len(statements) == 3
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import db
+
+
+def _publish(user, count):
+    return [db.publish_tweet(user['user_id'], f'post {i}') for i in range(count)]
+
+
+# every post in the same second, so pages have to break ties on post_id
+def _same_second():
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE post SET created_at = '2026-01-01 12:00:00'")
+        conn.commit()
+        cursor.close()
+
+
+def _walk(fetch, limit):
+    seen, before = [], None
+    while True:
+        page = fetch(before)
+        seen.extend(tweet['id'] for tweet in page)
+        before = db.next_page_cursor(page, limit)
+        if before is None:
+            return seen
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 1, 1, 12, 0, 0)
+    assert db.decode_cursor(db.encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+def test_malformed_cursor_reads_as_first_page(make_user):
+    user = make_user('alice')
+    _publish(user, 3)
+    assert db.decode_cursor('not a cursor!') is None
+    assert len(db.get_all_tweets(before='not a cursor!')) == 3
+
+
+def test_explore_pages_through_ties_once(make_user):
+    user = make_user('alice')
+    post_ids = _publish(user, 25)
+    _same_second()
+    seen = _walk(lambda before: db.get_all_tweets(limit=7, before=before), 7)
+    assert seen == sorted(post_ids, reverse=True)
+
+
+def test_user_timeline_pages_stop_at_the_end(make_user):
+    user = make_user('alice')
+    post_ids = _publish(user, 10)
+    first = db.get_user_tweets(user['user_id'], limit=5)
+    second = db.get_user_tweets(user['user_id'], limit=5, before=db.next_page_cursor(first, 5))
+    assert [t['id'] for t in first + second] == sorted(post_ids, reverse=True)
+    third = db.get_user_tweets(user['user_id'], limit=5, before=db.next_page_cursor(second, 5))
+    assert third == []
+    assert db.next_page_cursor(third, 5) is None
+
+
+def test_thread_replies_page_on_created_at_and_id(make_user):
+    user = make_user('alice')
+    root = db.publish_tweet(user['user_id'], 'root')
+    reply_ids = [db.publish_tweet(user['user_id'], f'reply {i}', root) for i in range(7)]
+    _same_second()
+    first = db.get_conversation(root, max_breadth=3, max_depth=1)
+    seen, after = [r['id'] for r in first['replies']], first['next_cursor']
+    while after:
+        page = db.get_conversation(root, max_breadth=3, max_depth=1, after=after)
+        seen += [r['id'] for r in page['replies']]
+        after = page['next_cursor']
+    assert seen == reply_ids
+
+
+def test_full_reply_page_has_no_next_cursor(make_user):
+    user = make_user('alice')
+    root = db.publish_tweet(user['user_id'], 'root')
+    for i in range(3):
+        db.publish_tweet(user['user_id'], f'reply {i}', root)
+    assert db.get_conversation(root, max_breadth=3)['next_cursor'] is None
+    assert db.get_conversation(root, max_breadth=2)['next_cursor'] is not None
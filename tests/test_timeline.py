@@ -0,0 +1,57 @@
+import db
+
+
+def _feed_ids(user):
+    return [tweet['id'] for tweet in db.get_feed_tweets(user['user_id'])]
+
+
+def _timeline_rows(user):
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT post_id FROM timeline WHERE user_id = %s', (user['user_id'],))
+        rows = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+    return rows
+
+
+def test_publish_fans_out_to_followers(make_user):
+    alice, bob, carol = make_user('alice'), make_user('bob'), make_user('carol')
+    db.follow_user(bob['user_id'], alice['user_id'])
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    assert post_id in _timeline_rows(bob)
+    assert post_id in _feed_ids(bob)
+    assert post_id in _feed_ids(alice)
+    assert post_id not in _feed_ids(carol)
+
+
+def test_follow_backfills_and_unfollow_prunes(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    older = [db.publish_tweet(alice['user_id'], f'old {i}') for i in range(3)]
+    db.follow_user(bob['user_id'], alice['user_id'])
+    assert set(older) <= set(_feed_ids(bob))
+    db.unfollow_user(bob['user_id'], alice['user_id'])
+    assert not set(older) & _timeline_rows(bob)
+    assert not set(older) & set(_feed_ids(bob))
+
+
+def test_fanout_on_read_accounts_are_merged_at_read_time(make_user):
+    celebrity, bob = make_user('celebrity'), make_user('bob')
+    db.follow_user(bob['user_id'], celebrity['user_id'])
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE user SET fanout_on_read = TRUE WHERE user_id = %s', (celebrity['user_id'],))
+        conn.commit()
+        cursor.close()
+    post_id = db.publish_tweet(celebrity['user_id'], 'to millions')
+    assert post_id not in _timeline_rows(bob)
+    assert _feed_ids(bob)[0] == post_id
+
+
+def test_feed_pages_without_repeats(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    db.follow_user(bob['user_id'], alice['user_id'])
+    post_ids = [db.publish_tweet(alice['user_id'], f'post {i}') for i in range(12)]
+    first = db.get_feed_tweets(bob['user_id'], limit=5)
+    second = db.get_feed_tweets(bob['user_id'], limit=5, before=db.next_page_cursor(first, 5))
+    third = db.get_feed_tweets(bob['user_id'], limit=5, before=db.next_page_cursor(second, 5))
+    assert [t['id'] for t in first + second + third] == sorted(post_ids, reverse=True)
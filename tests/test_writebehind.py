@@ -0,0 +1,131 @@
+import db
+import writebehind
+
+
+class Recorder:
+    def __init__(self, fail_on=(), error=KeyError):
+        self.batches = []
+        self.fail_on = set(fail_on)
+        self.error = error
+
+    def __call__(self, writes):
+        self.batches.append(list(writes))
+        if any(write[2] in self.fail_on for write in writes):
+            raise self.error('bad write')
+
+
+def _queue(apply, **settings):
+    settings.setdefault('flush_interval', 3600)
+    return writebehind.WriteBehindQueue(apply, **settings)
+
+
+def test_writes_to_one_key_collapse_and_cancel():
+    apply = Recorder()
+    queue = _queue(apply)
+    queue.submit('like', 'u1', 1, True)
+    queue.submit('like', 'u1', 1, False)   # back to the start: cancelled
+    queue.submit('like', 'u1', 2, True)
+    queue.submit('follow', 'u1', 'u2', True)
+    assert queue.state('like', 'u1', 1) is None
+    assert queue.states_for('like', 'u1') == {2: True}
+    assert queue.flush() == 2
+    assert apply.batches == [[('like', 'u1', 2, True), ('follow', 'u1', 'u2', True)]]
+    assert queue.flush() == 0
+
+
+def test_journal_is_replayed_after_a_crash(tmp_path):
+    crashed = _queue(Recorder(), journal_dir=str(tmp_path))
+    crashed.submit('like', 'u1', 1, True)
+    crashed.submit('like', 'u1', 2, True)
+    crashed.submit('like', 'u1', 2, False)
+    crashed.submit('like', 'u1', 3, True)
+    # the process dies: its lock goes away, its journal stays
+    crashed._stopped = True
+    crashed._lock_file.close()
+
+    apply = Recorder()
+    assert _queue(apply, journal_dir=str(tmp_path)).recover() == 3
+    assert apply.batches == [[('like', 'u1', 1, True), ('like', 'u1', 2, False), ('like', 'u1', 3, True)]]
+    # the journal is gone once replayed
+    assert _queue(Recorder(), journal_dir=str(tmp_path)).recover() == 0
+
+
+def test_bad_write_is_dropped_and_the_rest_applied():
+    apply = Recorder(fail_on={'gone'})
+    queue = _queue(apply, drop_errors=(KeyError,))
+    queue.submit('like', 'u1', 1, True)
+    queue.submit('like', 'u1', 'gone', True)
+    queue.submit('like', 'u1', 3, True)
+    assert queue.flush() == 2
+    assert queue.stats()['dropped'] == 1
+    assert queue.stats()['pending'] == 0
+
+
+def test_outage_keeps_the_batch_queued():
+    apply = Recorder(fail_on={1}, error=ConnectionError)
+    queue = _queue(apply, drop_errors=(KeyError,))
+    queue.submit('like', 'u1', 1, True)
+    try:
+        queue.flush()
+    except ConnectionError:
+        pass
+    assert queue.state('like', 'u1', 1) is True
+    apply.fail_on.clear()
+    assert queue.flush() == 1
+
+
+def _like_count(post_id):
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT like_count FROM post WHERE post_id = %s', (post_id,))
+        count = cursor.fetchone()[0]
+        cursor.close()
+    return count
+
+
+def test_applying_a_batch_twice_is_idempotent(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    batch = [('like', bob['user_id'], post_id, True), ('follow', bob['user_id'], alice['user_id'], True)]
+    db._apply_write_batch(batch)
+    db._apply_write_batch(batch)
+    assert _like_count(post_id) == 1
+    assert db.is_post_liked(bob['user_id'], post_id)
+    assert db.get_follower_count(alice['user_id']) == 1
+
+
+def test_queued_likes_are_visible_to_their_author_before_the_flush(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    post_id = db.publish_tweet(alice['user_id'], 'hello')
+    db.configure_write_behind(flush_interval=3600)
+    assert db.like_post(bob['user_id'], post_id)
+    assert not db.like_post(bob['user_id'], post_id)
+    assert db.get_liked_post_ids(bob['user_id'], [post_id]) == {post_id}
+    assert _like_count(post_id) == 0
+    assert db.flush_writes() == 1
+    assert _like_count(post_id) == 1
+
+
+def test_writes_to_missing_rows_are_refused(make_user):
+    alice = make_user('alice')
+    db.configure_write_behind(flush_interval=3600)
+    assert not db.like_post(alice['user_id'], 999999)
+    assert not db.follow_user(alice['user_id'], 'no-such-user')
+    assert db.flush_writes() == 0
+
+
+def test_write_to_a_deleted_post_does_not_block_the_batch(make_user):
+    alice, bob = make_user('alice'), make_user('bob')
+    kept = db.publish_tweet(alice['user_id'], 'kept')
+    deleted = db.publish_tweet(alice['user_id'], 'deleted')
+    queue = db.configure_write_behind(flush_interval=3600)
+    db.like_post(bob['user_id'], kept)
+    db.like_post(bob['user_id'], deleted)
+    with db.get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM post WHERE post_id = %s', (deleted,))
+        conn.commit()
+        cursor.close()
+    assert db.flush_writes() == 1
+    assert queue.stats()['dropped'] == 1
+    assert _like_count(kept) == 1
@@ -0,0 +1,145 @@
+import heapq
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, Iterable, List, Tuple
+
+# trending hashtags - sliding-window counts kept in memory
+#
+# hashtag uses are counted in fixed time buckets. each window (1h, 24h)
+# keeps a running total of the buckets inside it, so recording a use is
+# a few dict updates and reading the top list is a cached lookup.
+# buckets that slide out of a window are subtracted during compaction.
+
+# width of one count bucket in seconds
+BUCKET_SECONDS = 300
+
+# windows shown on the explore page, name -> seconds
+WINDOWS = {
+    '1h': 3600,
+    '24h': 24 * 3600,
+}
+
+# how many hashtags each top list holds
+TOP_K = 10
+
+# how often expired buckets are dropped and top lists recomputed
+COMPACT_SECONDS = 30
+
+
+class TrendingHashtags:
+    def __init__(self, windows: Dict[str, int] = None, bucket_seconds: int = BUCKET_SECONDS,
+                 top_k: int = TOP_K, compact_seconds: int = COMPACT_SECONDS):
+        self.windows = dict(windows or WINDOWS)
+        self.bucket_seconds = bucket_seconds
+        self.top_k = top_k
+        self.compact_seconds = compact_seconds
+        self._lock = threading.Lock()
+        self.clear()
+
+    # forget every count
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._buckets = {}                                      # bucket start -> Counter
+        self._window_buckets = {w: deque() for w in self.windows}  # sorted bucket starts inside each window
+        self._window_members = {w: set() for w in self.windows}
+        self._totals = {w: Counter() for w in self.windows}
+        self._names = {}                                        # lowercase -> display spelling
+        self._top = {w: [] for w in self.windows}
+        self._compacted_at = 0.0
+        self.loaded_at = None
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds) * self.bucket_seconds
+
+    # count hashtag uses, `timestamp` defaults to now
+    def record(self, hashtags: Iterable[str], timestamp: float = None, count: int = 1):
+        now = time.time()
+        timestamp = now if timestamp is None else timestamp
+        bucket = self._bucket(timestamp)
+        with self._lock:
+            self._add(bucket, hashtags, count, now)
+            self._maybe_compact(now)
+
+    def _add(self, bucket: int, hashtags: Iterable[str], count: int, now: float):
+        counts = self._buckets.get(bucket)
+        if counts is None:
+            counts = self._buckets[bucket] = Counter()
+            for window, seconds in self.windows.items():
+                # only buckets still inside the window join its total
+                if bucket >= self._bucket(now - seconds):
+                    self._insert_bucket(self._window_buckets[window], bucket)
+                    self._window_members[window].add(bucket)
+        windows = [window for window, members in self._window_members.items() if bucket in members]
+        for name in hashtags:
+            key = name.lower()
+            self._names.setdefault(key, name)
+            counts[key] += count
+            for window in windows:
+                self._totals[window][key] += count
+
+    # keep a window's bucket list sorted - old buckets can arrive during a rebuild
+    def _insert_bucket(self, starts: deque, bucket: int):
+        if not starts or bucket > starts[-1]:
+            starts.append(bucket)
+            return
+        items = sorted(set(starts) | {bucket})
+        starts.clear()
+        starts.extend(items)
+
+    def _maybe_compact(self, now: float):
+        if now - self._compacted_at >= self.compact_seconds:
+            self._compact(now)
+
+    # drop buckets that left each window and refresh the top lists
+    def _compact(self, now: float):
+        for window, seconds in self.windows.items():
+            oldest = self._bucket(now - seconds)
+            starts = self._window_buckets[window]
+            totals = self._totals[window]
+            while starts and starts[0] < oldest:
+                bucket = starts.popleft()
+                self._window_members[window].discard(bucket)
+                totals.subtract(self._buckets[bucket])
+            # drop zero entries so the counter doesn't grow forever
+            for key in [key for key, value in totals.items() if value <= 0]:
+                del totals[key]
+            self._top[window] = heapq.nlargest(self.top_k, totals.items(), key=lambda item: (item[1], item[0]))
+
+        # buckets outside the longest window are no longer needed
+        oldest_kept = self._bucket(now - max(self.windows.values()))
+        for bucket in [bucket for bucket in self._buckets if bucket < oldest_kept]:
+            del self._buckets[bucket]
+        live = set().union(*self._totals.values())
+        for key in [key for key in self._names if key not in live]:
+            del self._names[key]
+        self._compacted_at = now
+
+    # force compaction now, e.g. from a scheduled job
+    def compact(self):
+        with self._lock:
+            self._compact(time.time())
+
+    # replace all counts with aggregated rows of (hashtag, unix time, uses)
+    def load(self, rows: Iterable[Tuple[str, float, int]]):
+        now = time.time()
+        with self._lock:
+            self._reset()
+            for name, timestamp, count in rows:
+                self._add(self._bucket(timestamp), [name], count, now)
+            self._compact(now)
+            self.loaded_at = now
+
+    # top hashtags in a window as [{'name': ..., 'count': ...}]
+    def top(self, window: str = '24h', k: int = None) -> List[Dict]:
+        with self._lock:
+            self._maybe_compact(time.time())
+            top = self._top[window][:k or self.top_k]
+            return [{'name': self._names.get(key, key), 'count': count} for key, count in top]
+
+
+# shared instance used by db.py and the explore page
+hashtags = TrendingHashtags()
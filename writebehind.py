@@ -0,0 +1,327 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# write-behind queue for toggles such as likes and follows
+#
+# each write is a desired state for a key (kind, actor, target), e.g.
+# ('like', user_id, post_id) -> True. writes wait in memory and a worker
+# thread hands them to `apply_batch` every `flush_interval` seconds or
+# once `batch_size` are waiting. two writes to one key collapse into the
+# last one, and a write that returns the key to the state it had before
+# the first one (like, then unlike) cancels out.
+#
+# every write is appended to a journal before submit() returns. a flush
+# rotates the journal into a segment that is deleted once the batch has
+# committed, so after a crash the next process replays whatever was not
+# flushed. apply_batch must set states idempotently for that to be safe.
+# when a batch fails, its writes are retried one at a time: a write that
+# fails on its own with one of `drop_errors` (e.g. a like of a post deleted
+# since) is logged and dropped, so it can't hold back the writes around it.
+# any other error is taken for an outage and the batch waits for a retry.
+# each process keeps its own journal and holds a lock on it; a lock that
+# can be taken belongs to a dead process, whose journal the worker thread
+# replays when it starts.
+
+logger = logging.getLogger(__name__)
+
+# seconds between flushes, and writes that trigger a flush early
+FLUSH_INTERVAL = 0.5
+BATCH_SIZE = 500
+
+# a failed flush is retried after this many seconds
+RETRY_SECONDS = 2.0
+
+Key = Tuple[str, Hashable, Hashable]
+
+
+class _Pending:
+    __slots__ = ('initial', 'state')
+
+    def __init__(self, initial: bool, state: bool):
+        self.initial = initial
+        self.state = state
+
+
+class WriteBehindQueue:
+    def __init__(self, apply_batch: Callable[[List[Tuple[str, Hashable, Hashable, bool]]], None],
+                 journal_dir: Optional[str] = None, name: str = 'writes',
+                 flush_interval: float = FLUSH_INTERVAL, batch_size: int = BATCH_SIZE, fsync: bool = True,
+                 drop_errors: Tuple[type, ...] = ()):
+        self.apply_batch = apply_batch
+        self.drop_errors = drop_errors
+        self.journal_dir = journal_dir
+        self.name = name
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self._stats = {'submitted': 0, 'cancelled': 0, 'flushed': 0, 'batches': 0, 'failures': 0,
+                       'dropped': 0}
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = OrderedDict()   # key -> _Pending, waiting for a flush
+        self._inflight = {}             # key -> state, in the batch being written
+        self._worker = None
+        self._stopped = False
+        self._pid = os.getpid()
+        # pids get reused after a restart, so journals carry a random part too
+        self._id = f'{self._pid}-{uuid.uuid4().hex[:8]}'
+        self._journal = None
+        self._lock_file = None
+        self._segment_seq = 0
+        self._segments = []             # rotated journal files not yet committed
+
+    # journal files of this process, or of the process with `owner` id
+    def _path(self, suffix: str, owner: str = None) -> str:
+        return os.path.join(self.journal_dir, f'{self.name}-{owner or self._id}{suffix}')
+
+    # lazily start the worker and journal, again in a forked child
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._reset()
+        if self._worker is not None:
+            return
+        if self.journal_dir:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            # lock before the file becomes visible, or recover() in another
+            # process could take it for a dead one
+            self._lock_file = open(self._path('.lock.tmp'), 'w')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            os.replace(self._path('.lock.tmp'), self._path('.lock'))
+            self._journal = open(self._path('.log'), 'a')
+        self._worker = threading.Thread(target=self._run, name=f'pinkbird-{self.name}', daemon=True)
+        self._worker.start()
+
+    def _append_journal(self, key: Key, state: bool):
+        if self._journal is None:
+            return
+        self._journal.write(json.dumps([*key, state]) + '\n')
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _merge(self, key: Key, state: bool, initial: bool):
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = _Pending(initial, state)
+            return
+        entry.state = state
+        if entry.state == entry.initial:
+            del self._pending[key]
+            self._stats['cancelled'] += 1
+
+    # queue a state change - the caller has checked that `state` differs
+    # from the current one (see state())
+    def submit(self, kind: str, actor: Hashable, target: Hashable, state: bool):
+        key = (kind, actor, target)
+        with self._lock:
+            self._ensure_started()
+            self._append_journal(key, state)
+            self._merge(key, state, not state)
+            self._stats['submitted'] += 1
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    # the state a key will have once queued writes are flushed, None when
+    # nothing is queued for it - this is what makes writes visible to
+    # their author before they reach the database
+    def state(self, kind: str, actor: Hashable, target: Hashable) -> Optional[bool]:
+        key = (kind, actor, target)
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None:
+                return entry.state
+            return self._inflight.get(key)
+
+    # queued states of one actor's writes of a kind, as {target: state}
+    def states_for(self, kind: str, actor: Hashable) -> Dict[Hashable, bool]:
+        with self._lock:
+            found = {key[2]: state for key, state in self._inflight.items()
+                     if key[0] == kind and key[1] == actor}
+            found.update({key[2]: entry.state for key, entry in self._pending.items()
+                          if key[0] == kind and key[1] == actor})
+        return found
+
+    # write everything queued so far, returns how many writes were applied
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, OrderedDict()
+                self._inflight = {key: entry.state for key, entry in batch.items()}
+                segments = self._rotate_journal()
+            writes = [(*key, entry.state) for key, entry in batch.items()]
+            dropped = 0
+            try:
+                self.apply_batch(writes)
+            except Exception:
+                logger.exception('write-behind flush of %d %s failed, retrying one at a time',
+                                 len(batch), self.name)
+                left, dropped, error = self._apply_singly(writes)
+                if error is not None:
+                    with self._lock:
+                        # newer writes win, but the database still holds the old state
+                        for key in (tuple(write[:3]) for write in left):
+                            entry = batch[key]
+                            newer = self._pending.pop(key, None)
+                            if newer is None:
+                                self._pending[key] = entry
+                            elif newer.state != entry.initial:
+                                self._pending[key] = _Pending(entry.initial, newer.state)
+                        self._inflight = {}
+                        self._stats['failures'] += 1
+                    raise error
+            with self._lock:
+                self._inflight = {}
+                self._stats['flushed'] += len(batch) - dropped
+                self._stats['batches'] += 1
+            # every write in these segments has been applied
+            for path in segments:
+                os.remove(path)
+                self._segments.remove(path)
+            return len(batch) - dropped
+
+    # apply writes one by one after their batch failed. returns the writes
+    # not applied yet, how many were dropped, and the error that stopped it
+    def _apply_singly(self, writes: List[tuple]) -> Tuple[List[tuple], int, Optional[Exception]]:
+        dropped, left, error = 0, [], None
+        for i, write in enumerate(writes):
+            try:
+                self.apply_batch([write])
+            except self.drop_errors:
+                logger.exception('dropping write-behind %s write %r', self.name, write)
+                dropped += 1
+            except Exception as e:
+                left, error = writes[i:], e
+                break
+        with self._lock:
+            self._stats['dropped'] += dropped
+        return left, dropped, error
+
+    # move the journal aside so writes after this point go to a fresh one.
+    # returns the segments the batch being flushed covers
+    def _rotate_journal(self) -> List[str]:
+        if self._journal is None:
+            return []
+        self._journal.close()
+        self._segment_seq += 1
+        segment = self._path(f'.{self._segment_seq}.segment')
+        os.replace(self._path('.log'), segment)
+        self._segments.append(segment)
+        self._journal = open(self._path('.log'), 'a')
+        return list(self._segments)
+
+    def _run(self):
+        try:
+            self.recover()
+        except Exception:
+            logger.exception('replaying %s journals failed', self.name)
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stopped:
+                return
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(RETRY_SECONDS)
+
+    # flush and stop the worker, called at exit
+    def stop(self):
+        if self._pid != os.getpid() or self._worker is None:
+            return
+        self._stopped = True
+        self._wake.set()
+        self._worker.join(timeout=5)
+        try:
+            self.flush()
+        except Exception:
+            # the journal still has the writes, the next start replays them
+            return
+        if self._journal is not None:
+            self._journal.close()
+            os.remove(self._path('.log'))
+            self._lock_file.close()
+            os.remove(self._path('.lock'))
+
+    # apply writes left in the journals of processes that died before
+    # flushing them. returns how many writes were replayed
+    def recover(self) -> int:
+        if not self.journal_dir or not os.path.isdir(self.journal_dir):
+            return 0
+        replayed = 0
+        for lock_path in glob.glob(os.path.join(self.journal_dir, f'{self.name}-*.lock')):
+            owner = os.path.basename(lock_path)[len(self.name) + 1:-len('.lock')]
+            if owner == self._id:
+                continue
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # its process is still running
+                replayed += self._replay(owner)
+                os.remove(lock_path)
+        return replayed
+
+    def _replay(self, owner: str) -> int:
+        def segment_seq(path):
+            return int(path.rsplit('.', 2)[-2])
+        paths = sorted(glob.glob(self._path('.*.segment', owner)), key=segment_seq)
+        if os.path.exists(self._path('.log', owner)):
+            paths.append(self._path('.log', owner))
+        writes = OrderedDict()
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        kind, actor, target, state = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a crash
+                    writes.pop((kind, actor, target), None)
+                    writes[(kind, actor, target)] = state
+        if writes:
+            writes = [(*key, state) for key, state in writes.items()]
+            try:
+                self.apply_batch(writes)
+            except Exception:
+                logger.exception('replaying %d %s writes failed, retrying one at a time', len(writes), self.name)
+                _, _, error = self._apply_singly(writes)
+                if error is not None:
+                    raise error
+        for path in paths:
+            os.remove(path)
+        return len(writes)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+            stats['inflight'] = len(self._inflight)
+        return stats
+
+
+# stop every queue cleanly when the interpreter exits
+_queues = []
+
+def register(queue: WriteBehindQueue) -> WriteBehindQueue:
+    _queues.append(queue)
+    return queue
+
+@atexit.register
+def _stop_all():
+    for queue in _queues:
+        queue.stop()